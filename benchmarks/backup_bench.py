@@ -0,0 +1,118 @@
+"""ワールドの増分バックアップを、生成したワールドとローカルの S3 で計測する
+
+    python benchmarks/backup_bench.py [--size-mb 1024] [--touched 0.1] [--span-kb 1024] [--bandwidth-mb 50]
+                                      [--endpoint-url http://localhost:9000 --bucket backups]
+
+--size-mb のワールド(8MB のリージョンファイル)を生成して初回のバックアップを取り、
+1日遊んだ想定で --touched の割合のリージョンの連続した --span-kb を書き換えてから2回目(増分)を取る。
+最後に両方のスナップショットを復元して、元のファイルと一致することを確かめる。
+既定はメモリ上の FakeS3(接続毎に --bandwidth-mb MB/秒、リクエスト毎に数十ミリ秒の遅延)。
+--endpoint-url を渡すと boto3 で S3 互換のサーバー(MinIO など)に対して実行する。
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeS3, Latency  # noqa: E402
+from world_backup import UPLOAD_WORKERS, backup, restore  # noqa: E402
+
+REGION_SIZE = 8 * 1024 * 1024
+SECTOR = 4096
+DAY = 86400
+MB = 1024 * 1024
+
+
+def generate_world(world_dir, size_mb, rng):
+    region_dir = os.path.join(world_dir, 'region')
+    os.makedirs(region_dir)
+    os.makedirs(os.path.join(world_dir, 'playerdata'))
+    for index in range(max(size_mb * MB // REGION_SIZE, 1)):
+        with open(os.path.join(region_dir, f'r.{index % 16}.{index // 16}.mca'), 'wb') as f:
+            f.write(rng.randbytes(REGION_SIZE))
+    for name in ('level.dat', 'playerdata/player.dat'):
+        with open(os.path.join(world_dir, name), 'wb') as f:
+            f.write(rng.randbytes(4096))
+
+
+def play(world_dir, touched, span, rng):
+    """遊んだ範囲のチャンクが保存される(リージョン内の連続したセクタが書き換わる)"""
+    region_dir = os.path.join(world_dir, 'region')
+    regions = sorted(os.listdir(region_dir))
+    for name in rng.sample(regions, max(int(len(regions) * touched), 1)):
+        offset = rng.randrange(0, REGION_SIZE - span, SECTOR)
+        with open(os.path.join(region_dir, name), 'r+b') as f:
+            f.seek(offset)
+            f.write(rng.randbytes(span))
+    with open(os.path.join(world_dir, 'level.dat'), 'r+b') as f:
+        f.write(rng.randbytes(64))
+
+
+def digests(world_dir):
+    result = {}
+    for root, _, names in os.walk(world_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                result[os.path.relpath(path, world_dir)] = hashlib.sha256(f.read()).hexdigest()
+    return result
+
+
+def report(label, summary, elapsed):
+    print(f"{label:<12} {summary['bytes'] / MB:8.0f} MB world, read {summary['read_bytes'] / MB:8.1f} MB, "
+          f"uploaded {summary['uploaded_bytes'] / MB:8.1f} MB in {summary['uploaded_chunks']:4} chunks, "
+          f"{elapsed:6.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--touched', type=float, default=0.1, help='1日で書き換わるリージョンの割合')
+    parser.add_argument('--span-kb', type=int, default=1024, help='リージョン毎に書き換わる連続した範囲')
+    parser.add_argument('--bandwidth-mb', type=float, default=50, help='FakeS3 の接続毎の帯域(MB/秒)')
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS)
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--bucket', default='backups')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.endpoint_url:
+        import boto3
+        s3 = boto3.client('s3', endpoint_url=args.endpoint_url)
+    else:
+        s3 = FakeS3(sleep=time.sleep, latency=Latency(0.02, 0.1), bandwidth=args.bandwidth_mb * MB)
+    prefix = f'bench-{int(time.time())}'
+    now = time.time()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        world = os.path.join(tmp, 'world')
+        generate_world(world, args.size_mb, rng)
+        snapshots = []
+        for day, label in enumerate(('full', 'incremental')):
+            if day:
+                play(world, args.touched, args.span_kb * 1024, rng)
+            started = time.perf_counter()
+            summary = backup(s3, args.bucket, prefix, world, workers=args.workers, now=now + day * DAY)
+            report(label, summary, time.perf_counter() - started)
+            snapshots.append((time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now + day * DAY)), digests(world)))
+
+        for at, expected in snapshots:
+            restored = os.path.join(tmp, f'restore-{at}')
+            started = time.perf_counter()
+            restore(s3, args.bucket, prefix, restored, at=at, workers=args.workers)
+            ok = digests(restored) == expected
+            print(f'restore {at}: {"identical" if ok else "MISMATCH"} in {time.perf_counter() - started:.1f} s')
+            if not ok:
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""ハンドラ1回あたりのクライアント生成コストを、変更前後で比較する
+
+    python benchmarks/client_setup.py [回数]
+
+ネットワークには接続しない(クライアント・セッションの生成のみを計測する)。
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
+os.environ.setdefault('AWS_REGION', 'ap-northeast-1')
+os.environ.setdefault('AWS_DEFAULT_REGION', os.environ['AWS_REGION'])
+
+import boto3  # noqa: E402
+import requests  # noqa: E402
+
+import clients  # noqa: E402
+
+
+def setup_before():
+    # 変更前: 呼び出し毎にクライアント・リソースを生成し、requests.post は毎回セッションを作る
+    boto3.client('ec2', region_name=os.environ['AWS_REGION'])
+    boto3.resource('ec2').Instance('i-00000000000000000')
+    boto3.client('ssm')
+    boto3.client('events')
+    requests.Session().close()
+
+
+def setup_after():
+    # 変更後: モジュールレベルのキャッシュから取得する
+    clients.get_client('ec2')
+    clients.get_client('ssm')
+    clients.get_client('events')
+    clients.get_http_session()
+
+
+def measure(setup, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        setup()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    before = measure(setup_before, count)
+    clients.reset()
+    after = measure(setup_after, count)
+
+    print(f'{"":8} {"first(ms)":>10} {"warm avg(ms)":>13}')
+    for name, timings in (('before', before), ('after', after)):
+        warm = timings[1:] or timings
+        print(f'{name:8} {timings[0]:10.2f} {sum(warm) / len(warm):13.3f}')
+
+
+if __name__ == '__main__':
+    main()
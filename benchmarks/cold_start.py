@@ -0,0 +1,113 @@
+"""各Lambda関数のコールドスタート(import)にかかる時間を計測する
+
+    python benchmarks/cold_start.py [関数名 ...] [--top N] [--runs N]
+
+関数毎に新しいPythonプロセスで `import app` を実行し、-X importtime の結果から
+時間のかかっているトップレベルモジュールを表示する。
+slash_commands_callback は署名付きPINGを1回処理するまでの時間も計測する。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+COMMON = os.path.join(SRC, 'common')
+
+FUNCTIONS = ['slash_commands_callback', 'start_ec2', 'stop_ec2', 'restart_ec2', 'monitoring_ec2']
+
+CHILD = """
+import json, os, time
+started = time.perf_counter()
+import app
+result = {'import_ms': (time.perf_counter() - started) * 1000}
+if os.getenv('BENCH_EVENT'):
+    event = json.loads(os.environ['BENCH_EVENT'])
+    started = time.perf_counter()
+    app.lambda_handler(event, None)
+    result['ping_ms'] = (time.perf_counter() - started) * 1000
+print(json.dumps(result))
+"""
+
+
+def signed_ping_event():
+    from nacl.signing import SigningKey
+
+    signing_key = SigningKey.generate()
+    body = json.dumps({'type': 1})
+    timestamp = '1700000000'
+    signature = signing_key.sign(f'{timestamp}{body}'.encode()).signature.hex()
+    event = {
+        'headers': {'X-Signature-Ed25519': signature, 'X-Signature-Timestamp': timestamp},
+        'body': body,
+    }
+    return signing_key.verify_key.encode().hex(), event
+
+
+def run_once(function, env, event):
+    env = dict(env, BENCH_EVENT=json.dumps(event) if event else '')
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD],
+        cwd=os.path.join(SRC, function), env=env, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.splitlines()[-1]), parse_importtime(process.stderr)
+
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package" の出力は子が親より先に並ぶ
+    # app が直接 import したモジュール(深さ1)の累積時間を集計する
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            children[name] = int(cumulative) / 1000
+        elif depth == 0:
+            if name == 'app':
+                return children
+            children = {}
+    return children
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('functions', nargs='*', default=FUNCTIONS)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    public_key, ping_event = signed_ping_event()
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': COMMON,
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'AWS_REGION': env.get('AWS_REGION', 'ap-northeast-1'),
+        'AWS_DEFAULT_REGION': env.get('AWS_REGION', 'ap-northeast-1'),
+        'APPLICATION_PUBLIC_KEY': public_key,
+        'EC2_INSTANCE_ID': 'i-00000000000000000',
+    })
+
+    for function in args.functions:
+        event = ping_event if function == 'slash_commands_callback' else None
+        results = []
+        modules = {}
+        for _ in range(args.runs):
+            result, modules = run_once(function, env, event)
+            results.append(result)
+
+        import_ms = statistics.median(r['import_ms'] for r in results)
+        line = f'{function}: import app {import_ms:.1f} ms'
+        if event is not None:
+            line += f', signed PING {statistics.median(r["ping_ms"] for r in results):.2f} ms'
+        print(line)
+        for name, ms in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'    {ms:8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""1週間分のイベントを再生して、関数を分けた場合とまとめた場合(router)のコールドスタートを比べる
+
+    python benchmarks/consolidation_replay.py [--keep-warm 600] [--runtime-ms 100] [--runs 3] [--seed 1]
+
+初期化にかかる時間は新しいPythonプロセスでの import から計測する。
+- split: 関数毎に `<関数>.app` を import し、boto3 のクライアントを作る
+- consolidated: `router.app` と boto3 のクライアントはコンテナ毎に1回、各関数の app は初めて使う時に1回
+イベントは prewarm_replay の履歴(平日夜と週末昼に遊ぶグループ)から作る。
+事前起動は5分毎、監視は起動中だけ5分毎、遊び始めに /start と /status、30分無人なら監視が停止する。
+コンテナは最後の呼び出しから --keep-warm 秒で破棄され、実行中のコンテナは他の呼び出しに使えないものとする。
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cold_start import COMMON, SRC, signed_ping_event  # noqa: E402
+from prewarm_replay import generate_history  # noqa: E402
+
+FUNCTIONS = ['slash_commands_callback', 'start_ec2', 'stop_ec2', 'restart_ec2', 'backup_ec2', 'monitoring_ec2',
+             'prewarm_ec2', 'state_change_ec2']
+
+INTERVAL = 300  # 事前起動・監視のスケジュール
+IDLE_STOP = 1800  # 無人でこの秒数が経ったら監視が停止する
+START_INVOCATIONS = 20  # 起動ワーカーの呼び出し回数(SQS からの再開を含む。simulate.py の start と同程度)
+START_SECONDS = 100
+STOP_INVOCATIONS = 5
+STOP_SECONDS = 15
+
+# 1回の呼び出しにかかる秒数(ウォーム時)
+DURATION = {
+    'slash_commands_callback': 0.1,
+    'start_ec2': 0.3,
+    'stop_ec2': 0.3,
+    'restart_ec2': 0.3,
+    'backup_ec2': 0.3,
+    'monitoring_ec2': 1.5,
+    'prewarm_ec2': 0.2,
+    'state_change_ec2': 0.1,
+}
+
+CHILD = """
+import json, sys, time
+import boto3
+result = []
+for name in sys.argv[1:]:
+    started = time.perf_counter()
+    if name == 'boto3':
+        boto3.client('ec2')
+    else:
+        __import__(name)
+    result.append((time.perf_counter() - started) * 1000)
+print(json.dumps(result))
+"""
+
+
+def measure(modules, env, runs):
+    """modules を順に import した時のそれぞれの所要時間(ミリ秒、runs 回の中央値)"""
+    samples = []
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-c', CHILD, *modules],
+                                 cwd=SRC, env=env, capture_output=True, text=True, check=True)
+        samples.append(json.loads(process.stdout.splitlines()[-1]))
+    return [statistics.median(values) for values in zip(*samples)]
+
+
+def measure_init(runs):
+    public_key, _ = signed_ping_event()
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': COMMON,
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'AWS_REGION': env.get('AWS_REGION', 'ap-northeast-1'),
+        'AWS_DEFAULT_REGION': env.get('AWS_REGION', 'ap-northeast-1'),
+        'APPLICATION_PUBLIC_KEY': public_key,
+        'EC2_INSTANCE_ID': 'i-00000000000000000',
+    })
+    # boto3 の import は実際には最初の API 呼び出しの時だが、どのコンテナも必ず払うので初期化に含める
+    split = {function: sum(measure([f'{function}.app', 'boto3'], env, runs)) for function in FUNCTIONS}
+    router, *lazy = measure(['router.app', 'boto3', *[f'{function}.app' for function in FUNCTIONS]], env, runs)
+    sdk, *lazy = lazy
+    return split, router + sdk, dict(zip(FUNCTIONS, lazy))
+
+
+def generate_events(seed):
+    """(時刻, 関数) のリスト"""
+    rng = random.Random(seed)
+    series = generate_history(1, seed)
+    start, end = series.times[0], series.times[-1] + INTERVAL
+
+    events = [(t, 'prewarm_ec2') for t in range(start, end, INTERVAL)]
+    running = False
+    idle_since = None
+    for t, players in zip(series.times, series.players):
+        if not running and players:
+            # 遊びに来た人が /start して、起動ワーカーが SQS で再開しながら起動を待つ
+            running = True
+            idle_since = None
+            t -= rng.uniform(0, INTERVAL)  # 5分刻みの記録より前に来ている
+            events.append((t, 'slash_commands_callback'))
+            events += [(t + 1 + i * START_SECONDS / START_INVOCATIONS, 'start_ec2') for i in range(START_INVOCATIONS)]
+            events += [(t + 2, 'state_change_ec2'), (t + 40, 'state_change_ec2')]
+            events += [(t + rng.uniform(120, 600), 'slash_commands_callback') for _ in range(rng.randint(1, 3))]
+        elif running:
+            events.append((t, 'monitoring_ec2'))
+            if players:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = t
+            elif t - idle_since >= IDLE_STOP:
+                running = False
+                if rng.random() < 0.3:
+                    # 監視より先に誰かが /stop した
+                    events.append((t - 60, 'slash_commands_callback'))
+                    events += [(t - 59 + i * STOP_SECONDS / STOP_INVOCATIONS, 'stop_ec2')
+                               for i in range(STOP_INVOCATIONS)]
+                events += [(t + 5, 'state_change_ec2'), (t + 60, 'state_change_ec2')]
+    return sorted(events)
+
+
+def replay(events, keep_warm, init_of, container_key):
+    """関数毎のコールドスタートの回数と初期化の合計(ミリ秒)"""
+    pools = {}  # container_key → [{'busy_until', 'loaded'}]
+    colds = Counter()
+    total = 0.0
+    for t, function in events:
+        pool = pools.setdefault(container_key(function), [])
+        pool[:] = [c for c in pool if c['busy_until'] + keep_warm >= t]
+        container = next((c for c in pool if c['busy_until'] <= t), None)
+        if container is None:
+            container = {'busy_until': t, 'loaded': set()}
+            pool.append(container)
+            colds[function] += 1
+        init = init_of(container, function)
+        total += init
+        container['busy_until'] = t + DURATION[function] + init / 1000
+    return colds, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keep-warm', type=float, default=600, help='アイドルのコンテナが破棄されるまでの秒数')
+    parser.add_argument('--runtime-ms', type=float, default=100, help='import 以外のランタイムの初期化(ミリ秒)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    split_init, router_init, lazy_init = measure_init(args.runs)
+    print('init (import + boto3 client, ms):')
+    for function in FUNCTIONS:
+        print(f'    {function:<24} split {split_init[function]:8.1f}   router first use {lazy_init[function]:8.1f}')
+    print(f'    {"router":<24} {router_init:8.1f}')
+
+    def split(container, function):
+        if container['loaded']:
+            return 0.0
+        container['loaded'].add(function)
+        return args.runtime_ms + split_init[function]
+
+    def consolidated(container, function):
+        init = 0.0
+        if not container['loaded']:
+            init += args.runtime_ms + router_init
+        if function not in container['loaded']:
+            container['loaded'].add(function)
+            init += lazy_init[function]
+        return init
+
+    events = generate_events(args.seed)
+    print(f'\n{len(events)} invocations in a week (keep warm {args.keep_warm:.0f} s)')
+    calls = Counter(function for _, function in events)
+    print(f"{'mode':<14} {'cold starts':>12} {'cold rate':>10} {'init total':>12}   cold / invocations")
+    for mode, init_of, key in [('split', split, lambda function: function),
+                               ('consolidated', consolidated, lambda function: 'router')]:
+        colds, total = replay(events, args.keep_warm, init_of, key)
+        detail = ', '.join(f'{function} {colds[function]}/{calls[function]}' for function in FUNCTIONS)
+        cold = sum(colds.values())
+        print(f'{mode:<14} {cold:>12} {cold / len(events):>10.1%} {total / 1000:>10.1f} s   {detail}')
+
+
+if __name__ == '__main__':
+    main()
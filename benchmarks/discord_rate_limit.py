@@ -0,0 +1,127 @@
+"""Discord のレート制限を再現するローカルのフェイクサーバーに対して、投稿の挙動を確認する
+
+    python benchmarks/discord_rate_limit.py [--limit 5] [--window 1.0]
+
+フェイクはルート毎に window 秒あたり limit 回まで受け付け、X-RateLimit-* ヘッダーを返し、
+超えた場合は 429 と retry_after を返す(--no-headers でヘッダーを返さず 429 だけで制限する)。
+直列・並列の投稿と、フリート全体の停止通知のまとめ投稿で、429 の回数と所要時間を表示する。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
+
+
+class FakeDiscord(ThreadingHTTPServer):
+    def __init__(self, limit, window, headers=True):
+        super().__init__(('127.0.0.1', 0), FakeDiscordHandler)
+        self.limit = limit
+        self.window = window
+        self.headers = headers
+        self.lock = threading.Lock()
+        self.buckets = {}  # パス → (ウィンドウ開始時刻, 受け付けた回数)
+        self.accepted = 0
+        self.embeds = 0
+        self.rejected = 0
+
+    def take(self, path):
+        """(受け付けたか, 残り回数, リセットまでの秒数)"""
+        with self.lock:
+            now = time.monotonic()
+            started, count = self.buckets.get(path, (now, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+            reset_after = self.window - (now - started)
+            if count >= self.limit:
+                self.rejected += 1
+                return False, 0, reset_after
+            self.buckets[path] = (started, count + 1)
+            self.accepted += 1
+            return True, self.limit - count - 1, reset_after
+
+
+class FakeDiscordHandler(BaseHTTPRequestHandler):
+    def handle_request(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        accepted, remaining, reset_after = self.server.take(self.path)
+        if accepted:
+            self.server.embeds += len(body.get('embeds', []))
+            self.send_response(200)
+            payload = {'id': '1'}
+        else:
+            self.send_response(429)
+            payload = {'message': 'You are being rate limited.', 'retry_after': round(reset_after, 3), 'global': False}
+        if self.server.headers:
+            self.send_header('X-RateLimit-Bucket', 'bucket-' + self.path.split('/')[2])
+            self.send_header('X-RateLimit-Limit', str(self.server.limit))
+            self.send_header('X-RateLimit-Remaining', str(remaining))
+            self.send_header('X-RateLimit-Reset-After', f'{reset_after:.3f}')
+        data = json.dumps(payload).encode()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_POST = handle_request
+    do_PATCH = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+def run(label, server, function):
+    server.accepted = server.embeds = server.rejected = 0
+    started = time.monotonic()
+    function()
+    print(f'{label}: {server.accepted} messages ({server.embeds} embeds) delivered, '
+          f'{server.rejected} x 429, {time.monotonic() - started:.2f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--window', type=float, default=1.0)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--no-headers', action='store_true')
+    args = parser.parse_args()
+
+    server = FakeDiscord(args.limit, args.window, headers=not args.no_headers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['DISCORD_API_BASE'] = f'http://127.0.0.1:{server.server_port}/api/v10'
+    os.environ.setdefault('COMMAND_CHANNEL_ID', '1')
+
+    import discord_message  # noqa: E402
+
+    # 同じプロセスで状態を持ち越さないよう、シナリオ毎にリミッターを作り直す
+    def sequential():
+        discord_message._limiter = discord_message.RateLimiter()
+        for index in range(args.messages):
+            discord_message.send_message(f'message {index}', '')
+
+    def concurrent():
+        discord_message._limiter = discord_message.RateLimiter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda index: discord_message.send_message(f'message {index}', ''),
+                              range(args.messages)))
+
+    def fleet_notices():
+        discord_message._limiter = discord_message.RateLimiter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda index: discord_message.queue_message(f'server {index} stopped', ''),
+                              range(args.messages)))
+        discord_message.flush_messages()
+
+    run('sequential', server, sequential)
+    run('concurrent', server, concurrent)
+    run('fleet notices', server, fleet_notices)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""ログに出力された EMF の計測値から、フェーズ毎の p50 / p95 を集計する
+
+    python benchmarks/local_workflow.py | python benchmarks/emf_summary.py
+    sam logs -n StartEC2Function --start-time '1 week ago' | python benchmarks/emf_summary.py
+
+JSON 以外の行は無視する。(action, フェーズ) 毎にサンプル数・p50・p95・最大をミリ秒で表示する。
+"""
+import json
+import sys
+from collections import defaultdict
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def parse(lines):
+    samples = defaultdict(list)
+    for line in lines:
+        start = line.find('{"_aws"')
+        if start < 0:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        for directive in record['_aws']['CloudWatchMetrics']:
+            for metric in directive['Metrics']:
+                value = record.get(metric['Name'])
+                values = value if isinstance(value, list) else [value]
+                samples[(record.get('action'), metric['Name'])].extend(v for v in values if v is not None)
+    return samples
+
+
+def main():
+    samples = parse(sys.stdin)
+    print(f"{'action':<12} {'phase':<22} {'n':>5} {'p50':>10} {'p95':>10} {'max':>10}")
+    for (action, name), values in sorted(samples.items()):
+        print(f'{action:<12} {name:<22} {len(values):>5} {percentile(values, 0.5):>10.1f} '
+              f'{percentile(values, 0.95):>10.1f} {max(values):>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,589 @@
+"""ローカル実行用の AWS / Discord のフェイク
+
+時間は LocalScheduler などが持つ仮想時計(clock)で進み、実際には待機しない。
+sleep を渡すと API 呼び出し毎に latency の分だけ仮想時計を進め、failures で失敗を注入できる。
+"""
+import calendar
+import datetime
+import heapq
+import io
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FakeError(Exception):
+    pass
+
+
+class VirtualClock:
+    """time.time / time.sleep の代わりになる仮想時計
+
+    ワーカースレッドのタスクは executor を生成した時刻から各自の sleep の分だけ進み(executor() を使う)、
+    メインスレッドの時刻は全タスクの最大値になる(並列に待った時間は足し合わせない)。
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.fork_at = start
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self, start):
+        with self.lock:
+            self.now = self.fork_at = start
+            self.local = threading.local()
+
+    def branch(self, started):
+        """このスレッドで、started から始まる新しいタスクを実行する"""
+        self.local.now = started
+
+    def executor(self):
+        """ThreadPoolExecutor の代わり(スレッドが使い回されても、タスク毎に executor の生成時刻から数え直す)"""
+        clock = self
+
+        class VirtualExecutor(ThreadPoolExecutor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # 先に投入したタスクが進めた時刻から始めないよう、生成時点の時刻にそろえる
+                self.started = clock.time()
+
+            def submit(self, fn, *args, **kwargs):
+                def run():
+                    clock.branch(self.started)
+                    return fn(*args, **kwargs)
+
+                return super().submit(run)
+
+        return VirtualExecutor
+
+    def _is_main(self):
+        return threading.current_thread() is threading.main_thread()
+
+    def _worker_now(self):
+        if not hasattr(self.local, 'now'):
+            self.local.now = self.fork_at
+        return self.local.now
+
+    def time(self):
+        with self.lock:
+            if self._is_main():
+                self.fork_at = self.now
+                return self.now
+            return self._worker_now()
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0.0)
+        with self.lock:
+            if self._is_main():
+                self.now += seconds
+                self.fork_at = self.now
+            else:
+                self.local.now = self._worker_now() + seconds
+                self.now = max(self.now, self.local.now)
+
+
+class FakeExceptions:
+    """boto3 クライアントの .exceptions と同じ名前で例外クラスを引けるようにする"""
+
+    class InvocationDoesNotExist(FakeError):
+        pass
+
+    class InvalidInstanceId(FakeError):
+        pass
+
+    class ConditionalCheckFailedException(FakeError):
+        pass
+
+
+class Latency:
+    """API 呼び出し1回の遅延(秒)。p50 と p99 を指定した対数正規分布"""
+
+    def __init__(self, p50, p99=None):
+        self.mu = math.log(p50)
+        self.sigma = (math.log(p99) - self.mu) / 2.326 if p99 else 0.0
+
+    def sample(self, rng):
+        return rng.lognormvariate(self.mu, self.sigma)
+
+
+class FakeService:
+    """呼び出しの記録・遅延・失敗の注入を共通で行う
+
+    latency: Latency(全 API 共通)、または API 名 → Latency
+    failures: API 名 → 失敗させる回数(int)か失敗率(float)。(例外クラス, 回数か率) で例外も指定できる
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, clock=None, sleep=None, latency=None, failures=None, seed=0):
+        self.clock = clock
+        self.sleep = sleep
+        self.latency = latency
+        self.failures = dict(failures or {})
+        self.rng = random.Random(seed)
+        self.calls = []
+
+    def _call(self, name):
+        self.calls.append(name)
+        latency = self.latency.get(name) if isinstance(self.latency, dict) else self.latency
+        if latency is not None and self.sleep is not None:
+            self.sleep(latency.sample(self.rng))
+
+        failure = self.failures.get(name)
+        if failure is None:
+            return
+        error, rule = failure if isinstance(failure, tuple) else (FakeError, failure)
+        if isinstance(rule, float):
+            failed = self.rng.random() < rule
+        else:
+            failed = rule > 0
+            if failed:
+                self.failures[name] = (error, rule - 1)
+        if failed:
+            raise error(f'Injected failure: {name}')
+
+    def get_paginator(self, name):
+        """NextToken を辿って1ページ毎に API を呼ぶ(ページ毎に1回の呼び出しとして記録される)"""
+        service = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                while True:
+                    page = getattr(service, name)(**kwargs)
+                    yield page
+                    if not page.get('NextToken'):
+                        return
+                    kwargs = dict(kwargs, NextToken=page['NextToken'])
+
+        return Paginator()
+
+
+class FakeEC2(FakeService):
+    def __init__(self, clock, instance_ids=('i-00000000000000000',), boot_seconds=40, status_check_seconds=120,
+                 stop_seconds=30, reboot_seconds=30, state='stopped', hibernation=False, **service_kwargs):
+        super().__init__(clock, **service_kwargs)
+        self.hibernation = hibernation
+        self.boot_seconds = boot_seconds
+        self.reboot_seconds = reboot_seconds
+        self.status_check_seconds = status_check_seconds
+        self.stop_seconds = stop_seconds
+        self.instances = {
+            instance_id: {
+                'state': state,
+                'changed_at': clock(),
+                'launched_at': clock(),
+                'booted_at': clock(),  # OS の起動時刻(再起動中は未来)
+                'public_ip': f'192.0.2.{index + 10}',
+                'hibernated': False,
+                'impaired': False,
+                'instance_type': 't3.large',
+            }
+            for index, instance_id in enumerate(instance_ids)
+        }
+
+    def _state(self, instance):
+        elapsed = self.clock() - instance['changed_at']
+        if instance['state'] == 'pending' and elapsed >= self.boot_seconds:
+            instance['state'] = 'running'
+            instance['changed_at'] += self.boot_seconds
+        if instance['state'] == 'stopping' and elapsed >= self.stop_seconds:
+            instance['state'] = 'stopped'
+            instance['changed_at'] += self.stop_seconds
+        return instance['state']
+
+    def describe_instances(self, InstanceIds=None, **kwargs):
+        self._call('describe_instances')
+        instances = []
+        for instance_id in InstanceIds or list(self.instances):
+            instance = self.instances[instance_id]
+            state = self._state(instance)
+            description = {
+                'InstanceId': instance_id,
+                'State': {'Name': state},
+                'InstanceType': instance['instance_type'],
+                'LaunchTime': datetime.datetime.fromtimestamp(instance['launched_at'], datetime.timezone.utc),
+                'HibernationOptions': {'Configured': self.hibernation},
+            }
+            if state == 'stopped' and instance['hibernated']:
+                description['StateReason'] = {'Code': 'Client.UserInitiatedHibernate'}
+            if state in ('pending', 'running'):
+                description['PublicIpAddress'] = instance['public_ip']
+            instances.append(description)
+        return {'Reservations': [{'Instances': instances}]}
+
+    def describe_instance_status(self, InstanceIds=None, **kwargs):
+        self._call('describe_instance_status')
+        statuses = []
+        for instance_id in InstanceIds or list(self.instances):
+            instance = self.instances[instance_id]
+            if self._state(instance) != 'running':
+                continue
+            ok = self.clock() - instance['changed_at'] >= self.status_check_seconds
+            status = 'impaired' if instance['impaired'] else 'ok' if ok else 'initializing'
+            statuses.append({
+                'InstanceId': instance_id,
+                'InstanceStatus': {'Status': status},
+                'SystemStatus': {'Status': status},
+            })
+        return {'InstanceStatuses': statuses}
+
+    def start_instances(self, InstanceIds, **kwargs):
+        self._call('start_instances')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if self._state(instance) == 'stopped':
+                instance['state'] = 'pending'
+                instance['changed_at'] = instance['launched_at'] = self.clock()
+                instance['booted_at'] = self.clock() + self.boot_seconds
+        return {'StartingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+    def stop_instances(self, InstanceIds, Hibernate=False, **kwargs):
+        self._call('stop_instances')
+        if Hibernate and not self.hibernation:
+            raise FakeError('UnsupportedHibernationConfiguration')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            instance['state'] = 'stopping'
+            instance['changed_at'] = self.clock()
+            instance['hibernated'] = Hibernate
+        return {'StoppingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+    def modify_instance_attribute(self, InstanceId, InstanceType=None, **kwargs):
+        self._call('modify_instance_attribute')
+        instance = self.instances[InstanceId]
+        if InstanceType is not None:
+            if self._state(instance) != 'stopped' or instance['hibernated']:
+                raise FakeError('IncorrectInstanceState')
+            instance['instance_type'] = InstanceType['Value']
+        return {}
+
+    def reboot_instances(self, InstanceIds, **kwargs):
+        self._call('reboot_instances')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            instance['changed_at'] = self.clock()
+            instance['booted_at'] = self.clock() + self.reboot_seconds
+        return {}
+
+    def os_uptime(self, instance_id):
+        """OS の起動時間(秒)。停止中・再起動中は None"""
+        instance = self.instances[instance_id]
+        if self._state(instance) != 'running' or self.clock() < instance['booted_at']:
+            return None
+        return self.clock() - instance['booted_at']
+
+    def get_waiter(self, name):
+        raise FakeError('Waiters block; use polling steps with the local runner.')
+
+
+class FakeSSM(FakeService):
+    def __init__(self, clock, durations=None, outputs=None, online=None, **service_kwargs):
+        """
+        durations: コマンドに含まれる文字列 → 実行にかかる秒数
+        outputs: コマンドに含まれる文字列 → 標準出力(インスタンスIDを受け取って完了時に作る関数でもよい)
+        online: インスタンスID → エージェントが応答するか。応答しない間のコマンドは完了しない
+        """
+        super().__init__(clock, **service_kwargs)
+        self.durations = durations or {}
+        self.outputs = outputs or {}
+        self.online = online or (lambda instance_id: True)
+        self.commands = {}
+        self.ids = itertools.count(1)
+
+    def send_command(self, InstanceIds, DocumentName, Parameters, **kwargs):
+        self._call('send_command')
+        script = '\n'.join(Parameters['commands'])
+        command_id = f'command-{next(self.ids)}'
+        duration = next((seconds for key, seconds in self.durations.items() if key in script), 1)
+        stdout = next((output for key, output in self.outputs.items() if key in script), '')
+        self.commands[command_id] = {'done_at': self.clock() + duration, 'stdout': stdout,
+                                     'instance_ids': list(InstanceIds), 'script': script,
+                                     'invoked_at': self.clock(), 'comment': kwargs.get('Comment', '')}
+        return {'Command': {'CommandId': command_id}}
+
+    def list_commands(self, InstanceId, Filters=(), **kwargs):
+        self._call('list_commands')
+        invoked_after = float('-inf')
+        for item in Filters:
+            if item['key'] == 'InvokedAfter':
+                invoked_after = calendar.timegm(time.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ'))
+        return {'Commands': [
+            {'CommandId': command_id, 'Comment': command['comment']}
+            for command_id, command in self.commands.items()
+            if InstanceId in command['instance_ids'] and command['invoked_at'] >= invoked_after
+        ]}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        self._call('get_command_invocation')
+        command = self.commands[CommandId]
+        if self.clock() < command['done_at'] or not self.online(InstanceId):
+            return {'Status': 'InProgress'}
+        return {'Status': 'Success', 'StandardOutputContent': self._stdout(command, InstanceId),
+                'StandardErrorContent': '', 'ResponseCode': 0}
+
+    def list_command_invocations(self, CommandId, Details=False, MaxResults=50, NextToken=None, **kwargs):
+        self._call('list_command_invocations')
+        command = self.commands[CommandId]
+        start = int(NextToken or 0)
+        instance_ids = command['instance_ids'][start:start + MaxResults]
+        invocations = []
+        for instance_id in instance_ids:
+            done = self.clock() >= command['done_at'] and self.online(instance_id)
+            invocation = {'InstanceId': instance_id, 'Status': 'Success' if done else 'InProgress'}
+            if done and Details:
+                invocation['CommandPlugins'] = [{'Output': self._stdout(command, instance_id), 'ResponseCode': 0}]
+            invocations.append(invocation)
+        response = {'CommandInvocations': invocations}
+        if start + MaxResults < len(command['instance_ids']):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def _stdout(self, command, instance_id):
+        """標準出力(関数ならインスタンス毎に完了した時に1回だけ作る)"""
+        if not callable(command['stdout']):
+            return command['stdout']
+        outputs = command.setdefault('outputs', {})
+        if instance_id not in outputs:
+            outputs[instance_id] = command['stdout'](instance_id)
+        return outputs[instance_id]
+
+
+class FakeEvents(FakeService):
+    """監視イベントのルールの状態と発火時刻(5分毎の cron と、1回だけの cron)を持つ"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rule = {'state': 'DISABLED', 'expression': 'cron(*/5 * * * ? *)',
+                     'description': 'monitoring ec2 schedule event for lambda'}
+
+    def enable_rule(self, **kwargs):
+        self._call('enable_rule')
+        self.rule['state'] = 'ENABLED'
+
+    def disable_rule(self, **kwargs):
+        self._call('disable_rule')
+        self.rule['state'] = 'DISABLED'
+
+    def put_rule(self, Name, ScheduleExpression, State='ENABLED', **kwargs):
+        self._call('put_rule')
+        # 渡さなかったプロパティは消える
+        self.rule = {'state': State, 'expression': ScheduleExpression, 'description': kwargs.get('Description')}
+        return {'RuleArn': f'arn:aws:events:ap-northeast-1:000000000000:rule/{Name}'}
+
+    def describe_rule(self, Name, **kwargs):
+        self._call('describe_rule')
+        rule = {'Name': Name, 'Arn': f'arn:aws:events:ap-northeast-1:000000000000:rule/{Name}',
+                'ScheduleExpression': self.rule['expression'], 'State': self.rule['state'], 'EventBusName': 'default'}
+        if self.rule['description']:
+            rule['Description'] = self.rule['description']
+        return rule
+
+    def next_fire(self, after):
+        """after より後にルールが発火する時刻(発火しなければ None)"""
+        if self.rule['state'] != 'ENABLED':
+            return None
+        fields = self.rule['expression'][len('cron('):-1].split()
+        if fields[0].startswith('*/'):
+            period = int(fields[0][2:]) * 60
+            return (after // period + 1) * period
+        minute, hour, day, month, _, year = fields
+        at = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+                               tzinfo=datetime.timezone.utc).timestamp()
+        return at if at > after else None
+
+    def list_rules(self, **kwargs):
+        self._call('list_rules')
+        return {'Rules': [{'Name': 'monitoring'}]}
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body or {}
+
+    def json(self):
+        return self.body
+
+    def __repr__(self):
+        return f'<Response [{self.status_code}]>'
+
+
+class FakeSQS(FakeService):
+    """遅延メッセージを配信予定時刻の順に取り出せるキュー"""
+
+    def __init__(self, clock, **service_kwargs):
+        super().__init__(clock, **service_kwargs)
+        self.messages = []
+        self.sequence = itertools.count()
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self._call('send_message')
+        heapq.heappush(self.messages, (self.clock() + DelaySeconds, next(self.sequence), MessageBody))
+        return {'MessageId': f'message-{len(self.calls)}'}
+
+    def receive(self):
+        """次に配信されるメッセージ (配信時刻, 本文)。無ければ None"""
+        if not self.messages:
+            return None
+        due, _, body = heapq.heappop(self.messages)
+        return due, body
+
+
+class FakeS3(FakeService):
+    """オブジェクトをメモリに持つ S3(put/get/list_objects_v2 のページネーターだけ)
+
+    bandwidth(バイト/秒)を渡すと、転送量に応じて1リクエスト毎に sleep する。
+    """
+
+    def __init__(self, clock=None, bandwidth=None, **service_kwargs):
+        super().__init__(clock, **service_kwargs)
+        self.bandwidth = bandwidth
+        self.objects = {}
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def _transfer(self, size):
+        if self.bandwidth and self.sleep is not None:
+            self.sleep(size / self.bandwidth)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('put_object')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self._transfer(len(data))
+        with self._lock:
+            self.objects[(Bucket, Key)] = data
+            self.uploaded_bytes += len(data)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('get_object')
+        data = self.objects[(Bucket, Key)]
+        self._transfer(len(data))
+        with self._lock:
+            self.downloaded_bytes += len(data)
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._call('list_objects_v2')
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys]}
+
+
+class FakeLambdaContext:
+    """Lambda の context: 呼び出し時点から timeout 秒で終了する"""
+
+    def __init__(self, clock, function_name, timeout=600):
+        self.clock = clock
+        self.function_name = function_name
+        self.expires_at = clock() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.expires_at - self.clock()) * 1000)
+
+
+class FakeLambda(FakeService):
+    """非同期呼び出し(InvocationType=Event)のペイロードを記録する"""
+
+    def __init__(self, clock=None, **service_kwargs):
+        super().__init__(clock, **service_kwargs)
+        self.invocations = []
+
+    def invoke(self, FunctionName, Payload=None, **kwargs):
+        self._call('invoke')
+        self.invocations.append((FunctionName, json.loads(Payload or '{}')))
+        return {'StatusCode': 202}
+
+
+class FakeHttpSession(FakeService):
+    """Discord への投稿を記録するだけの requests.Session の代わり
+
+    rate_limited: 最初の n 回は 429(retry_after 秒)を返す
+    """
+
+    def __init__(self, clock=None, rate_limited=0, retry_after=0.5, **service_kwargs):
+        super().__init__(clock, **service_kwargs)
+        self.requests = []
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+
+    def request(self, method, url, **kwargs):
+        self._call(method)
+        self.requests.append((method, url, kwargs.get('json')))
+        if self.rate_limited > 0:
+            self.rate_limited -= 1
+            return FakeResponse(429, {'Retry-After': str(self.retry_after)},
+                                {'retry_after': self.retry_after, 'global': False})
+        return FakeResponse()
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+
+class FakePing:
+    """server_steps.ping の代わり: running になってから ready_seconds 後(休止からの復帰は resume_seconds 後)だけ応答する
+
+    players は人数か、時刻 → 人数の関数。
+
+    ssm を渡すと、停止スクリプトを送ってから起動スクリプトが終わって jvm_seconds 経つまでも応答しない
+    (OS を再起動しないマイクラだけの再起動)。
+    """
+
+    def __init__(self, clock, ec2, ready_seconds=60, resume_seconds=5, players=0, ssm=None, jvm_seconds=20):
+        self.clock = clock
+        self.ec2 = ec2
+        self.ready_seconds = ready_seconds
+        self.resume_seconds = resume_seconds
+        self.players = players
+        self.ssm = ssm
+        self.jvm_seconds = jvm_seconds
+        self.calls = 0
+
+    def __call__(self, host, port=None, timeout=3.0):
+        self.calls += 1
+        for instance_id, instance in self.ec2.instances.items():
+            if instance['public_ip'] == host and instance['state'] == 'running':
+                ready_seconds = self.resume_seconds if instance['hibernated'] else self.ready_seconds
+                if self.clock() - instance['changed_at'] >= ready_seconds and self._jvm_running(instance_id):
+                    players = self.players(self.clock()) if callable(self.players) else self.players
+                    return {'players': {'online': players, 'max': 20}, 'latency': 0.01}
+        raise ConnectionRefusedError(host)
+
+    def _jvm_running(self, instance_id):
+        if self.ssm is None:
+            return True
+        running = True
+        for command in self.ssm.commands.values():
+            if instance_id not in command['instance_ids']:
+                continue
+            if 'Minecraft_restart.sh' in command['script'] or 'Minecraft_stop.sh' in command['script']:
+                running = False
+            elif 'Minecraft_start.sh' in command['script']:
+                running = self.clock() >= command['done_at'] + self.jvm_seconds
+        return running
+
+
+class FakeRcon:
+    """RconClient の代わり: 受け取ったコマンドを記録するだけ"""
+    commands = []
+
+    def __init__(self, host, *args, **kwargs):
+        self.host = host
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def command(self, command):
+        self.commands.append((self.host, command))
+        return ''
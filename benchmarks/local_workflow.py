@@ -0,0 +1,105 @@
+"""start/stop/restart のワークフローを、フェイクと仮想時計でローカル実行する
+
+    python benchmarks/local_workflow.py [start|stop|restart ...] [--inline-limit 秒] [--hibernate]
+                                        [--timeout 秒] [--no-queue] [--restart-mode process|os|auto]
+
+Lambda の呼び出し回数(初回 + 再スケジュール)と、仮想時間での所要時間を表示する。
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+sys.path.insert(0, os.path.join(SRC, 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('EC2_INSTANCE_ID', 'i-00000000000000000')
+
+import clients  # noqa: E402
+import hibernation  # noqa: E402
+import server_steps  # noqa: E402
+import startup_log  # noqa: E402
+from fakes import FakeEC2, FakeEvents, FakeHttpSession, FakePing, FakeRcon, FakeSSM  # noqa: E402
+from orchestration import LocalScheduler  # noqa: E402
+
+FUNCTIONS = {
+    'start': ('start_ec2', 'stopped'),
+    'stop': ('stop_ec2', 'running'),
+    'restart': ('restart_ec2', 'running'),
+}
+
+STOP_OUTPUT = 'PHASE stop_script 200\nPHASE saving 1500\nPHASE exited 9000\n'
+# Paper の latest.log(起動の節目だけ)
+STARTUP_LOG = [
+    '[09:00:00 INFO]: Environment: Environment[sessionHost=https://sessionserver.mojang.com]',
+    '[09:00:04 INFO]: Starting minecraft server version 1.20.4',
+    '[09:00:06 INFO]: [LuckPerms] Enabling LuckPerms v5.4.102',
+    '[09:00:07 INFO]: Preparing level "world"',
+    '[09:00:09 INFO]: Preparing start region for dimension minecraft:overworld',
+    '[09:00:10 INFO]: Preparing spawn area: 42%',
+    '[09:00:12 INFO]: [EssentialsX] Enabling Essentials v2.20.1',
+    '[09:00:13 INFO]: [Dynmap] Enabling dynmap v3.7',
+    '[09:00:18 INFO]: Done (13.871s)! For help, type "help"',
+]
+STARTUP_OUTPUT = startup_log.SUMMARY_MARKER + json.dumps(startup_log.parse(STARTUP_LOG))
+
+
+def load_app(function):
+    spec = importlib.util.spec_from_file_location(f'{function}_app', os.path.join(SRC, function, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_fakes(runner, initial_state, hibernate=False):
+    ec2 = FakeEC2(runner.clock, state=initial_state, hibernation=hibernate)
+    if initial_state == 'running':
+        # 起動してしばらく経ったサーバー
+        for instance in ec2.instances.values():
+            instance['changed_at'] = instance['launched_at'] = runner.clock() - 3600
+    if hibernate:
+        # 休止した状態から起動する
+        for instance in ec2.instances.values():
+            instance['hibernated'] = initial_state == 'stopped'
+        hibernation.HIBERNATE = True
+        hibernation.RCON_PASSWORD = 'local'
+        hibernation.RconClient = FakeRcon
+    ssm = FakeSSM(runner.clock, durations={'Minecraft_start.sh': 3, 'PHASE': 10},
+                  outputs={'PHASE': STOP_OUTPUT, 'startup_log': STARTUP_OUTPUT})
+    events = FakeEvents()
+    clients.reset()
+    clients._clients.update({'ec2': ec2, 'ssm': ssm, 'events': events})
+    clients._http_session = FakeHttpSession()
+    server_steps.ping = FakePing(runner.clock, ec2, ssm=ssm)
+    return ec2, ssm, events
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workflows', nargs='*', default=list(FUNCTIONS))
+    parser.add_argument('--inline-limit', type=float, default=1.0)
+    parser.add_argument('--ignore-maintenance', action='store_true', help='メンテナンス時間帯でも起動する')
+    parser.add_argument('--hibernate', action='store_true', help='休止で停止し、休止から起動する')
+    parser.add_argument('--timeout', type=float, help='Lambda のタイムアウト(秒)')
+    parser.add_argument('--no-queue', action='store_true', help='キューを使わず Lambda 内で待機する')
+    parser.add_argument('--restart-mode', help='restart の方法(省略時は RESTART_MODE)')
+    args = parser.parse_args()
+
+    for name in args.workflows:
+        function, initial_state = FUNCTIONS[name]
+        app = load_app(function)
+        if args.ignore_maintenance and hasattr(app, 'MAINTENANCE_START_TIME'):
+            app.MAINTENANCE_START_TIME = app.MAINTENANCE_END_TIME
+        runner = LocalScheduler(inline_limit=args.inline_limit, timeout=args.timeout, queue=not args.no_queue)
+        ec2, ssm, events = install_fakes(runner, initial_state, args.hibernate)
+
+        elapsed = runner.run(app.WORKFLOW, {'mode': args.restart_mode} if name == 'restart' else {})
+        api_calls = len(ec2.calls) + len(ssm.calls) + len(events.calls)
+        print(f'{name}: {elapsed:.0f} s simulated, {runner.invocations} invocations, {api_calls} API calls, '
+              f'result: {clients._http_session.requests[-1][2]["embeds"][0]["title"]}')
+
+
+if __name__ == '__main__':
+    main()
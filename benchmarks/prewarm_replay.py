@@ -0,0 +1,117 @@
+"""記録したログイン人数の履歴を再生して、事前起動と自動停止の方針を比べる
+
+    python benchmarks/prewarm_replay.py [stats.bin] [--weeks 4] [--seed 1]
+
+stats.bin は S3 の stats/<インスタンスID>.bin。省略すると平日夜と週末昼に遊ぶグループの履歴を生成する。
+履歴の最後の --weeks 週を5分刻みで再生し、それ以前の履歴だけで学習しながら
+- 従来: 誰かが来てから起動し、起動から30分経って無人なら停止
+- 予測: 遊ぶ時間帯の前に起動し、無人なら時間帯に応じた起動時間で停止
+の待ち時間と稼働時間を表示する。
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
+
+from play_schedule import (IDLE_MAX_MINUTES, TOKYO_OFFSET, build_profile, idle_limit_minutes, is_maintenance,  # noqa: E402
+                           should_prewarm)
+from player_stats import DAY, SAMPLE_INTERVAL, WEEK, PlayerSeries  # noqa: E402
+
+STARTUP_SECONDS = 180  # 起動にかかる秒数(「３分ぐらい待ってね」)
+
+
+def generate_history(weeks, seed, now=1_760_000_000):
+    """平日は 20～23 時、週末は 13～18 時に遊ぶことが多いグループの履歴(遊んでいない間は0人)"""
+    rng = random.Random(seed)
+    series = PlayerSeries()
+    start = now - weeks * WEEK
+    start -= (start + TOKYO_OFFSET) % DAY  # JST の0時から
+
+    sessions = []
+    for day in range(weeks * 7):
+        midnight = start + day * DAY
+        weekend = (day + 3) % 7 in (5, 6)  # 1970-01-01 は木曜
+        if weekend and rng.random() < 0.7:
+            sessions.append((midnight + 13 * 3600 + rng.randint(-2, 2) * 600, rng.randint(2, 5) * 3600))
+        if not weekend and rng.random() < 0.8:
+            sessions.append((midnight + 20 * 3600 + rng.randint(-1, 2) * 600, rng.randint(4, 12) * 900))
+        if rng.random() < 0.1:
+            sessions.append((midnight + rng.randint(7, 23) * 3600, rng.randint(1, 4) * 900))
+
+    for t in range(start, now, SAMPLE_INTERVAL):
+        playing = any(begin <= t < begin + length for begin, length in sessions)
+        series.append(t, rng.randint(1, 6) if playing else 0)
+    return series
+
+
+def simulate(series, start, end, predictive):
+    running = False
+    launched_at = ready_at = 0
+    wait = 0
+    arrivals = 0
+    running_seconds = 0
+    profile = None
+    profile_day = None
+
+    i, j = series.window(start, end)
+    previous = series.players[i - 1] if i else 0
+    for index in range(i, j):
+        t = series.times[index]
+        players = series.players[index]
+
+        if predictive and profile_day != t // DAY:
+            # 学習は1日1回、その時点までの履歴だけで行う
+            profile = build_profile(series, t)
+            profile_day = t // DAY
+
+        if is_maintenance(t):
+            running = False
+        elif players and not previous:
+            arrivals += 1
+            if not running:
+                running, launched_at, ready_at = True, t, t + STARTUP_SECONDS
+            wait += max(0, ready_at - t)
+        elif predictive and not running and should_prewarm(profile, t):
+            running, launched_at, ready_at = True, t, t + STARTUP_SECONDS
+
+        if running and not players:
+            limit = idle_limit_minutes(profile, t) if predictive else IDLE_MAX_MINUTES
+            if (t - launched_at) / 60 > limit:
+                running = False
+
+        if running:
+            running_seconds += SAMPLE_INTERVAL
+        previous = players
+
+    return {'arrivals': arrivals, 'wait_minutes': wait / 60, 'hours': running_seconds / 3600}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--weeks', type=int, default=4, help='再生する週数(それ以前は学習用)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            series = PlayerSeries.from_bytes(f.read())
+    else:
+        series = generate_history(12, args.seed)
+
+    end = series.times[-1] + 1
+    start = end - args.weeks * WEEK
+    baseline = simulate(series, start, end, predictive=False)
+    predictive = simulate(series, start, end, predictive=True)
+
+    for name, result in (('baseline', baseline), ('predictive', predictive)):
+        print(f"{name:>10}: {result['arrivals']} arrivals, waited {result['wait_minutes']:.0f} min, "
+              f"{result['hours']:.1f} instance-hours")
+    print(f"wait saved: {baseline['wait_minutes'] - predictive['wait_minutes']:.0f} min, "
+          f"extra instance-hours: {predictive['hours'] - baseline['hours']:+.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""EC2 の状態変更イベントをローカルで再生し、状態キャッシュと /status の応答を確認する
+
+    python benchmarks/replay_state_events.py [events.jsonl]
+
+ファイルを省略すると、起動 → 停止の途中で古いイベントが遅れて届く例を再生する。
+各イベント後のキャッシュの内容と、/status が describe_instances を呼んだ回数を表示する。
+"""
+import datetime
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+sys.path.insert(0, os.path.join(SRC, 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('EC2_INSTANCE_ID', 'i-00000000000000000')
+os.environ.setdefault('APPLICATION_PUBLIC_KEY', '00' * 32)
+
+import clients  # noqa: E402
+from fakes import FakeEC2  # noqa: E402
+from local_workflow import load_app  # noqa: E402
+
+INSTANCE_ID = os.environ['EC2_INSTANCE_ID']
+
+
+def state_change_event(instance_id, state, at):
+    return {
+        'source': 'aws.ec2',
+        'detail-type': 'EC2 Instance State-change Notification',
+        'time': at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'detail': {'instance-id': instance_id, 'state': state},
+    }
+
+
+def default_events():
+    started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=50)
+    minute = datetime.timedelta(minutes=1)
+    return [
+        state_change_event(INSTANCE_ID, 'pending', started),
+        state_change_event(INSTANCE_ID, 'running', started + minute),
+        state_change_event(INSTANCE_ID, 'stopping', started + 40 * minute),
+        state_change_event(INSTANCE_ID, 'running', started + 2 * minute),  # 遅れて届いた古いイベント
+        state_change_event(INSTANCE_ID, 'stopped', started + 41 * minute),
+    ]
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = default_events()
+
+    ec2 = FakeEC2(lambda: 0, instance_ids=[INSTANCE_ID], state='running')
+    clients.reset()
+    clients._clients['ec2'] = ec2
+
+    state_change = load_app('state_change_ec2')
+    callback = load_app('slash_commands_callback')
+
+    for event in events:
+        state_change.lambda_handler(event, None)
+        calls = len(ec2.calls)
+        print(callback.describe_status(list(callback.SERVERS)))
+        print(f'-> /status used {len(ec2.calls) - calls} describe_instances calls\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""ログイン人数の履歴を再生して、インスタンスタイプの選び方毎の料金とラグの時間を比べる
+
+    python benchmarks/right_sizing_replay.py [stats.bin] [--ladder t3.medium:4:0.0544,...] [--weeks 4]
+                                             [--capacity-factor 0.8] [--seed 1]
+
+stats.bin は S3 の stats/<インスタンスID>.bin。省略すると平日夜は少人数、週末は大人数、時々イベントで
+さらに集まるグループの履歴を生成する。履歴の最後の --weeks 週のセッション(誰かが遊んでいる間 + 無人で停止するまで)毎に
+- fixed: 常に同じタイプ(ラダーの各タイプ)
+- right-size: 起動時に right_sizing で選んだタイプ。ラグがあれば監視と同じように記録する
+で起動したとして、料金とラグの時間(人数が実際の収容人数を超えていた5分刻みの時間)を表示する。
+実際の収容人数はラダーの人数 × --capacity-factor とする(ラダーの見積もりが甘い場合を試す)。
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
+
+from play_schedule import IDLE_MAX_MINUTES, TOKYO_OFFSET  # noqa: E402
+from player_stats import DAY, SAMPLE_INTERVAL, WEEK, PlayerSeries  # noqa: E402
+from right_sizing import MemorySizingStore, choose_rung, expected_peak, parse_ladder, record_starved  # noqa: E402
+
+DEFAULT_LADDER = 't3.medium:4:0.0544,t3.large:8:0.1088,m6i.xlarge:16:0.248,m6i.2xlarge:32:0.496'
+INSTANCE_ID = 'i-replay'
+
+
+def generate_history(weeks, seed, now=1_760_000_000):
+    """平日夜は2～4人、週末昼は5～12人、月に1回ほどイベントで15～25人集まるグループの履歴"""
+    rng = random.Random(seed)
+    series = PlayerSeries()
+    start = now - weeks * WEEK
+    start -= (start + TOKYO_OFFSET) % DAY  # JST の0時から
+
+    sessions = []  # (開始, 長さ, ピーク人数)
+    for day in range(weeks * 7):
+        midnight = start + day * DAY
+        weekend = (day + 3) % 7 in (5, 6)  # 1970-01-01 は木曜
+        if weekend and rng.random() < 0.7:
+            peak = rng.randint(15, 25) if rng.random() < 0.12 else rng.randint(5, 12)
+            sessions.append((midnight + 13 * 3600 + rng.randint(-2, 2) * 600, rng.randint(2, 5) * 3600, peak))
+        if not weekend and rng.random() < 0.8:
+            sessions.append((midnight + 20 * 3600 + rng.randint(-1, 2) * 600, rng.randint(4, 12) * 900,
+                             rng.randint(2, 4)))
+
+    for t in range(start, now, SAMPLE_INTERVAL):
+        players = 0
+        for begin, length, peak in sessions:
+            if begin <= t < begin + length:
+                # 始まりと終わりは少なく、真ん中でピークになる
+                position = (t - begin) / length
+                players = max(1, round(peak * min(1.0, 3 * min(position, 1 - position) + rng.uniform(0, 0.3))))
+        series.append(t, players)
+    return series
+
+
+def find_sessions(series, start, end):
+    """(開始のインデックス, 終了のインデックス) のリスト。無人になってから IDLE_MAX_MINUTES 分で停止する"""
+    idle_samples = IDLE_MAX_MINUTES * 60 // SAMPLE_INTERVAL
+    sessions = []
+    i, j = series.window(start, end)
+    index = i
+    while index < j:
+        if not series.players[index]:
+            index += 1
+            continue
+        begin = index
+        idle = 0
+        while index < j and idle < idle_samples:
+            idle = 0 if series.players[index] else idle + 1
+            index += 1
+        sessions.append((begin, index))
+    return sessions
+
+
+def replay(series, sessions, ladder, factor, choose):
+    cost = 0.0
+    lag_minutes = 0
+    resizes = 0
+    store = MemorySizingStore()
+    current = None
+    for begin, end in sessions:
+        rung = choose(series.times[begin], store) or current or ladder[0]
+        resizes += current is not None and rung is not current
+        current = rung
+        for index in range(begin, end):
+            cost += rung.hourly_cost * SAMPLE_INTERVAL / 3600
+            players = series.players[index]
+            if players > rung.players * factor:
+                lag_minutes += SAMPLE_INTERVAL / 60
+                # 監視が TPS の低下を見つけて記録する
+                record_starved(INSTANCE_ID, rung.instance_type, players, store=store, now=series.times[index])
+    return {'cost': cost, 'lag_minutes': lag_minutes, 'resizes': resizes}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--ladder', default=DEFAULT_LADDER, help='タイプ:人数:1時間あたりの料金 のカンマ区切り')
+    parser.add_argument('--weeks', type=int, default=4, help='再生する週数(それ以前は学習用)')
+    parser.add_argument('--capacity-factor', type=float, default=0.8, help='実際の収容人数 / ラダーの人数')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            series = PlayerSeries.from_bytes(f.read())
+    else:
+        series = generate_history(12, args.seed)
+    ladder = parse_ladder(args.ladder)
+
+    end = series.times[-1] + 1
+    sessions = find_sessions(series, end - args.weeks * WEEK, end)
+    hours = sum(end_index - begin for begin, end_index in sessions) * SAMPLE_INTERVAL / 3600
+    print(f'{len(sessions)} sessions, {hours:.0f} instance-hours over {args.weeks} weeks')
+
+    def right_size(now, store):
+        players = expected_peak(series, now)
+        if players is None:
+            return None
+        return choose_rung(ladder, players, store.load(INSTANCE_ID), now)
+
+    policies = [(f'fixed {rung.instance_type}', lambda now, store, rung=rung: rung) for rung in ladder]
+    policies.append(('right-size', right_size))
+    for name, choose in policies:
+        result = replay(series, sessions, ladder, args.capacity_factor, choose)
+        print(f"{name:>20}: ${result['cost']:7.2f}, {result['lag_minutes']:5.0f} lag minutes, "
+              f"{result['resizes']:3} resizes")
+
+
+if __name__ == '__main__':
+    main()
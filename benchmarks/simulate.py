@@ -0,0 +1,379 @@
+"""各関数の lambda_handler を、フェイクと仮想時計で端から端まで実行する
+
+    python benchmarks/simulate.py [シナリオ ...] [--check] [--update-baseline] [-v]
+    python benchmarks/simulate.py --load 2000
+
+time.sleep / time.time / time.monotonic / time.perf_counter を仮想時計に差し替えてから src を読み込むので、
+数分かかる起動も一瞬で終わる。EC2・SSM・EventBridge・SQS・Lambda の呼び出し・Discord はフェイクで、
+シナリオ毎に API の遅延(分布)や失敗・429 を注入する。SQS の遅延メッセージは配信時刻に
+lambda_handler を呼び直すので、オーケストレーションも本番と同じ経路を通る。
+
+シナリオ毎に仮想時間での所要時間・Lambda の呼び出し回数・API 呼び出し回数・課金対象の実行時間
+(呼び出し毎の実行時間の合計)を表示する。--check は benchmarks/baseline.json と比べて悪化していれば
+終了コード1で終わり、--update-baseline で今回の結果を基準にする。
+--load は署名付きのインタラクションを callback に送り、署名検証とルーティングにかかる実時間の p50/p99 を測る。
+"""
+import concurrent.futures  # noqa: F401 仮想時計に差し替える前に読み込んでおく(内部で時刻を使う)
+import queue  # noqa: F401
+import threading  # noqa: F401
+import time
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src', 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import (FakeEC2, FakeEvents, FakeExceptions, FakeHttpSession, FakeLambda, FakeLambdaContext,  # noqa: E402
+                   FakePing, FakeRcon, FakeSQS, FakeSSM, Latency, VirtualClock)
+
+REAL_TIME = time.time
+REAL_PERF_COUNTER = time.perf_counter
+
+CLOCK = VirtualClock(REAL_TIME())
+time.time = time.monotonic = time.perf_counter = CLOCK.time
+time.sleep = CLOCK.sleep
+
+SERVERS = {'survival': 'i-00000000000000001', 'creative': 'i-00000000000000002', 'event': 'i-00000000000000003'}
+os.environ['SERVERS'] = json.dumps(SERVERS)
+os.environ.setdefault('APPLICATION_ID', 'application')
+os.environ.setdefault('START_EC2_LAMBDA_FUNCTION', 'StartEC2Function')
+os.environ.setdefault('STOP_EC2_LAMBDA_FUNCTION', 'StopEC2Function')
+os.environ.setdefault('RESTART_EC2_LAMBDA_FUNCTION', 'RestartEC2Function')
+os.environ.setdefault('BACKUP_EC2_LAMBDA_FUNCTION', 'BackupEC2Function')
+
+from nacl.signing import SigningKey  # noqa: E402
+
+SIGNING_KEY = SigningKey(bytes(range(32)))
+os.environ['APPLICATION_PUBLIC_KEY'] = SIGNING_KEY.verify_key.encode().hex()
+
+import clients  # noqa: E402
+import discord_message  # noqa: E402
+import fleet  # noqa: E402
+import hibernation  # noqa: E402
+import metrics  # noqa: E402
+import monitor_schedule  # noqa: E402
+import operation_lock  # noqa: E402
+import orchestration  # noqa: E402
+import player_probe  # noqa: E402
+import player_stats  # noqa: E402
+import right_sizing  # noqa: E402
+import server_steps  # noqa: E402
+import startup_profile  # noqa: E402
+import state_cache  # noqa: E402
+import world_backup  # noqa: E402
+from local_workflow import STARTUP_OUTPUT, STOP_OUTPUT, load_app  # noqa: E402
+
+fleet.ThreadPoolExecutor = CLOCK.executor()
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TOLERANCE = 0.1  # 基準からこの割合を超えて悪化したら回帰とみなす
+BACKUP_SUMMARY = {'manifest': 'i-00000000000000001/manifests/20250101T000000Z.json.gz', 'files': 300,
+                  'bytes': 4096 * 1024 * 1024, 'read_bytes': 400 * 1024 * 1024, 'uploaded_chunks': 60,
+                  'uploaded_bytes': 60 * 1024 * 1024, 'seconds': 25.0}
+LADDER = 't3.medium:4:0.0544,t3.large:8:0.1088,m6i.xlarge:16:0.248'
+MONITOR_EVENT = {'resources': ['arn:aws:events:ap-northeast-1:000000000000:rule/monitoring']}
+SESSION_SECONDS = 4 * 3600
+
+
+def session_players(elapsed):
+    """起動から8分後に5人集まり、80分で3人抜け、残りの2人も100分で一緒に抜ける"""
+    if elapsed < 8 * 60:
+        return 0
+    if elapsed < 80 * 60:
+        return 5
+    return 2 if elapsed < 100 * 60 else 0
+
+
+FIRST = next(iter(SERVERS))
+
+SCENARIOS = {
+    'start': dict(function='start_ec2', state='stopped'),
+    'start_hibernated': dict(function='start_ec2', state='stopped', hibernate=True),
+    'start_slow_api': dict(function='start_ec2', state='stopped', latency=Latency(0.2, 1.5)),
+    'start_resize': dict(function='start_ec2', state='stopped', ladder=LADDER, peak_players=12),
+    'start_flaky': dict(function='start_ec2', state='stopped', rate_limited=2,
+                        failures={'send_command': (FakeExceptions.InvalidInstanceId, 3)}),
+    'stop': dict(function='stop_ec2', state='running'),
+    'stop_hibernate': dict(function='stop_ec2', state='running', hibernate=True),
+    'stop_backup': dict(function='stop_ec2', state='running', backup=True),
+    'restart': dict(function='restart_ec2', state='running', uptime=3600, event={'mode': 'os'}),
+    'restart_process': dict(function='restart_ec2', state='running', uptime=3600, event={'mode': 'process'}),
+    'restart_auto_impaired': dict(function='restart_ec2', state='running', uptime=3600, impaired=True),
+    'backup': dict(function='backup_ec2', state='running', uptime=3600, backup=True),
+    'monitor_idle': dict(function='monitoring_ec2', state='running', uptime=45 * 60, event=MONITOR_EVENT),
+    'monitor_locked': dict(function='monitoring_ec2', state='running', uptime=45 * 60, event=MONITOR_EVENT,
+                           locked='restart'),
+    'monitor_ssh_user': dict(function='monitoring_ec2', state='running', uptime=45 * 60, event=MONITOR_EVENT,
+                             ec2_users=1),
+    'monitor_busy': dict(function='monitoring_ec2', state='running', uptime=45 * 60, players=3, event=MONITOR_EVENT),
+    'monitor_fleet': dict(function='monitoring_ec2', state='running', servers=3, uptime=45 * 60, event=MONITOR_EVENT,
+                          latency=Latency(0.05, 0.3)),
+    'monitor_session': dict(function='monitoring_ec2', state='running', players=session_players,
+                            session=SESSION_SECONDS, cadence='fixed'),
+    'monitor_session_adaptive': dict(function='monitoring_ec2', state='running', players=session_players,
+                                     session=SESSION_SECONDS),
+    'monitor_unused': dict(function='monitoring_ec2', state='running', session=SESSION_SECONDS, cadence='fixed'),
+    'monitor_unused_adaptive': dict(function='monitoring_ec2', state='running', session=SESSION_SECONDS),
+    'callback_start': dict(function='slash_commands_callback', state='stopped', command='start'),
+    'callback_status': dict(function='slash_commands_callback', state='running', command='status', server='all'),
+}
+
+
+def install(scenario):
+    """フェイクを差し込み、モジュールに残った状態(キャッシュ・ロック・キュー)を初期化する"""
+    if scenario.get('session'):
+        # 5分毎の cron との位相が毎回同じになるように、5分の境目から2分後に始める
+        CLOCK.reset(REAL_TIME() // 300 * 300 + 120)
+    else:
+        CLOCK.reset(REAL_TIME())
+    service = {'sleep': CLOCK.sleep, 'latency': scenario.get('latency'), 'failures': scenario.get('failures')}
+    hibernate = scenario.get('hibernate', False)
+
+    ec2 = FakeEC2(CLOCK.time, instance_ids=list(SERVERS.values()), hibernation=hibernate, **service)
+    for name in list(SERVERS)[:scenario.get('servers', 1)]:
+        instance = ec2.instances[SERVERS[name]]
+        instance['state'] = scenario['state']
+        started = CLOCK.time() - scenario.get('uptime', 0)
+        instance['launched_at'] = instance['changed_at'] = instance['booted_at'] = started
+        instance['hibernated'] = hibernate and scenario['state'] == 'stopped'
+        instance['impaired'] = scenario.get('impaired', False)
+    fakes = {
+        'ec2': ec2,
+        'ssm': FakeSSM(CLOCK.time, durations={'Minecraft_start.sh': 3, 'PHASE': 10, 'world_backup': 25},
+                       outputs={'PHASE': STOP_OUTPUT, 'world_backup': 'BACKUP ' + json.dumps(BACKUP_SUMMARY),
+                                'startup_log': STARTUP_OUTPUT,
+                                '/proc/uptime': lambda instance_id: f'{ec2.os_uptime(instance_id):.2f} 0.00'},
+                       online=lambda instance_id: ec2.os_uptime(instance_id) is not None, **service),
+        'events': FakeEvents(CLOCK.time, **service),
+        'sqs': FakeSQS(CLOCK.time, **service),
+        'lambda': FakeLambda(CLOCK.time, **service),
+    }
+    http = FakeHttpSession(CLOCK.time, rate_limited=scenario.get('rate_limited', 0), **service)
+
+    clients.reset()
+    clients._clients.update(fakes)
+    clients._http_session = http
+    orchestration.ORCHESTRATION_QUEUE_URL = 'https://sqs.local/orchestration'
+    state_cache._store = None
+    state_cache._recorded.clear()
+    player_stats._store = None
+    startup_profile._store = None
+    right_sizing._store = None
+    monitor_schedule._rule_properties.clear()
+    operation_lock._store = None
+    discord_message._limiter = discord_message.RateLimiter()
+    discord_message._queue.clear()
+
+    players = scenario.get('players', 0)
+    if callable(players):
+        players = lambda now, started=CLOCK.time(), timeline=players: timeline(now - started)  # noqa: E731
+    ping = FakePing(CLOCK.time, ec2, players=players, ssm=fakes['ssm'])
+    server_steps.ping = player_probe.ping = ping
+    fakes['ssm'].outputs['Zabbigot'] = lambda instance_id: probe_output(ec2, ping, instance_id,
+                                                                        scenario.get('ec2_users', 0))
+    player_probe.launch_uptime_minutes = lambda instance, now=None: int(
+        (CLOCK.time() - instance['LaunchTime'].timestamp()) / 60)
+    hibernation.HIBERNATE = hibernate
+    hibernation.RCON_PASSWORD = 'local' if hibernate else ''
+    hibernation.RconClient = FakeRcon
+    # 関数の app は読み込む時に設定を取り込むので、load_app より前に差し替える
+    backup_bucket = 'local-backups' if scenario.get('backup') else None
+    world_backup.BACKUP_BUCKET = server_steps.BACKUP_BUCKET = backup_bucket
+    world_backup.BACKUP_ON_STOP = bool(backup_bucket)
+    right_sizing.INSTANCE_LADDER = scenario.get('ladder', '')
+    monitor_schedule.MONITOR_CADENCE = scenario.get('cadence', 'adaptive')
+    if scenario.get('session'):
+        # 起動した直後に start_ec2 が監視を有効にした状態から始める
+        monitor_schedule.schedule_monitoring('monitoring')
+    if scenario.get('locked'):
+        # 手動の操作(再起動など)が実行中
+        operation_lock.acquire_operation(SERVERS[FIRST], scenario['locked'], now=CLOCK.time())
+    if scenario.get('peak_players'):
+        # 先週の同じ時間帯に遊んだ人数
+        player_stats.record_sample(SERVERS[FIRST], scenario['peak_players'],
+                                   now=CLOCK.time() - player_stats.WEEK + 3600)
+    return fakes, http
+
+
+def probe_output(ec2, ping, instance_id, users=0):
+    """監視の SSM プローブ(uptime -s, who -q, Zabbigot, メモリ)の出力"""
+    # parse_ssm_output は実時間の現在時刻と比べるので、起動時刻も実時間で表す
+    booted = datetime.datetime.now() - datetime.timedelta(seconds=ec2.os_uptime(instance_id) or 0)
+    players = ping.players(CLOCK.time()) if callable(ping.players) else ping.players
+    return (f"{booted:%Y-%m-%d %H:%M:%S}\n{' '.join(['ec2-user'] * users)}\n# users={users}\n"
+            f"{json.dumps({'user': players})}\n"
+            f"# memory=0 0\n")
+
+
+def interaction_event(command, server=None, timestamp=None):
+    options = [{'name': 'action', 'value': command}]
+    if server:
+        options.append({'name': 'server', 'value': server})
+    body = json.dumps({
+        'type': 2,
+        'application_id': os.environ['APPLICATION_ID'],
+        'token': 'interaction-token',
+        'member': {'user': {'username': 'simulator'}},
+        'data': {'name': 'minecraft', 'options': options},
+    })
+    timestamp = str(int(timestamp or REAL_TIME()))
+    signature = SIGNING_KEY.sign(f'{timestamp}{body}'.encode()).signature.hex()
+    return {'headers': {'X-Signature-Ed25519': signature, 'X-Signature-Timestamp': timestamp}, 'body': body}
+
+
+def invoke(app, function, event, durations):
+    context = FakeLambdaContext(CLOCK.time, function)
+    started = CLOCK.time()
+    result = app.lambda_handler(event, context)
+    durations.append(CLOCK.time() - started)
+    return result
+
+
+def run_session(app, scenario, events, durations):
+    """監視イベントのルールが発火する度に監視を呼び出す(ルールが無効になるか session 秒経つまで)"""
+    end = CLOCK.time() + scenario['session']
+    result = None
+    while (at := events.next_fire(CLOCK.time())) is not None and at < end:
+        CLOCK.sleep(at - CLOCK.time())
+        result = invoke(app, scenario['function'], MONITOR_EVENT, durations)
+    return result
+
+
+def run_scenario(name, scenario):
+    fakes, http = install(scenario)
+    app = load_app(scenario['function'])
+    if hasattr(app, 'MAINTENANCE_START_TIME'):
+        # 実行した時刻によらず同じ結果にする
+        app.MAINTENANCE_START_TIME = app.MAINTENANCE_END_TIME
+
+    if 'command' in scenario:
+        event = interaction_event(scenario['command'], scenario.get('server'))
+    else:
+        event = scenario.get('event', {})
+
+    started = CLOCK.time()
+    durations = []
+    if scenario.get('session'):
+        result = run_session(app, scenario, fakes['events'], durations)
+    else:
+        result = invoke(app, scenario['function'], event, durations)
+
+    # SQS の遅延メッセージを配信時刻の順に処理する
+    while (message := fakes['sqs'].receive()) is not None:
+        due, body = message
+        CLOCK.sleep(due - CLOCK.time())
+        invoke(app, scenario['function'], {'Records': [{'body': body}]}, durations)
+
+    if http.requests:
+        outcome = ' / '.join(embed['title'] for embed in http.requests[-1][2]['embeds'])
+    elif isinstance(result, dict) and 'data' in result:
+        outcome = result['data']['embeds'][0]['title']
+    elif isinstance(result, dict):
+        outcome = f"response type {result.get('type')}, {len(fakes['lambda'].invocations)} workers invoked"
+    else:
+        outcome = '(no message)'
+
+    return {
+        'simulated_seconds': round(CLOCK.time() - started, 1),
+        'invocations': len(durations),
+        'api_calls': sum(len(fake.calls) for fake in fakes.values()) + len(http.calls),
+        'billed_seconds': round(sum(math.ceil(seconds * 1000) for seconds in durations) / 1000, 1),
+        'outcome': outcome,
+    }
+
+
+def find_regressions(results, baseline):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in ('simulated_seconds', 'invocations', 'api_calls', 'billed_seconds'):
+            # 整数の回数は1回までの揺れを許す
+            limit = expected[key] * (1 + TOLERANCE) + (1 if isinstance(expected[key], int) else 0.5)
+            if result[key] > limit:
+                regressions.append(f'{name}: {key} {expected[key]} -> {result[key]}')
+        if result['outcome'] != expected['outcome']:
+            regressions.append(f"{name}: outcome {expected['outcome']!r} -> {result['outcome']!r}")
+    return regressions
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def run_load(count):
+    """署名付きのインタラクションを送り、応答までの実時間を測る(API はフェイクなので検証とルーティングの分)"""
+    install(dict(state='running', servers=3))
+    app = load_app('slash_commands_callback')
+    commands = [('status', 'all'), ('status', FIRST), ('stats', FIRST), ('start', FIRST), ('stop', 'unknown')]
+    events = [interaction_event(command, server) for command, server in commands]
+
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index in range(count):
+            event = events[index % len(events)]
+            started = REAL_PERF_COUNTER()
+            response = app.lambda_handler(event, None)
+            latencies.append(REAL_PERF_COUNTER() - started)
+            assert response.get('statusCode') != 401, 'signature rejected'
+
+    total = sum(latencies)
+    print(f'callback: {count} interactions, p50 {percentile(latencies, 0.5) * 1000:.2f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms, {count / total:.0f} req/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS))
+    parser.add_argument('--check', action='store_true', help='baseline.json と比べて回帰があれば失敗する')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--load', type=int, help='callback に送るインタラクションの数')
+    parser.add_argument('-v', '--verbose', action='store_true', help='関数のログも表示する')
+    args = parser.parse_args()
+
+    if args.load:
+        run_load(args.load)
+        return
+
+    results = {}
+    for name in args.scenarios:
+        log = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            results[name] = run_scenario(name, SCENARIOS[name])
+        metrics._samples.clear()
+        result = results[name]
+        print(f"{name:<17} {result['simulated_seconds']:>7.1f} s simulated, {result['invocations']:>3} invocations, "
+              f"{result['api_calls']:>3} API calls, {result['billed_seconds']:>6.1f} s billed | {result['outcome']}")
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline updated: {BASELINE}')
+    elif args.check:
+        regressions = find_regressions(results, baseline)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+from discord_message import COLOR_ERROR, COLOR_WARNING
+from fleet import DEFAULT_SERVER, resolve_server, server_label
+from operation_lock import OperationProgress
+from orchestration import FINISHED, Workflow, describe_failure, handle_event
+from rcon import RCON_PASSWORD, RconClient
+from server_steps import await_backup, describe_instance, send_backup
+from world_backup import BACKUP_BUCKET, describe_summary
+
+
+def lambda_handler(event, context):
+    return handle_event(WORKFLOW, event, lambda_context=context)
+
+
+def prepare(context):
+    # サーバー名が解決できなくても on_error で応答できるように、先に進捗メッセージを用意する
+    server = context.data.get('server') or context.event.get('server') or DEFAULT_SERVER
+    context.progress = OperationProgress.restore(context.event, "ワールドをバックアップします!" + server_label(server),
+                                                 context.state.get('progress'))
+    if 'instance_id' not in context.data:
+        context.data['server'], context.data['instance_id'] = resolve_server(context.event.get('server'))
+
+
+def check_instance(context):
+    if not BACKUP_BUCKET:
+        context.progress.finish("バックアップは設定されてないよ！", '管理者に問い合わせてね', COLOR_WARNING)
+        return FINISHED
+
+    # インスタンスのステータスを取得
+    instance = describe_instance(context.data['instance_id'])
+    ec2_status = instance['State']['Name']
+    print('[INFO] Instance Status:' + str(ec2_status))
+
+    if ec2_status != "running":
+        # ワールドのファイルはインスタンス上にしか無い
+        context.progress.finish("サーバーは起動してないよ！", '起動してから、もう一度試してね', COLOR_WARNING)
+        return FINISHED
+
+    context.data['public_ip'] = instance.get('PublicIpAddress')
+
+
+def pause_saving(context):
+    # 遊んでいる間はファイルが書き換わるので、保存し切ってから自動保存を止める(RCON が無ければそのまま読む)
+    if not RCON_PASSWORD:
+        print('[WARN] RCON_PASSWORD is not set, backing up while the world may be saving.')
+        return
+    with RconClient(context.data['public_ip']) as rcon:
+        rcon.command('save-all flush')
+        rcon.command('save-off')
+    context.data['saving_paused'] = True
+
+
+def resume_saving(context):
+    if context.data.pop('saving_paused', False):
+        with RconClient(context.data['public_ip']) as rcon:
+            rcon.command('save-on')
+
+
+def notify_backed_up(context):
+    resume_saving(context)
+    summary = context.data.get('backup')
+    context.progress.finish("\N{WHITE HEAVY CHECK MARK} バックアップ完了！",
+                            describe_summary(summary) if summary else '')
+
+
+def on_error(context, error):
+    try:
+        resume_saving(context)
+    except Exception as resume_error:
+        print(f'[ERROR] Failed to resume saving: {resume_error}')
+    context.progress.finish('\N{cross mark} バックアップ失敗！', describe_failure(error), COLOR_ERROR)
+
+
+WORKFLOW = Workflow(
+    'backup',
+    [
+        ('check_instance', check_instance),
+        ('pause_saving', pause_saving),
+        ('send_backup', send_backup()),
+        ('await_backup', await_backup("バックアップ", required=True)),
+        ('notify_backed_up', notify_backed_up),
+    ],
+    start=prepare,
+    on_error=on_error
+)
@@ -0,0 +1,57 @@
+"""ウォームコンテナ間で使い回すクライアント
+
+boto3 や requests の import・生成はそれなりに重いので、初めて使われた時に一度だけ行う。
+"""
+import threading
+
+_clients = {}
+_http_session = None
+_lock = threading.Lock()  # boto3 のデフォルトセッションはスレッドセーフではない
+
+HTTP_POOL_SIZE = 4
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5
+# 応答の取得に失敗した・5xx だったリクエストを再送してよいメソッド。
+# POST(メッセージの投稿など)は届いていれば重複するので、接続できなかった場合だけ再送する
+HTTP_RETRY_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'PATCH'})
+
+
+def get_client(service_name):
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+
+                client = boto3.client(service_name)
+                _clients[service_name] = client
+    return client
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=HTTP_RETRY_METHODS,
+        )
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+    return _http_session
+
+
+def reset():
+    """キャッシュ済みのクライアントを破棄する(ベンチマーク・差し替え用)"""
+    global _http_session
+    _clients.clear()
+    _http_session = None
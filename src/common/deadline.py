@@ -0,0 +1,70 @@
+"""Lambda の残り実行時間(予算)
+
+Lambda の context.get_remaining_time_in_millis() から Deadline を作り、待機・ポーリング・通信には
+残り時間から失敗通知用の予備(DEADLINE_RESERVE 秒)を引いた分しか使わせない。
+予算を使い切ったら、どの段階で尽きたかを添えて DeadlineExceededError を送出するので、
+Lambda に強制終了される前に、予備の時間で「失敗しました」を通知できる。
+handle_event などの入口で activate() しておけば、下位の関数は current() で参照できる。
+Lambda の context が無い場合(ローカル実行)は期限なし。
+"""
+import math
+import os
+import time
+
+DEADLINE_RESERVE = float(os.getenv('DEADLINE_RESERVE', '10'))  # 失敗通知のために残しておく秒数
+
+
+class DeadlineExceededError(Exception):
+    """OSError(socket.timeout など)として握りつぶされないよう TimeoutError にはしない"""
+
+    def __init__(self, stage, remaining):
+        super().__init__(f'Lambda deadline reached at {stage} ({remaining:.1f} seconds left)')
+        self.stage = stage
+        self.remaining = remaining
+
+
+class Deadline:
+    def __init__(self, remaining_ms=None, reserve=DEADLINE_RESERVE, clock=time.monotonic):
+        self.clock = clock
+        self.reserve = reserve
+        self.expires_at = None if remaining_ms is None else clock() + remaining_ms / 1000
+
+    @classmethod
+    def from_lambda_context(cls, lambda_context, reserve=DEADLINE_RESERVE, clock=time.monotonic):
+        remaining = getattr(lambda_context, 'get_remaining_time_in_millis', None)
+        return cls(remaining() if remaining else None, reserve, clock)
+
+    def remaining(self):
+        """強制終了までの秒数"""
+        if self.expires_at is None:
+            return math.inf
+        return self.expires_at - self.clock()
+
+    def budget(self, reserve=None):
+        """予備を除いて使える秒数"""
+        return self.remaining() - (self.reserve if reserve is None else reserve)
+
+    def check(self, stage, reserve=None):
+        if self.budget(reserve) <= 0:
+            raise DeadlineExceededError(stage, self.remaining())
+
+    def timeout(self, seconds, stage, reserve=None):
+        """seconds を予算内に切り詰める。予算が残っていなければ DeadlineExceededError"""
+        self.check(stage, reserve)
+        return min(seconds, self.budget(reserve))
+
+
+UNLIMITED = Deadline()
+
+_current = UNLIMITED
+
+
+def activate(deadline):
+    """この呼び出しの Deadline を設定する(Lambda は1コンテナで同時に1呼び出しだけ処理する)"""
+    global _current
+    _current = deadline
+    return deadline
+
+
+def current():
+    return _current
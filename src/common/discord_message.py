@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import metrics
+from clients import get_http_session
+from deadline import current
+
+DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+COMMAND_CHANNEL_ID = os.getenv('COMMAND_CHANNEL_ID')
+DISCORD_API_BASE = os.getenv('DISCORD_API_BASE', 'https://discord.com/api/v10')
+
+DISCORD_ENDPOINT = f"{DISCORD_API_BASE}/channels/{COMMAND_CHANNEL_ID}/messages"
+DISCORD_TIMEOUT = (3.05, 10)  # (接続, 読み取り) 秒
+DISCORD_MAX_RETRIES = 3  # 429 の後にやり直す回数
+DISCORD_MAX_WAIT = 30.0  # レート制限でこれ以上待たされる場合は諦める(秒)
+MAX_EMBEDS = 10  # 1メッセージに載せられる埋め込みの上限
+UNKNOWN_RESET_AFTER = 1.0  # リセット時刻が分からないウィンドウの長さの見込み(秒)
+
+COLOR_SUCCESS = 5763719
+COLOR_WARNING = 16705372
+COLOR_ERROR = 15548997
+COLOR_PROGRESS = 16777215
+
+
+def build_embed(title, msg, color=COLOR_SUCCESS):
+    return {
+        "title": title,
+        "description": msg,
+        "color": color
+    }
+
+
+class RateLimiter:
+    """Discord のレート制限をルート毎のバケットで追跡する
+
+    X-RateLimit-* ヘッダーで上限・残り回数・リセット時刻を覚えておき、使い切ったバケットへの
+    リクエストはリセットまで待つ。並列に送る場合も残り回数を先に確保するので、リセット直後に
+    一斉に送って 429 になることはない。429 の retry_after はバケット(global なら全体)に反映する。
+    """
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.routes = {}  # ルート → バケットID(ヘッダーで分かるまではルート自体)
+        self.buckets = {}  # バケットID → [残り回数, リセット時刻, 上限]
+        self.global_reset_at = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, route):
+        """1回分を確保できれば 0、できなければ待つべき秒数を返す"""
+        with self.lock:
+            now = self.clock()
+            if self.global_reset_at > now:
+                return self.global_reset_at - now
+
+            bucket = self.buckets.get(self.routes.get(route, route))
+            if bucket is None:
+                # まだ制限が分からない
+                return 0.0
+            if bucket[0] <= 0 and bucket[1] <= now:
+                # 新しいウィンドウ(上限が分からなければ1回だけ試す)
+                bucket[0] = bucket[2] or 1
+                bucket[1] = now + UNKNOWN_RESET_AFTER
+            if bucket[0] <= 0:
+                return bucket[1] - now
+            bucket[0] -= 1
+            return 0.0
+
+    def wait(self, route):
+        waited = 0.0
+        while True:
+            delay = self.reserve(route)
+            if delay <= 0:
+                return
+            waited += delay
+            if waited > DISCORD_MAX_WAIT:
+                raise TimeoutError(f'Discord rate limit for {route} did not reset within {DISCORD_MAX_WAIT} seconds.')
+            # 待っている間に Lambda が終了するなら諦める
+            current().check(f'Discord rate limit {route}', reserve=delay)
+            print(f'[INFO] Discord rate limit: waiting {delay:.2f} seconds for {route}')
+            self.sleep(delay)
+
+    def update(self, route, headers):
+        bucket_id = headers.get('X-RateLimit-Bucket')
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        limit = headers.get('X-RateLimit-Limit')
+        if remaining is None or reset_after is None:
+            return
+
+        with self.lock:
+            now = self.clock()
+            if bucket_id:
+                self.routes[route] = bucket_id
+            key = self.routes.get(route, route)
+            remaining = int(remaining)
+            current = self.buckets.get(key)
+            if current is not None and current[1] > now:
+                # 同じウィンドウ内なら、並列に確保済みの分を戻さない
+                remaining = min(remaining, current[0])
+            self.buckets[key] = [remaining, now + float(reset_after), int(limit) if limit else None]
+
+    def limited(self, route, retry_after, is_global):
+        with self.lock:
+            reset_at = self.clock() + retry_after
+            if is_global:
+                self.global_reset_at = max(self.global_reset_at, reset_at)
+                return
+            key = self.routes.get(route, route)
+            limit = self.buckets[key][2] if key in self.buckets else None
+            self.buckets[key] = [0, reset_at, limit]
+
+
+_limiter = RateLimiter()
+
+
+def request(method, url, body, headers=None, limiter=None):
+    """レート制限を守って Discord API を呼ぶ。失敗してもワークフローは止めずに None を返す"""
+    if limiter is None:
+        limiter = _limiter
+    route = f"{method} {urlsplit(url).path}"
+
+    response = None
+    started = time.perf_counter()
+    try:
+        for attempt in range(DISCORD_MAX_RETRIES + 1):
+            limiter.wait(route)
+            # 失敗通知も送れるよう、予備の時間まで使ってよい
+            timeout = tuple(current().timeout(seconds, f'Discord {route}', reserve=0) for seconds in DISCORD_TIMEOUT)
+            response = get_http_session().request(method, url, json=body, headers=headers, timeout=timeout)
+            limiter.update(route, response.headers)
+            if response.status_code != 429:
+                break
+
+            try:
+                data = response.json()
+            except ValueError:
+                data = {}
+            retry_after = float(data.get('retry_after', response.headers.get('Retry-After', 1)))
+            print(f'[WARN] Discord rate limited {route} (attempt {attempt + 1}), retry after {retry_after} seconds.')
+            limiter.limited(route, retry_after, data.get('global', False))
+        else:
+            print(f'[ERROR] Discord request {route} was still rate limited after {DISCORD_MAX_RETRIES} retries.')
+            return None
+    except Exception as error:
+        print(f'[ERROR] Discord request {route} failed: {error}')
+        return None
+    finally:
+        metrics.record('discord', time.perf_counter() - started)
+    return response
+
+
+def send_embeds(embeds):
+    """コマンドチャンネルに埋め込みを投稿する(MAX_EMBEDS 件ずつ1メッセージにまとめる)"""
+    headers = {
+        "Authorization": f"Bot {DISCORD_TOKEN}",
+    }
+    for start in range(0, len(embeds), MAX_EMBEDS):
+        response = request('POST', DISCORD_ENDPOINT, {"embeds": embeds[start:start + MAX_EMBEDS]}, headers)
+        print('[INFO] Send Message:' + str(response))
+
+
+def send_message(title, msg, color=COLOR_SUCCESS):
+    """コマンドチャンネルに新しいメッセージを投稿する"""
+    send_embeds([build_embed(title, msg, color)])
+
+
+_queue = []
+_queue_lock = threading.Lock()
+
+
+def queue_message(title, msg, color=COLOR_SUCCESS):
+    """投稿するメッセージを溜めておく(flush_messages でまとめて投稿する)"""
+    with _queue_lock:
+        _queue.append(build_embed(title, msg, color))
+
+
+def flush_messages():
+    with _queue_lock:
+        embeds = list(_queue)
+        _queue.clear()
+    if embeds:
+        send_embeds(embeds)
+
+
+def edit_original_response(interaction, title, msg, color=COLOR_SUCCESS):
+    """遅延応答(type 5)したインタラクションの元メッセージを書き換える"""
+    url = f"{DISCORD_API_BASE}/webhooks/{interaction['application_id']}/{interaction['token']}/messages/@original"
+    body = {
+        "embeds": [build_embed(title, msg, color)]
+    }
+
+    response = request('PATCH', url, body)
+    print('[INFO] Edit Message:' + str(response))
+
+
+class ProgressMessage:
+    """スラッシュコマンドの応答を、フェーズが進む度にその場で更新する
+
+    インタラクション情報のないイベント(手動実行など)では途中経過は出さず、
+    最後の結果だけをチャンネルに投稿する。
+    """
+
+    def __init__(self, event, title, clock=time.time, saved=None):
+        self.interaction = (event or {}).get('interaction')
+        self.title = title
+        self.clock = clock
+        self.started = clock()
+        self.steps = []
+        if saved:
+            # 別の呼び出しで途中まで進めた進捗を引き継ぐ
+            self.started = saved['started']
+            self.steps = [tuple(step) for step in saved['steps']]
+
+    @classmethod
+    def restore(cls, event, title, saved=None):
+        """ワークフローの呼び出し毎に進捗メッセージを復元する(初回のみ begin する)"""
+        progress = cls(event, title, saved=saved)
+        if saved is None:
+            progress.begin()
+        return progress
+
+    def dump(self):
+        return {'started': self.started, 'steps': self.steps}
+
+    def begin(self):
+        if self.interaction:
+            edit_original_response(self.interaction, self.title, "\N{timer clock}", COLOR_PROGRESS)
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def step(self, name):
+        elapsed = self.elapsed()
+        self.steps.append((name, elapsed))
+        print(f'[INFO] Progress: {name} ({elapsed:.1f} seconds)')
+
+        if self.interaction:
+            edit_original_response(self.interaction, self.title, self.describe_steps() + "\n\N{timer clock}",
+                                   COLOR_PROGRESS)
+
+    def describe_steps(self):
+        return "\n".join(f"\N{WHITE HEAVY CHECK MARK} {name} ({int(elapsed)}秒)" for name, elapsed in self.steps)
+
+    def finish(self, title, msg, color=COLOR_SUCCESS):
+        if self.interaction:
+            if self.steps:
+                msg = self.describe_steps() + "\n\n" + msg
+            edit_original_response(self.interaction, title, msg, color)
+        else:
+            send_message(title, msg, color)
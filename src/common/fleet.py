@@ -0,0 +1,106 @@
+"""複数のマイクラサーバー(ワールド)の登録簿
+
+SERVERS に {"survival": "i-...", "creative": "i-..."} の形式の JSON を設定する。
+未設定の場合は EC2_INSTANCE_ID を "default" という名前で登録する。
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import get_client
+from state_cache import record_instance
+
+ALL_SERVERS = 'all'
+FLEET_CONCURRENCY = int(os.getenv('FLEET_CONCURRENCY', '4'))  # 同時に操作するサーバー数の上限
+
+
+def load_servers():
+    servers = os.getenv('SERVERS')
+    if servers:
+        return json.loads(servers)
+    return {'default': os.getenv('EC2_INSTANCE_ID')}
+
+
+SERVERS = load_servers()
+DEFAULT_SERVER = next(iter(SERVERS))
+
+
+class UnknownServerError(KeyError):
+    pass
+
+
+def resolve_server(name=None):
+    """サーバー名を (名前, インスタンスID) に変換する。名前が無ければ最初に登録したサーバー"""
+    if not name:
+        name = DEFAULT_SERVER
+    if name not in SERVERS:
+        raise UnknownServerError(name)
+    return name, SERVERS[name]
+
+
+def server_names(name=None):
+    """name が all なら全サーバー名、それ以外はそのサーバー名だけを返す"""
+    if name == ALL_SERVERS:
+        return list(SERVERS)
+    return [resolve_server(name)[0]]
+
+
+def server_label(name):
+    """複数サーバーを登録している場合だけ、メッセージに付けるサーバー名"""
+    return f" ({name})" if len(SERVERS) > 1 else ""
+
+
+def describe_servers(names=None):
+    """1回の describe_instances で複数サーバーの状態を取得する
+
+    戻り値はサーバー名 → describe_instances の Instances 要素。
+    """
+    if names is None:
+        names = list(SERVERS)
+    ids = {SERVERS[name]: name for name in names}
+    if not ids:
+        return {}
+
+    response = get_client('ec2').describe_instances(InstanceIds=list(ids))
+    instances = {}
+    for reservation in response['Reservations']:
+        for instance in reservation['Instances']:
+            instances[ids[instance['InstanceId']]] = instance
+            record_instance(instance)
+    return instances
+
+
+def describe_server_statuses(names=None):
+    """1回の describe_instance_status で複数サーバーのステータスチェックを取得する"""
+    if names is None:
+        names = list(SERVERS)
+    ids = {SERVERS[name]: name for name in names}
+    if not ids:
+        return {}
+
+    response = get_client('ec2').describe_instance_status(InstanceIds=list(ids))
+    return {ids[status['InstanceId']]: status for status in response['InstanceStatuses']}
+
+
+def run_concurrently(function, items, max_workers=None):
+    """items の各要素に function を並列に適用する(同時実行数は FLEET_CONCURRENCY まで)
+
+    戻り値は要素 → 結果(例外が発生した場合は例外オブジェクト)。
+    """
+    items = list(items)
+    if not items:
+        return {}
+    if len(items) == 1:
+        return {items[0]: _call(function, items[0])}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers or FLEET_CONCURRENCY, len(items))) as executor:
+        results = executor.map(lambda item: _call(function, item), items)
+        return dict(zip(items, results))
+
+
+def _call(function, item):
+    try:
+        return function(item)
+    except Exception as error:
+        print(f'[ERROR] {item}: {error}')
+        return error
@@ -0,0 +1,45 @@
+"""休止(ハイバネーション)での停止と復帰
+
+マイクラのプロセスを生かしたままワールドを保存して自動保存を止め(save-all flush, save-off)、
+stop_instances(Hibernate=True) でメモリごと休止する。復帰時は起動スクリプトを使わずに
+そのままマイクラの応答を待ち、自動保存を戻す(save-on)。
+HIBERNATE が true で、インスタンスが休止に対応していて、RCON が使える場合だけ休止する。
+休止できなかった場合は呼び出し元が通常の停止にフォールバックする。
+"""
+import os
+
+from rcon import RCON_PASSWORD, RconClient
+
+HIBERNATE = os.getenv('HIBERNATE', 'false').lower() == 'true'
+
+HIBERNATE_REASON = 'Client.UserInitiatedHibernate'
+
+
+def can_hibernate(instance):
+    return (HIBERNATE and bool(RCON_PASSWORD) and bool(instance.get('PublicIpAddress'))
+            and instance.get('HibernationOptions', {}).get('Configured', False))
+
+
+def is_hibernated(instance):
+    """休止した状態で停止しているなら True"""
+    return instance['State']['Name'] == 'stopped' and instance.get('StateReason', {}).get('Code') == HIBERNATE_REASON
+
+
+def hibernate_instance(ec2_client, instance_id, host):
+    """ワールドを保存してから休止する。失敗した場合は自動保存を戻して例外を送出する"""
+    with RconClient(host) as rcon:
+        rcon.command('save-all flush')
+        rcon.command('save-off')
+
+    try:
+        ec2_client.stop_instances(InstanceIds=[instance_id], Hibernate=True)
+    except Exception:
+        resume_world(host)
+        raise
+    print(f'[INFO] Successfully Hibernated Instance: {instance_id}')
+
+
+def resume_world(host):
+    """休止前に止めた自動保存を戻す"""
+    with RconClient(host) as rcon:
+        rcon.command('save-on')
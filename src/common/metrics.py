@@ -0,0 +1,82 @@
+"""フェーズ毎の所要時間を CloudWatch Embedded Metric Format(EMF)で出力する
+
+計測値は呼び出し中はメモリに溜めておき、flush() で次元(function, action, server)毎に
+1行の JSON として標準出力に書く。Lambda では CloudWatch Logs がそのままメトリクスに変換し、
+ローカル実行ではログとして読める。計測自体は perf_counter と list.append だけなので、
+API 呼び出しや待機に比べて無視できる。
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'MinecraftServer')
+FUNCTION_NAME = os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+ALL_SERVERS = 'all'  # 特定のサーバーに紐付かない計測(監視の1周など)の server 次元
+DIMENSIONS = ['function', 'action', 'server']
+MAX_METRICS = 100  # EMF の1レコードに載せられるメトリクス数の上限
+
+_samples = []  # (action, server, フェーズ名, ミリ秒)
+_defaults = {'action': 'unknown', 'server': ALL_SERVERS}
+_lock = threading.Lock()
+
+
+def use(action, server=None):
+    """以降の計測の既定の action / server を設定する"""
+    _defaults['action'] = action
+    _defaults['server'] = server or ALL_SERVERS
+
+
+def record(name, seconds, server=None, action=None):
+    with _lock:
+        _samples.append((action or _defaults['action'], server or _defaults['server'], name, seconds * 1000))
+
+
+@contextmanager
+def timed(name, server=None, action=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, server, action)
+
+
+def build_records(samples, timestamp):
+    groups = {}
+    for action, server, name, milliseconds in samples:
+        groups.setdefault((action, server), {}).setdefault(name, []).append(round(milliseconds, 1))
+
+    records = []
+    for (action, server), values in groups.items():
+        names = list(values)
+        for start in range(0, len(names), MAX_METRICS):
+            chunk = names[start:start + MAX_METRICS]
+            record = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [DIMENSIONS],
+                        'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in chunk],
+                    }],
+                },
+                'function': FUNCTION_NAME,
+                'action': action,
+                'server': server,
+            }
+            for name in chunk:
+                # 同じフェーズを複数回計測した場合は配列で出す
+                record[name] = values[name][0] if len(values[name]) == 1 else values[name]
+            records.append(record)
+    return records
+
+
+def flush(out=print):
+    """溜めた計測値を EMF の JSON 行として出力する"""
+    with _lock:
+        samples = list(_samples)
+        _samples.clear()
+    for record in build_records(samples, int(time.time() * 1000)):
+        out(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
@@ -0,0 +1,119 @@
+import json
+import os
+import socket
+import struct
+import time
+
+from deadline import current
+
+MINECRAFT_PORT = int(os.getenv('MINECRAFT_PORT', '25565'))
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', '300'))  # マイクラ起動待ちの上限(秒)
+
+PROTOCOL_VERSION = -1  # ステータス取得のみなのでバージョンは問わない
+PING_INTERVAL = 2.0  # 起動待ち中の ping 間隔(秒)
+
+
+class ReadinessTimeoutError(TimeoutError):
+    pass
+
+
+def _pack_varint(value):
+    value &= 0xFFFFFFFF
+    data = b''
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data += struct.pack('B', byte | 0x80)
+        else:
+            return data + struct.pack('B', byte)
+
+
+def _pack_string(value):
+    encoded = value.encode('utf-8')
+    return _pack_varint(len(encoded)) + encoded
+
+
+def _pack_packet(packet_id, payload=b''):
+    body = _pack_varint(packet_id) + payload
+    return _pack_varint(len(body)) + body
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by Minecraft server.')
+        data += chunk
+    return data
+
+
+def _read_varint(sock):
+    value = 0
+    for i in range(5):
+        byte = _recv_exact(sock, 1)[0]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise ValueError('VarInt is too big.')
+
+
+def ping(host, port=None, timeout=3.0):
+    """Server List Ping でサーバーのステータスを取得する
+
+    戻り値はサーバーが返すステータス JSON に、応答時間(latency 秒)を加えた dict。
+    """
+    if port is None:
+        port = MINECRAFT_PORT
+    timeout = current().timeout(timeout, f'ping {host}')
+
+    started = time.monotonic()
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.settimeout(timeout)
+
+        # ハンドシェイク(次の状態: 1=status) → ステータス要求
+        handshake = (_pack_varint(PROTOCOL_VERSION) + _pack_string(host) + struct.pack('>H', port) +
+                     _pack_varint(1))
+        sock.sendall(_pack_packet(0x00, handshake) + _pack_packet(0x00))
+
+        _read_varint(sock)  # パケット長
+        packet_id = _read_varint(sock)
+        if packet_id != 0x00:
+            raise ValueError(f'Unexpected packet id: {packet_id}')
+        length = _read_varint(sock)
+        status = json.loads(_recv_exact(sock, length).decode('utf-8'))
+
+    status['latency'] = time.monotonic() - started
+    return status
+
+
+def wait_until_ready(host, port=None, timeout=None, interval=PING_INTERVAL, sleep=time.sleep, clock=time.monotonic):
+    """サーバーが ping に応答する(ログインを受け付ける)まで待機する"""
+    if timeout is None:
+        timeout = READINESS_TIMEOUT
+
+    started = clock()
+    deadline = started + timeout
+    attempts = 0
+    last_error = None
+
+    while True:
+        attempts += 1
+        try:
+            status = ping(host, port, timeout=max(min(interval, deadline - clock()), 0.5))
+        except (OSError, ValueError) as error:
+            last_error = error
+        else:
+            elapsed = clock() - started
+            print(f'[INFO] Minecraft server is ready after {elapsed:.1f} seconds ({attempts} pings), '
+                  f'players: {status.get("players", {}).get("online")}/{status.get("players", {}).get("max")}')
+            status['elapsed'] = elapsed
+            return status
+
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise ReadinessTimeoutError(
+                f'Minecraft server {host}:{port or MINECRAFT_PORT} did not respond within {timeout} seconds '
+                f'({attempts} pings, last error: {last_error}).')
+        sleep(current().timeout(min(interval, remaining), f'ping {host}'))
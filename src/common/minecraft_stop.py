@@ -0,0 +1,155 @@
+import os
+import shlex
+import socket
+import time
+
+from deadline import current
+from rcon import RCON_PASSWORD, RCON_PORT, RconClient
+from ssm_command import CommandError, check_command, run_shell_script, send_shell_script
+
+STOP_MODE = os.getenv('STOP_MODE', 'process')  # process: SSMでプロセス終了を監視 / rcon: RCONで保存・停止
+if STOP_MODE == 'rcon' and not RCON_PASSWORD:
+    # RCON はパスワードを設定した場合だけ使う(ポートを開ける必要があるため)
+    print('[WARN] STOP_MODE is rcon but RCON_PASSWORD is empty, stopping with the process watch.')
+    STOP_MODE = 'process'
+STOP_TIMEOUT = float(os.getenv('STOP_TIMEOUT', '180'))  # マイクラ終了待ちの上限(秒)
+MINECRAFT_PROCESS_PATTERN = os.getenv('MINECRAFT_PROCESS_PATTERN', 'java.*-jar')
+
+MINECRAFT_DIR = '/home/ec2-user/minecraft/'
+STOP_LOG_MARKERS = 'Stopping server|Saving chunks'
+
+SSM_TIMEOUT_MARGIN = 30  # シェル側のタイムアウトに対する SSM 待機の余裕(秒)
+
+
+class StopTimeoutError(TimeoutError):
+    pass
+
+
+def stop_minecraft(ssm_client, instance_id, host=None, script='Minecraft_stop.sh', mode=None, timeout=None):
+    """マイクラの終了を検知するまで待機し、フェーズ毎の所要時間(秒)を返す
+
+    上限時間内に終了しなかった場合は例外を送出する(ワールド破損を避けるためインスタンスは停止させない)。
+    """
+    if mode is None:
+        mode = STOP_MODE
+    if timeout is None:
+        timeout = STOP_TIMEOUT
+
+    if mode == 'rcon':
+        phases = _stop_with_rcon(host, timeout)
+    else:
+        phases = _stop_with_process_watch(ssm_client, instance_id, script, timeout)
+
+    log_phases(phases)
+    return phases
+
+
+def build_stop_commands(script, timeout):
+    pattern = shlex.quote(MINECRAFT_PROCESS_PATTERN)
+    return [
+        f"cd {MINECRAFT_DIR}",
+        "now_ms() { echo $(( $(date +%s%N) / 1000000 )); }",
+        "started=$(now_ms)",
+        f"sh {script}",
+        'echo "PHASE stop_script $(( $(now_ms) - started ))"',
+        f"limit=$(( started + {int(timeout * 1000)} ))",
+        'saving=""',
+        f"while pgrep -f {pattern} > /dev/null; do",
+        f"  if [ -z \"$saving\" ] && grep -qE '{STOP_LOG_MARKERS}' logs/latest.log 2>/dev/null; then",
+        '    saving=1',
+        '    echo "PHASE saving $(( $(now_ms) - started ))"',
+        '  fi',
+        '  if [ $(now_ms) -ge $limit ]; then echo "Minecraft did not exit" >&2; exit 1; fi',
+        '  sleep 0.5',
+        'done',
+        'echo "PHASE exited $(( $(now_ms) - started ))"',
+    ]
+
+
+def parse_phases(stdout):
+    phases = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'PHASE':
+            phases[fields[1]] = int(fields[2]) / 1000
+    return phases
+
+
+def send_stop_script(ssm_client, instance_id, script='Minecraft_stop.sh', timeout=None, **send_kwargs):
+    """終了スクリプトを送信してコマンドIDを返す(完了は待たない)"""
+    if timeout is None:
+        timeout = STOP_TIMEOUT
+    return send_shell_script(ssm_client, instance_id, build_stop_commands(script, timeout), **send_kwargs)
+
+
+def check_stop_script(ssm_client, command_id, instance_id):
+    """終了スクリプトの状態を1回だけ確認する。終了していればフェーズ毎の所要時間を返す"""
+    try:
+        result = check_command(ssm_client, command_id, instance_id)
+    except CommandError as error:
+        if 'Minecraft did not exit' in error.result.stderr:
+            raise StopTimeoutError('Minecraft did not exit within the stop timeout.') from error
+        raise
+    if result is None:
+        return None
+
+    phases = parse_phases(result.stdout)
+    log_phases(phases)
+    return phases
+
+
+def log_phases(phases):
+    for name, seconds in phases.items():
+        print(f'[INFO] Stop phase {name}: {seconds:.1f} seconds.')
+
+
+def _stop_with_process_watch(ssm_client, instance_id, script, timeout):
+    try:
+        result = run_shell_script(ssm_client, instance_id, build_stop_commands(script, timeout),
+                                  timeout=timeout + SSM_TIMEOUT_MARGIN)
+    except CommandError as error:
+        if 'Minecraft did not exit' in error.result.stderr:
+            raise StopTimeoutError(f'Minecraft did not exit within {timeout} seconds.') from error
+        raise
+
+    phases = parse_phases(result.stdout)
+    phases['total'] = result.elapsed
+    return phases
+
+
+def send_rcon_stop(host):
+    """RCON でワールドを保存してから停止を指示する。保存にかかった秒数を返す"""
+    started = time.monotonic()
+    with RconClient(host) as rcon:
+        rcon.command('save-all flush')
+        saved = time.monotonic() - started
+        try:
+            rcon.command('stop')
+        except ConnectionError:
+            # 応答前に接続が切れることがある
+            pass
+    return saved
+
+
+def is_rcon_port_open(host):
+    try:
+        with socket.create_connection((host, RCON_PORT), timeout=1.0):
+            return True
+    except OSError:
+        return False
+
+
+def _stop_with_rcon(host, timeout, sleep=time.sleep, clock=time.monotonic):
+    started = clock()
+    phases = {'save': send_rcon_stop(host)}
+
+    # RCON ポートが閉じるまで待機
+    deadline = started + timeout
+    while is_rcon_port_open(host):
+        if clock() >= deadline:
+            raise StopTimeoutError(f'Minecraft did not exit within {timeout} seconds.')
+        sleep(current().timeout(0.5, f'RCON stop {host}'))
+
+    phases['exited'] = clock() - started
+    phases['total'] = phases['exited']
+    return phases
@@ -0,0 +1,90 @@
+"""監視(monitoring_ec2)の次の実行時刻を決めて、監視イベントのルールに設定する
+
+MONITOR_CADENCE=adaptive では、監視の度にルールを次の1回だけ発火する cron に書き換える。
+- 無人のサーバーは、停止する起動時間(idle_limit_minutes)を過ぎた直後に確認する
+- 遊んでいる間は MONITOR_INTERVAL 毎。MONITOR_BUSY_PLAYERS 人以上なら全員が一度に抜けることは少ないので
+  MONITOR_MAX_INTERVAL まで空ける
+- 停止する起動時間に届かないうちは、届くまで確認しない(遊んでいても停止できないため)
+どの場合も MONITOR_MIN_INTERVAL～MONITOR_MAX_INTERVAL 秒に収め、メンテナンス(5時)の開始を越えない。
+MONITOR_CADENCE=fixed では従来通り FIXED_EXPRESSION(5分毎)で監視する。
+"""
+import datetime
+import math
+import os
+import time
+
+from clients import get_client
+from play_schedule import MAINTENANCE_HOUR, TOKYO_OFFSET
+
+MONITOR_CADENCE = os.getenv('MONITOR_CADENCE', 'adaptive')
+MONITOR_INTERVAL = int(os.getenv('MONITOR_INTERVAL', '300'))  # 少人数で遊んでいる間・状態が分からない場合の間隔(秒)
+MONITOR_BUSY_PLAYERS = int(os.getenv('MONITOR_BUSY_PLAYERS', '4'))
+MONITOR_MIN_INTERVAL = 60  # ルールは分単位でしか発火しない
+MONITOR_MAX_INTERVAL = int(os.getenv('MONITOR_MAX_INTERVAL', '900'))
+CHECK_MARGIN = 30  # メンテナンスの開始を確実に過ぎてから確認する(秒)
+
+FIXED_EXPRESSION = 'cron(*/5 * * * ? *)'
+RULE_PROPERTIES = ('Description', 'RoleArn', 'EventBusName')  # put_rule で引き継ぐルールのプロパティ
+
+_rule_properties = {}  # ルール名 → 引き継ぐプロパティ(コンテナ毎に1回だけ取得する)
+
+
+def seconds_until_maintenance(now):
+    """次のメンテナンス(5:00 JST)までの秒数"""
+    local = now + TOKYO_OFFSET
+    start = local - local % 86400 + MAINTENANCE_HOUR * 3600
+    if start <= local:
+        start += 86400
+    return start - local
+
+
+def next_check_seconds(players, uptime_minutes, limit_minutes):
+    """1台のサーバーを次に確認するまでの秒数(MONITOR_MIN_INTERVAL～MONITOR_MAX_INTERVAL に収める前)
+
+    players はマイクラと ec2 のログイン人数の合計。無人で uptime_minutes > limit_minutes なら停止する。
+    """
+    # 起動時間(分未満は切り捨て)が floor(limit) + 1 分になれば停止できる
+    until_limit = (math.floor(limit_minutes) + 1 - uptime_minutes) * 60
+    if not players:
+        return until_limit
+    interval = MONITOR_MAX_INTERVAL if players >= MONITOR_BUSY_PLAYERS else MONITOR_INTERVAL
+    return max(interval, until_limit)
+
+
+def next_delay(checks, now=None):
+    """サーバー毎の確認までの秒数から、次に監視する秒数を決める"""
+    if now is None:
+        now = time.time()
+    delay = min(min(checks, default=MONITOR_INTERVAL), MONITOR_MAX_INTERVAL,
+                seconds_until_maintenance(now) + CHECK_MARGIN)
+    return max(MONITOR_MIN_INTERVAL, delay)
+
+
+def one_shot_expression(at):
+    """at(UNIX 時刻)以降で最初の分に1回だけ発火する cron(UTC)"""
+    moment = datetime.datetime.fromtimestamp(math.ceil(at / 60) * 60, datetime.timezone.utc)
+    return f'cron({moment.minute} {moment.hour} {moment.day} {moment.month} ? {moment.year})'
+
+
+def rule_properties(rule_name):
+    """put_rule は渡さなかったプロパティを消すので、テンプレートで設定した値を取得しておく"""
+    properties = _rule_properties.get(rule_name)
+    if properties is None:
+        rule = get_client('events').describe_rule(Name=rule_name)
+        properties = {key: rule[key] for key in RULE_PROPERTIES if rule.get(key)}
+        _rule_properties[rule_name] = properties
+    return properties
+
+
+def schedule_monitoring(rule_name, seconds=MONITOR_INTERVAL, now=None):
+    """監視イベントのルールを有効にし、seconds 秒後(fixed では5分毎)に発火するようにする"""
+    if now is None:
+        now = time.time()
+    if MONITOR_CADENCE == 'adaptive':
+        expression = one_shot_expression(now + seconds)
+    else:
+        expression = FIXED_EXPRESSION
+    get_client('events').put_rule(Name=rule_name, ScheduleExpression=expression, State='ENABLED',
+                                  **rule_properties(rule_name))
+    print(f'[INFO] Next monitoring: {expression} ({rule_name})')
+    return expression
@@ -0,0 +1,213 @@
+"""インスタンス毎の操作ロック
+
+同じ操作(start/stop/restart)が同時に要求された場合は実行中の操作に合流させ、
+異なる操作の場合はすぐに拒否する。ロックは DynamoDB の条件付き書き込みで取得する。
+OPERATION_TABLE が未設定の場合はプロセス内のメモリで代用する(ローカル実行用)。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from clients import get_client
+from discord_message import COLOR_SUCCESS, ProgressMessage, edit_original_response
+
+OPERATION_TABLE = os.getenv('OPERATION_TABLE')
+OPERATION_TTL = int(os.getenv('OPERATION_TTL', '900'))  # ワーカーが落ちた場合にロックが自然解放されるまでの秒数
+
+ACQUIRED = 'acquired'  # 新しく操作を開始した
+ATTACHED = 'attached'  # 実行中の同じ操作に合流した
+CONFLICT = 'conflict'  # 別の操作が実行中
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+
+
+def new_record(instance_id, operation, interaction, now, ttl):
+    return {
+        'instance_id': instance_id,
+        'operation_id': uuid.uuid4().hex,
+        'operation': operation,
+        'status': STATUS_RUNNING,
+        'started_at': int(now),
+        'expires_at': int(now + ttl),
+        'waiters': [],
+        'interaction': interaction,
+    }
+
+
+def is_active(record, now):
+    return record is not None and record['status'] == STATUS_RUNNING and record['expires_at'] >= now
+
+
+class MemoryLockStore:
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, instance_id, operation, interaction, now, ttl):
+        with self.lock:
+            record = self.records.get(instance_id)
+            if not is_active(record, now):
+                record = new_record(instance_id, operation, interaction, now, ttl)
+                self.records[instance_id] = record
+                return ACQUIRED, dict(record)
+            if record['operation'] == operation:
+                if interaction:
+                    record['waiters'].append(interaction)
+                return ATTACHED, dict(record)
+            return CONFLICT, dict(record)
+
+    def release(self, instance_id, operation_id, result):
+        with self.lock:
+            record = self.records.get(instance_id)
+            if record is None or record['operation_id'] != operation_id:
+                return None
+            record['status'] = STATUS_DONE
+            record['result'] = result
+            return dict(record)
+
+
+class DynamoLockStore:
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or get_client('dynamodb')
+
+    def acquire(self, instance_id, operation, interaction, now, ttl):
+        # 解放と取得が交差した場合に備えて数回だけやり直す
+        for _ in range(3):
+            record = new_record(instance_id, operation, interaction, now, ttl)
+            try:
+                self.client.put_item(
+                    TableName=self.table_name,
+                    Item=self._to_item(record),
+                    ConditionExpression='attribute_not_exists(instance_id) OR #status <> :running OR expires_at < :now',
+                    ExpressionAttributeNames={'#status': 'status'},
+                    ExpressionAttributeValues={':running': {'S': STATUS_RUNNING}, ':now': {'N': str(int(now))}}
+                )
+                return ACQUIRED, record
+            except self.client.exceptions.ConditionalCheckFailedException:
+                pass
+
+            try:
+                response = self.client.update_item(
+                    TableName=self.table_name,
+                    Key={'instance_id': {'S': instance_id}},
+                    UpdateExpression='SET waiters = list_append(waiters, :waiter)',
+                    ConditionExpression='#operation = :operation AND #status = :running AND expires_at >= :now',
+                    ExpressionAttributeNames={'#operation': 'operation', '#status': 'status'},
+                    ExpressionAttributeValues={
+                        ':waiter': {'L': [{'S': json.dumps(interaction)}] if interaction else []},
+                        ':operation': {'S': operation},
+                        ':running': {'S': STATUS_RUNNING},
+                        ':now': {'N': str(int(now))},
+                    },
+                    ReturnValues='ALL_NEW'
+                )
+                return ATTACHED, self._from_item(response['Attributes'])
+            except self.client.exceptions.ConditionalCheckFailedException:
+                pass
+
+            response = self.client.get_item(
+                TableName=self.table_name,
+                Key={'instance_id': {'S': instance_id}},
+                ConsistentRead=True
+            )
+            current = self._from_item(response['Item']) if 'Item' in response else None
+            if is_active(current, now):
+                return CONFLICT, current
+
+        raise Exception(f'Could not acquire operation lock for {instance_id}.')
+
+    def release(self, instance_id, operation_id, result):
+        try:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={'instance_id': {'S': instance_id}},
+                UpdateExpression='SET #status = :done, #result = :result',
+                ConditionExpression='operation_id = :operation_id',
+                ExpressionAttributeNames={'#status': 'status', '#result': 'result'},
+                ExpressionAttributeValues={
+                    ':done': {'S': STATUS_DONE},
+                    ':result': {'S': json.dumps(result)},
+                    ':operation_id': {'S': operation_id},
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # 期限切れで別の操作に取って代わられている
+            return None
+        return self._from_item(response['Attributes'])
+
+    @staticmethod
+    def _to_item(record):
+        return {
+            'instance_id': {'S': record['instance_id']},
+            'operation_id': {'S': record['operation_id']},
+            'operation': {'S': record['operation']},
+            'status': {'S': record['status']},
+            'started_at': {'N': str(record['started_at'])},
+            'expires_at': {'N': str(record['expires_at'])},
+            'waiters': {'L': []},
+        }
+
+    @staticmethod
+    def _from_item(item):
+        return {
+            'instance_id': item['instance_id']['S'],
+            'operation_id': item['operation_id']['S'],
+            'operation': item['operation']['S'],
+            'status': item['status']['S'],
+            'started_at': int(item['started_at']['N']),
+            'expires_at': int(item['expires_at']['N']),
+            'waiters': [json.loads(waiter['S']) for waiter in item.get('waiters', {}).get('L', [])],
+        }
+
+
+_store = None
+
+
+def get_lock_store():
+    global _store
+    if _store is None:
+        _store = DynamoLockStore(OPERATION_TABLE) if OPERATION_TABLE else MemoryLockStore()
+    return _store
+
+
+def acquire_operation(instance_id, operation, interaction=None, store=None, now=None):
+    if store is None:
+        store = get_lock_store()
+    if now is None:
+        now = time.time()
+
+    state, record = store.acquire(instance_id, operation, interaction, now, OPERATION_TTL)
+    print(f'[INFO] Operation lock {state}: {record["operation"]} {record["operation_id"]} on {instance_id}')
+    return state, record
+
+
+def release_operation(operation, result, store=None):
+    """操作ロックを解放し、合流していたユーザーのインタラクション一覧を返す"""
+    if store is None:
+        store = get_lock_store()
+
+    record = store.release(operation['instance_id'], operation['operation_id'], result)
+    return (record or {}).get('waiters', [])
+
+
+class OperationProgress(ProgressMessage):
+    """ProgressMessage に加えて、終了時に操作ロックを解放し、合流したユーザーにも結果を返す"""
+
+    def __init__(self, event, title, store=None, **kwargs):
+        super().__init__(event, title, **kwargs)
+        self.operation = (event or {}).get('operation')
+        self.store = store
+
+    def finish(self, title, msg, color=COLOR_SUCCESS):
+        super().finish(title, msg, color)
+
+        if not self.operation:
+            return
+        waiters = release_operation(self.operation, {'title': title, 'msg': msg, 'color': color}, self.store)
+        for waiter in waiters:
+            edit_original_response(waiter, title, msg, color)
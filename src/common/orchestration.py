@@ -0,0 +1,300 @@
+"""処理を短いステップの列として実行する
+
+各ステップは1回だけ確認を行い、次へ進む(None を返す)・後で再実行する(Wait を返す)・
+ワークフローを終える(FINISHED を返す)のいずれかを選ぶ。待機中は Lambda を占有せず、
+進捗(state)を SQS の遅延メッセージとして保存して自分自身を再実行させる。
+実行途中で Lambda が落ちても、メッセージが再配信されて同じステップから再開する。
+Lambda の残り時間(deadline.Deadline)が予備しか残っていなければ、次のステップは新しい呼び出しに引き継ぎ、
+引き継げない(キューが無い・この呼び出しで1つもステップを実行していない)場合は
+どのステップで尽きたかを添えて on_error で失敗を通知する。
+再配信では送信済みの操作も再実行されるので、SSM コマンドの送信などは context.run_id で重複を避ける。
+"""
+import heapq
+import json
+import os
+import time
+
+import metrics
+from clients import get_client
+from deadline import UNLIMITED, Deadline, DeadlineExceededError, activate
+
+ORCHESTRATION_QUEUE_URL = os.getenv('ORCHESTRATION_QUEUE_URL')
+INLINE_WAIT_LIMIT = float(os.getenv('INLINE_WAIT_LIMIT', '1'))  # この秒数以下の待機は再スケジュールせずその場で待つ
+
+SQS_MAX_DELAY = 900
+BACKOFF_FACTOR = 1.6
+
+FINISHED = 'finished'
+WAITING = 'waiting'
+
+
+class Wait:
+    """ステップを seconds 秒後に再実行する"""
+
+    def __init__(self, seconds, reason=''):
+        self.seconds = seconds
+        self.reason = reason
+
+
+class StepTimeoutError(TimeoutError):
+    pass
+
+
+class Workflow:
+    def __init__(self, name, steps, start, on_error):
+        """
+        steps: (ステップ名, 関数) のリスト。関数は StepContext を受け取る
+        start: 最初の呼び出しで StepContext を準備する関数(進捗メッセージの生成など)
+        on_error: ステップで例外が発生した場合に呼ばれる関数
+        """
+        self.name = name
+        self.steps = steps
+        self.start = start
+        self.on_error = on_error
+
+
+class StepContext:
+    def __init__(self, workflow, state, clock=time.time, deadline=UNLIMITED):
+        self.workflow = workflow
+        self.state = state
+        self.data = state['data']
+        self.clock = clock
+        self.deadline = deadline
+        self.progress = None
+
+    @property
+    def event(self):
+        return self.state['event']
+
+    @property
+    def redelivered(self):
+        """SQS が同じメッセージを再配信した(前の呼び出しで送信済みの操作があり得る)"""
+        return self.state.get('redelivered', False)
+
+    @property
+    def run_id(self):
+        """ワークフローの実行毎の ID(SQS の再配信や引き継ぎをまたいで変わらない)"""
+        return f"{self.workflow.name}-{self.state['started_at']:.3f}"
+
+    def elapsed(self):
+        return self.clock() - self.state['started_at']
+
+    def step_elapsed(self):
+        return self.clock() - self.state['step_started_at']
+
+    def backoff(self, initial, maximum):
+        """同じステップを再実行する度に待機時間を伸ばす"""
+        return min(initial * BACKOFF_FACTOR ** self.state['step_polls'], maximum)
+
+    def check_step_timeout(self, timeout, message):
+        if self.step_elapsed() > timeout:
+            raise StepTimeoutError(f'{message} ({timeout} seconds)')
+
+
+def new_state(workflow, event, clock=time.time):
+    now = clock()
+    return {
+        'workflow': workflow.name,
+        'event': event or {},
+        'step': 0,
+        'started_at': now,
+        'step_started_at': now,
+        'polls': 0,
+        'step_polls': 0,
+        'data': {},
+    }
+
+
+def run_workflow(workflow, state, scheduler, clock=time.time, deadline=UNLIMITED):
+    """待機が必要になるか、最後のステップまで進める(呼び出し中に計測した所要時間は最後に出力する)"""
+    metrics.use(workflow.name, state['data'].get('server'))
+    try:
+        return _run_steps(workflow, state, scheduler, clock, deadline)
+    finally:
+        metrics.flush()
+
+
+def _run_steps(workflow, state, scheduler, clock, deadline):
+    context = StepContext(workflow, state, clock, deadline)
+    failed = False
+    ran = False  # この呼び出しでステップを実行したか
+
+    try:
+        # 準備(サーバー名の解決など)の失敗も on_error で通知し、操作ロックを解放する
+        workflow.start(context)
+        metrics.use(workflow.name, context.data.get('server'))
+        while state['step'] < len(workflow.steps):
+            name, step = workflow.steps[state['step']]
+            stage = f'{workflow.name}.{name}'
+            if deadline.budget() <= 0:
+                if context.progress is not None:
+                    state['progress'] = context.progress.dump()
+                # 1つも進めずに引き継ぐと(予備がタイムアウト以上など)、引き継ぎを繰り返すだけになるので失敗にする
+                if ran and scheduler.handoff(state):
+                    print(f'[INFO] Workflow {workflow.name} handed off at {name}: '
+                          f'{deadline.remaining():.1f} seconds left in this invocation.')
+                    return WAITING
+                deadline.check(stage)
+            result = step(context)
+            ran = True
+
+            if isinstance(result, Wait):
+                state['polls'] += 1
+                state['step_polls'] += 1
+                if context.progress is not None:
+                    state['progress'] = context.progress.dump()
+                if scheduler.schedule(state, result.seconds, deadline, stage):
+                    # その場で待機した
+                    continue
+                print(f'[INFO] Workflow {workflow.name} waiting {result.seconds} seconds at {name}: {result.reason}')
+                return WAITING
+
+            step_elapsed = clock() - state['step_started_at']
+            print(f'[INFO] Workflow {workflow.name} step {name} done in {step_elapsed:.1f} seconds.')
+            # ステップの所要時間(再スケジュールをまたいだ待ち時間を含む)をフェーズの計測値にする
+            metrics.record(name, step_elapsed)
+            if result == FINISHED:
+                break
+
+            state['step'] += 1
+            state['step_started_at'] = clock()
+            state['step_polls'] = 0
+    except Exception as error:
+        print(f'[ERROR] Workflow {workflow.name} failed at {workflow.steps[state["step"]][0]}: {error}')
+        workflow.on_error(context, error)
+        failed = True
+
+    metrics.record('failed' if failed else 'total', clock() - state['started_at'])
+    print(f'[INFO] Workflow {workflow.name} finished in {clock() - state["started_at"]:.1f} seconds '
+          f'({state["polls"]} polls).')
+    return FINISHED
+
+
+class InlineScheduler:
+    """キューが無い場合: その場で待機する(従来どおり Lambda 内でブロックする)"""
+
+    def __init__(self, sleep=time.sleep):
+        self.sleep = sleep
+
+    def schedule(self, state, seconds, deadline=UNLIMITED, stage=''):
+        # 予算を超える待機はせず、切り詰めた分はステップの再実行で確認し直す
+        self.sleep(deadline.timeout(seconds, stage))
+        return True
+
+    def handoff(self, state):
+        return False
+
+
+class SqsScheduler:
+    """短い待機はその場で、それ以外は SQS の遅延メッセージで自分自身を再実行する"""
+
+    def __init__(self, queue_url, inline_limit=INLINE_WAIT_LIMIT, sleep=time.sleep, clock=time.time):
+        self.queue_url = queue_url
+        self.inline_limit = inline_limit
+        self.sleep = sleep
+        self.clock = clock
+
+    def schedule(self, state, seconds, deadline=UNLIMITED, stage=''):
+        if seconds <= min(self.inline_limit, deadline.budget()):
+            self.sleep(seconds)
+            return True
+
+        self.enqueue(state, seconds)
+        return False
+
+    def handoff(self, state):
+        """残りのステップを新しい呼び出しで続ける"""
+        self.enqueue(state, 0)
+        return True
+
+    def enqueue(self, state, seconds):
+        get_client('sqs').send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(state),
+            DelaySeconds=min(int(seconds), SQS_MAX_DELAY)
+        )
+
+
+def handle_event(workflow, event, scheduler=None, lambda_context=None):
+    """Lambda のイベント(最初の呼び出し、または SQS からの再開)でワークフローを進める"""
+    if scheduler is None:
+        scheduler = SqsScheduler(ORCHESTRATION_QUEUE_URL) if ORCHESTRATION_QUEUE_URL else InlineScheduler()
+    deadline = activate(Deadline.from_lambda_context(lambda_context))
+
+    if 'Records' in (event or {}):
+        for record in event['Records']:
+            state = json.loads(record['body'])
+            state['redelivered'] = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1')) > 1
+            run_workflow(workflow, state, scheduler, deadline=deadline)
+    else:
+        run_workflow(workflow, new_state(workflow, event), scheduler, deadline=deadline)
+    return 0
+
+
+def describe_failure(error):
+    """失敗通知の本文(時間切れならどの段階で尽きたかを添える)"""
+    msg = '管理者に問い合わせてね\N{Person with Folded Hands}'
+    if isinstance(error, DeadlineExceededError):
+        msg += f'\n(時間切れ: {error.stage})'
+    return msg
+
+
+class LocalScheduler:
+    """仮想時計でワークフローを実行するローカルランナー
+
+    runner = LocalScheduler()
+    runner.run(WORKFLOW, event)
+    """
+
+    def __init__(self, inline_limit=0.0, timeout=None, queue=True):
+        self.now = 0.0
+        self.inline_limit = inline_limit
+        self.timeout = timeout  # Lambda のタイムアウト(秒)を再現する
+        self.use_queue = queue  # False ならキューの無い InlineScheduler と同じく常にその場で待つ
+        self.queue = []
+        self.invocations = 0
+        self.sequence = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def schedule(self, state, seconds, deadline=UNLIMITED, stage=''):
+        if not self.use_queue:
+            self.sleep(deadline.timeout(seconds, stage))
+            return True
+        if seconds <= min(self.inline_limit, deadline.budget()):
+            self.sleep(seconds)
+            return True
+
+        self.enqueue(state, seconds)
+        return False
+
+    def handoff(self, state):
+        if not self.use_queue:
+            return False
+        self.enqueue(state, 0.0)
+        return True
+
+    def enqueue(self, state, seconds):
+        # SQS を経由した場合と同じく JSON に直列化して渡す
+        self.sequence += 1
+        heapq.heappush(self.queue, (self.now + seconds, self.sequence, json.dumps(state)))
+
+    def deadline(self):
+        """呼び出し毎の Deadline(timeout が無ければ期限なし)"""
+        if self.timeout is None:
+            return UNLIMITED
+        return Deadline(self.timeout * 1000, clock=self.clock)
+
+    def run(self, workflow, event):
+        self.invocations += 1
+        run_workflow(workflow, new_state(workflow, event, self.clock), self, self.clock, self.deadline())
+        while self.queue:
+            due, _, body = heapq.heappop(self.queue)
+            self.now = max(self.now, due)
+            self.invocations += 1
+            run_workflow(workflow, json.loads(body), self, self.clock, self.deadline())
+        return self.now
@@ -0,0 +1,78 @@
+"""遊ぶ時間帯の学習と、それに合わせた事前起動・自動停止の判断
+
+ログイン人数の時系列から「曜日×時間帯」毎に誰かが遊んでいた週の割合を求め、
+割合が PREWARM_THRESHOLD 以上の時間帯を遊ぶ時間帯とみなす。
+- 遊ぶ時間帯が始まる PREWARM_LEAD 秒前に停止中のサーバーを起動する
+- 無人のサーバーを停止するまでの起動時間を、その時間帯の割合に応じて IDLE_MIN_MINUTES～IDLE_MAX_MINUTES で変える
+メンテナンス時間(5時台)には起動しない。
+履歴が PROFILE_MIN_DAYS 日に満たない間は学習せず、事前起動はしないで停止までの起動時間は IDLE_MAX_MINUTES にする。
+"""
+import os
+from itertools import compress
+
+from player_stats import DAY, WEEK
+
+TOKYO_OFFSET = 9 * 3600  # JST(夏時間は無い)
+HOURS_PER_WEEK = 168
+MAINTENANCE_HOUR = 5  # 5:00～5:59 はメンテナンス中
+
+PROFILE_WEEKS = int(os.getenv('PROFILE_WEEKS', '8'))  # 学習に使う週数
+PROFILE_MIN_DAYS = float(os.getenv('PROFILE_MIN_DAYS', '7'))  # 学習を始めるのに必要な履歴の日数
+PREWARM_THRESHOLD = float(os.getenv('PREWARM_THRESHOLD', '0.5'))  # 遊ぶ時間帯とみなす割合。1より大きければ事前起動しない
+PREWARM_LEAD = int(os.getenv('PREWARM_LEAD', '600'))  # 遊ぶ時間帯の何秒前に起動するか(起動に約3分かかる)
+IDLE_MIN_MINUTES = int(os.getenv('IDLE_MIN_MINUTES', '10'))  # 誰も遊ばない時間帯で、無人なら停止する起動時間(分)
+IDLE_MAX_MINUTES = int(os.getenv('IDLE_MAX_MINUTES', '30'))  # よく遊ぶ時間帯で、無人なら停止する起動時間(分)
+
+
+def hour_of_week(timestamp):
+    return int((timestamp + TOKYO_OFFSET) // 3600) % HOURS_PER_WEEK
+
+
+def is_maintenance(timestamp):
+    return int((timestamp + TOKYO_OFFSET) // 3600) % 24 == MAINTENANCE_HOUR
+
+
+def build_profile(series, now, weeks=PROFILE_WEEKS):
+    """直近 weeks 週で、曜日×時間帯毎に誰かが遊んでいた週の割合(168要素)を返す
+
+    履歴が PROFILE_MIN_DAYS 日に満たなければ None を返す(まだ見ていない曜日を「遊ばない」とみなさない)。
+    """
+    start = now - weeks * WEEK
+    i, j = series.window(start, now)
+    if i == j or now - series.times[i] < PROFILE_MIN_DAYS * DAY:
+        return None
+
+    # 誰かがログインしていたサンプルの時刻 → 通しの時間番号(同じ時間の重複は1回と数える)
+    active_hours = {int((t + TOKYO_OFFSET) // 3600) for t in compress(series.times[i:j], series.players[i:j])}
+    counts = [0] * HOURS_PER_WEEK
+    for hour in active_hours:
+        counts[hour % HOURS_PER_WEEK] += 1
+
+    observed_weeks = max(1.0, min(weeks, (now - series.times[i]) / WEEK))
+    return [min(1.0, count / observed_weeks) for count in counts]
+
+
+def should_prewarm(profile, now, lead=PREWARM_LEAD, threshold=PREWARM_THRESHOLD):
+    """遊ぶ時間帯が始まる直前(lead 秒以内)なら True"""
+    if profile is None:
+        return False
+    target = now + lead
+    hour = hour_of_week(target)
+    if hour == hour_of_week(now):
+        # 時間帯の途中では起動しない(自動停止した後に起動し直さない)
+        return False
+    if is_maintenance(now) or is_maintenance(target):
+        return False
+    return profile[hour] >= threshold and profile[(hour - 1) % HOURS_PER_WEEK] < threshold
+
+
+def idle_limit_minutes(profile, now):
+    """今の時間帯で、無人のサーバーを停止するまでの起動時間(分)"""
+    if profile is None:
+        # 学習前は従来通りの上限にする
+        return IDLE_MAX_MINUTES
+    hour = hour_of_week(now)
+    # 次の時間帯に遊ぶ見込みがあれば、それも考慮する
+    likelihood = max(profile[hour], profile[(hour + 1) % HOURS_PER_WEEK])
+    return IDLE_MIN_MINUTES + (IDLE_MAX_MINUTES - IDLE_MIN_MINUTES) * likelihood
+
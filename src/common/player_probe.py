@@ -0,0 +1,282 @@
+import datetime
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+
+from clients import get_client
+from fleet import run_concurrently
+from minecraft_ping import ping
+from rcon import RCON_PASSWORD, RconClient
+from ssm_command import CommandError, run_fleet_script, run_shell_script
+
+# 安い順に試すバックエンド(rcon/ping は SSM を使わない)。
+# rcon/ping では ec2 のログインユーザー数が分からず、起動時間も LaunchTime(OS の再起動では変わらない)なので、
+# 停止する前に confirm_idle で SSM の結果(起動時間は LaunchTime からとの短い方)に置き換える
+PROBE_BACKENDS = os.getenv('PROBE_BACKENDS', 'rcon,ping,ssm').split(',')
+
+ZABBIGOT_STATUS_PATH = '/home/ec2-user/minecraft/plugins/Zabbigot/status.json'
+SSM_PROBE_COMMANDS = [
+    "uptime -s",  # 起動時間
+    "who -q",  # ec2にログイン中のユーザー情報
+    f"cat {ZABBIGOT_STATUS_PATH}",  # マイクラサーバーを監視ログ
+    # マイクラ(java)の使用メモリと搭載メモリ(kB)
+    "echo \"# memory=$(ps -C java -o rss= | awk '{s+=$1} END {print s+0}') "
+    "$(awk '/MemTotal/ {print $2}' /proc/meminfo)\"",
+]
+
+
+@dataclass
+class ProbeResult:
+    backend: str
+    uptime_minutes: int  # ec2の起動時間(分)
+    login_user_cnt: int  # ec2にログイン中のユーザー数(ssm 以外では取得できないので0)
+    minecraft_login_user_cnt: int  # マイクラのログイン人数
+    latency: float  # 問い合わせにかかった秒数
+    tps: float = None  # 直近1分の TPS(rcon で Spigot/Paper の場合のみ)
+    memory: float = None  # マイクラの使用メモリ / 搭載メモリ(ssm の場合のみ)
+
+
+def probe_players(instance, ssm_client=None, backends=None):
+    """利用可能なバックエンドのうち最も安いもので、起動時間とログイン人数を取得する
+
+    instance は describe_instances の Instances 要素。
+    """
+    if backends is None:
+        backends = PROBE_BACKENDS
+
+    last_error = None
+    for backend in backends:
+        probe = PROBES.get(backend.strip())
+        if probe is None or not probe.available(instance, ssm_client):
+            continue
+        started = time.monotonic()
+        try:
+            result = probe.run(instance, ssm_client)
+        except Exception as error:
+            print(f'[WARN] Probe {backend} failed: {error}')
+            last_error = error
+            continue
+        result.latency = time.monotonic() - started
+        print(f'[INFO] Probe {result.backend}: {result.minecraft_login_user_cnt} players, '
+              f'{result.login_user_cnt} ec2 users, up {result.uptime_minutes} minutes '
+              f'in {result.latency:.3f} seconds.')
+        return result
+
+    raise Exception(f'No probe backend succeeded (last error: {last_error}).')
+
+
+def probe_fleet(instances, ssm_client=None, backends=None):
+    """複数サーバーの起動時間とログイン人数をまとめて取得する
+
+    instances はサーバー名 → describe_instances の Instances 要素。
+    rcon/ping は並列に問い合わせ、ssm は残ったサーバー全台に1回の send_command で送る。
+    戻り値はサーバー名 → ProbeResult(全バックエンドが失敗したサーバーは含まない)。
+    """
+    if backends is None:
+        backends = PROBE_BACKENDS
+
+    results = {}
+    remaining = dict(instances)
+    for backend in backends:
+        probe = PROBES.get(backend.strip())
+        if probe is None:
+            continue
+        targets = {name: instance for name, instance in remaining.items() if probe.available(instance, ssm_client)}
+        if not targets:
+            continue
+
+        started = time.monotonic()
+        for name, result in probe.run_many(targets, ssm_client).items():
+            if isinstance(result, Exception):
+                print(f'[WARN] Probe {backend} failed for {name}: {result}')
+                continue
+            print(f'[INFO] Probe {result.backend} {name}: {result.minecraft_login_user_cnt} players, '
+                  f'{result.login_user_cnt} ec2 users, up {result.uptime_minutes} minutes.')
+            results[name] = result
+            del remaining[name]
+        print(f'[INFO] Probe {backend}: {len(targets)} servers in {time.monotonic() - started:.3f} seconds.')
+
+        if not remaining:
+            break
+
+    for name in remaining:
+        print(f'[ERROR] No probe backend succeeded for {name}.')
+    return results
+
+
+def confirm_idle(instances, probes, ssm_client=None):
+    """停止候補のサーバーを、ssm 以外で問い合わせていれば SSM で問い合わせ直す
+
+    instances はサーバー名 → describe_instances の Instances 要素、probes は probe_fleet の結果。
+    戻り値はサーバー名 → ProbeResult(SSM が失敗したサーバーは例外オブジェクト)。
+    """
+    targets = {name: instance for name, instance in instances.items() if probes[name].backend != 'ssm'}
+    results = {name: probes[name] for name in instances if name not in targets}
+    if not targets:
+        return results
+
+    started = time.monotonic()
+    for name, result in PROBES['ssm'].run_many(targets, ssm_client).items():
+        if not isinstance(result, Exception):
+            print(f'[INFO] Probe ssm {name}: {result.minecraft_login_user_cnt} players, '
+                  f'{result.login_user_cnt} ec2 users, up {result.uptime_minutes} minutes.')
+        results[name] = result
+    print(f'[INFO] Confirmed {len(targets)} idle servers with ssm in {time.monotonic() - started:.3f} seconds.')
+    return results
+
+
+def launch_uptime_minutes(instance, now=None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return int((now - instance['LaunchTime']).total_seconds() / 60)
+
+
+class SsmProbe:
+    """SSM でコマンドを実行し、標準出力から直接読み取る"""
+
+    def available(self, instance, ssm_client):
+        return True
+
+    def run(self, instance, ssm_client):
+        if ssm_client is None:
+            ssm_client = get_client('ssm')
+        dt_now = datetime.datetime.now()  # 現時刻
+        result = run_shell_script(
+            ssm_client,
+            instance['InstanceId'],
+            SSM_PROBE_COMMANDS,
+            timeout=60,
+            TimeoutSeconds=60
+        )
+        return since_start(parse_ssm_output(result.stdout, dt_now), instance)
+
+    def run_many(self, instances, ssm_client):
+        if ssm_client is None:
+            ssm_client = get_client('ssm')
+        names = {instance['InstanceId']: name for name, instance in instances.items()}
+        dt_now = datetime.datetime.now()  # 現時刻
+        try:
+            commands = run_fleet_script(ssm_client, list(names), SSM_PROBE_COMMANDS, timeout=60, TimeoutSeconds=60)
+        except Exception as error:
+            return {name: error for name in instances}
+
+        results = {}
+        for instance_id, command in commands.items():
+            name = names[instance_id]
+            if not command.ok:
+                results[name] = CommandError(f'Command {command.command_id} {command.status}', command)
+                continue
+            try:
+                results[name] = since_start(parse_ssm_output(command.stdout, dt_now), instances[name])
+                results[name].latency = command.elapsed
+            except Exception as error:
+                results[name] = error
+        return results
+
+
+def since_start(result, instance):
+    """起動時間を最後の起動(start_instances)からの時間にする
+
+    休止から復帰した OS の起動時刻は休止前のままなので、uptime -s では休止していた時間まで含まれてしまう。
+    LaunchTime は休止からの復帰で更新され、OS の再起動では更新されないので、短い方を使う。
+    """
+    result.uptime_minutes = min(result.uptime_minutes, launch_uptime_minutes(instance))
+    return result
+
+
+def parse_ssm_output(stdout, dt_now):
+    log_list = stdout.splitlines()
+
+    # ec2起動日時
+    dt_uptime = datetime.datetime.strptime(log_list[0], '%Y-%m-%d %H:%M:%S')
+
+    # ec2にログイン中のユーザー数(who -q の最終行)
+    users_line = next(line for line in log_list[1:] if line.startswith('# users='))
+    login_user_cnt = int(users_line.replace('# users=', ''))
+
+    # マイクラログ
+    minecraft_log = json.loads(log_list[log_list.index(users_line) + 1])
+
+    # マイクラの使用メモリ(java が動いていなければ記録しない)
+    memory = None
+    memory_line = next((line for line in log_list if line.startswith('# memory=')), None)
+    if memory_line:
+        used, total = (int(value) for value in memory_line.replace('# memory=', '').split())
+        memory = used / total if used and total else None
+
+    return ProbeResult(
+        backend='ssm',
+        uptime_minutes=int((dt_now - dt_uptime).total_seconds() / 60),
+        login_user_cnt=login_user_cnt,
+        minecraft_login_user_cnt=int(minecraft_log['user']),
+        latency=0.0,
+        memory=memory
+    )
+
+
+class DirectProbe:
+    """SSM を使わずに問い合わせるバックエンド。複数サーバーは並列に問い合わせる"""
+
+    def run_many(self, instances, ssm_client):
+        return run_concurrently(lambda name: self._timed_run(instances[name], ssm_client), list(instances))
+
+    def _timed_run(self, instance, ssm_client):
+        started = time.monotonic()
+        result = self.run(instance, ssm_client)
+        result.latency = time.monotonic() - started
+        return result
+
+
+class PingProbe(DirectProbe):
+    """Server List Ping でマイクラに直接問い合わせる"""
+
+    def available(self, instance, ssm_client):
+        return bool(instance.get('PublicIpAddress'))
+
+    def run(self, instance, ssm_client):
+        status = ping(instance['PublicIpAddress'])
+        return ProbeResult(
+            backend='ping',
+            uptime_minutes=launch_uptime_minutes(instance),
+            login_user_cnt=0,
+            minecraft_login_user_cnt=int(status['players']['online']),
+            latency=0.0
+        )
+
+
+RCON_LIST_PATTERN = re.compile(r'There are (\d+)')
+RCON_TPS_PATTERN = re.compile(r'TPS from last 1m, 5m, 15m: \*?([\d.]+)')
+RCON_COLOR_PATTERN = re.compile(r'§.')
+
+
+class RconProbe(DirectProbe):
+    """RCON の list コマンドでマイクラに直接問い合わせる"""
+
+    def available(self, instance, ssm_client):
+        return bool(instance.get('PublicIpAddress')) and bool(RCON_PASSWORD)
+
+    def run(self, instance, ssm_client):
+        with RconClient(instance['PublicIpAddress']) as rcon:
+            response = rcon.command('list')
+            # tps は Spigot/Paper のコマンド(バニラでは Unknown command が返る)
+            tps = RCON_TPS_PATTERN.search(RCON_COLOR_PATTERN.sub('', rcon.command('tps')))
+        match = RCON_LIST_PATTERN.search(response)
+        if match is None:
+            raise ValueError(f'Unexpected list response: {response}')
+        return ProbeResult(
+            backend='rcon',
+            uptime_minutes=launch_uptime_minutes(instance),
+            login_user_cnt=0,
+            minecraft_login_user_cnt=int(match.group(1)),
+            latency=0.0,
+            tps=float(tps.group(1)) if tps else None
+        )
+
+
+PROBES = {
+    'ssm': SsmProbe(),
+    'ping': PingProbe(),
+    'rcon': RconProbe(),
+}
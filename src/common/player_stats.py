@@ -0,0 +1,202 @@
+"""ログイン人数の時系列
+
+監視の度に (時刻, マイクラのログイン人数, ec2のログインユーザー数) を1サンプルとして追記する。
+監視の間隔が SAMPLE_INTERVAL より空いた場合は、間も同じ人数だったとして SAMPLE_INTERVAL 毎に埋める。
+サンプルは列ごとの array に持ち、固定幅のバイナリとして S3 に1サーバー1オブジェクトで保存する。
+直近 STATS_CAPACITY 件を超えた古いサンプルは日毎の集計(ピーク・サンプル数・人数の合計)に畳み込む。
+集計は array の max/sum/sorted で行い、JSON を1行ずつ読み直すことはしない。
+STATS_BUCKET が未設定の場合はプロセス内のメモリで代用する(ローカル実行用)。
+"""
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+from clients import get_client
+
+STATS_BUCKET = os.getenv('STATS_BUCKET')
+STATS_CAPACITY = int(os.getenv('STATS_CAPACITY', str(90 * 288)))  # 保持する生サンプル数(5分毎で90日)
+SAMPLE_INTERVAL = int(os.getenv('SAMPLE_INTERVAL', '300'))  # 監視間隔(秒)。1サンプル = この秒数の稼働とみなす
+HOURLY_COST = float(os.getenv('HOURLY_COST', '0'))  # インスタンスの1時間あたりの料金(USD)
+# 監視の間隔が空いた分を今回の人数で埋める上限(これより空いていれば停止していたとみなす)
+MAX_SAMPLE_GAP = int(os.getenv('MONITOR_MAX_INTERVAL', '900')) + 60
+
+DAY = 86400
+WEEK = 7 * DAY
+
+MAGIC = b'MCS1'
+HEADER = struct.Struct('<4sHII')  # マジック, サンプル間隔, 生サンプル数, 日毎の集計数
+
+# 列名 → array の型コード(いずれもリトルエンディアンで保存する)
+SAMPLE_COLUMNS = (('times', 'I'), ('players', 'H'), ('users', 'B'))
+DAILY_COLUMNS = (('days', 'I'), ('peaks', 'H'), ('samples', 'H'), ('player_sums', 'I'))
+
+
+class PlayerSeries:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        for name, typecode in SAMPLE_COLUMNS + DAILY_COLUMNS:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp, players, users=0):
+        self.times.append(int(timestamp))
+        self.players.append(min(int(players), 0xFFFF))
+        self.users.append(min(int(users), 0xFF))
+
+    def fill(self, timestamp, players, users=0):
+        """監視の間隔が SAMPLE_INTERVAL より空いた分を、timestamp の人数で埋めてから追記する
+
+        1サンプル = interval 秒の稼働のまま集計できるようにする。
+        """
+        if self.times and timestamp - self.times[-1] <= MAX_SAMPLE_GAP:
+            for t in range(self.times[-1] + self.interval, int(timestamp) - self.interval // 2, self.interval):
+                self.append(t, players, users)
+        self.append(timestamp, players, users)
+
+    def trim(self, capacity=STATS_CAPACITY):
+        """古いサンプルを日毎の集計に畳み込んで、生サンプルを capacity 件に収める"""
+        overflow = len(self.times) - capacity
+        if overflow <= 0:
+            return
+
+        start = 0
+        while start < overflow:
+            day = self.times[start] - self.times[start] % DAY
+            end = min(bisect_left(self.times, day + DAY, start, overflow), overflow)
+            players = self.players[start:end]
+            if self.days and self.days[-1] == day:
+                # 同じ日の残りが前回畳み込まれている
+                self.peaks[-1] = max(self.peaks[-1], max(players))
+                self.samples[-1] += end - start
+                self.player_sums[-1] += sum(players)
+            else:
+                self.days.append(day)
+                self.peaks.append(max(players))
+                self.samples.append(end - start)
+                self.player_sums.append(sum(players))
+            start = end
+
+        for name, _ in SAMPLE_COLUMNS:
+            del getattr(self, name)[:overflow]
+
+    def window(self, start, end):
+        """start <= 時刻 < end の生サンプルの範囲を (開始, 終了) のインデックスで返す"""
+        return bisect_left(self.times, start), bisect_left(self.times, end)
+
+    def summarize(self, start, end):
+        """期間内のピーク・中央値の同時ログイン人数、稼働時間、料金の目安"""
+        i, j = self.window(start, end)
+        players = sorted(self.players[i:j])
+        hours = (j - i) * self.interval / 3600
+        return {
+            'samples': j - i,
+            'peak': players[-1] if players else 0,
+            'median': players[len(players) // 2] if players else 0,
+            'hours': hours,
+            'cost': hours * HOURLY_COST,
+        }
+
+    def weekly(self, now, weeks=4):
+        """直近 weeks 週分の集計を新しい順に返す(1週 = now から遡る7日間)"""
+        return [self.summarize(now - (week + 1) * WEEK, now - week * WEEK) for week in range(weeks)]
+
+    def total(self):
+        """日毎の集計も含めた累計の稼働時間・料金とピーク"""
+        samples = len(self.times) + sum(self.samples)
+        hours = samples * self.interval / 3600
+        return {
+            'samples': samples,
+            'peak': max(max(self.players, default=0), max(self.peaks, default=0)),
+            'hours': hours,
+            'cost': hours * HOURLY_COST,
+            'since': min(self.days[0] if self.days else time.time(), self.times[0] if self.times else time.time()),
+        }
+
+    def to_bytes(self):
+        chunks = [HEADER.pack(MAGIC, self.interval, len(self.times), len(self.days))]
+        for name, _ in SAMPLE_COLUMNS + DAILY_COLUMNS:
+            column = getattr(self, name)
+            if sys.byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            chunks.append(column.tobytes())
+        return b''.join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, interval, sample_count, daily_count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f'Unknown player stats format: {magic!r}')
+
+        series = cls(interval)
+        offset = HEADER.size
+        for columns, count in ((SAMPLE_COLUMNS, sample_count), (DAILY_COLUMNS, daily_count)):
+            for name, typecode in columns:
+                column = getattr(series, name)
+                size = column.itemsize * count
+                column.frombytes(data[offset:offset + size])
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                offset += size
+        return series
+
+
+class MemoryStatsStore:
+    def __init__(self):
+        self.objects = {}
+
+    def load(self, instance_id):
+        return self.objects.get(instance_id)
+
+    def save(self, instance_id, data):
+        self.objects[instance_id] = data
+
+
+class S3StatsStore:
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self.client = client or get_client('s3')
+
+    def load(self, instance_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f'stats/{instance_id}.bin')
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def save(self, instance_id, data):
+        self.client.put_object(Bucket=self.bucket, Key=f'stats/{instance_id}.bin', Body=data)
+
+
+_store = None
+
+
+def get_stats_store():
+    global _store
+    if _store is None:
+        _store = S3StatsStore(STATS_BUCKET) if STATS_BUCKET else MemoryStatsStore()
+    return _store
+
+
+def load_series(instance_id, store=None):
+    data = (store or get_stats_store()).load(instance_id)
+    return PlayerSeries.from_bytes(data) if data else PlayerSeries()
+
+
+def record_sample(instance_id, players, users=0, store=None, now=None):
+    """1サンプルを追記して保存する"""
+    if store is None:
+        store = get_stats_store()
+    if now is None:
+        now = time.time()
+
+    series = load_series(instance_id, store)
+    series.fill(now, players, users)
+    series.trim()
+    store.save(instance_id, series.to_bytes())
+    return series
@@ -0,0 +1,86 @@
+"""Minecraft の RCON クライアント
+
+RCON_PASSWORD が空なら使わない(既定)。Lambda は VPC 外からインスタンスのパブリック IP に接続するので、
+セキュリティグループで 25575 をインターネットに開ける必要があり、パスワードもコマンドも平文で流れる。
+"""
+import os
+import socket
+import struct
+
+from deadline import current
+
+RCON_PORT = int(os.getenv('RCON_PORT', '25575'))
+RCON_PASSWORD = os.getenv('RCON_PASSWORD', '')
+
+PACKET_COMMAND = 2
+PACKET_LOGIN = 3
+
+
+class RconError(Exception):
+    pass
+
+
+class RconClient:
+    """Minecraft の RCON クライアント
+
+    with RconClient(host) as rcon:
+        rcon.command('list')
+    """
+
+    def __init__(self, host, port=None, password=None, timeout=5.0):
+        self.host = host
+        self.port = port or RCON_PORT
+        self.password = RCON_PASSWORD if password is None else password
+        self.timeout = timeout
+        self.sock = None
+        self.request_id = 0
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        timeout = current().timeout(self.timeout, f'RCON {self.host}')
+        self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        self.sock.settimeout(timeout)
+        request_id = self._send(PACKET_LOGIN, self.password)
+        response_id, _, _ = self._receive()
+        if response_id == -1 or response_id != request_id:
+            self.close()
+            raise RconError('RCON authentication failed.')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def command(self, command):
+        request_id = self._send(PACKET_COMMAND, command)
+        response_id, _, body = self._receive()
+        if response_id != request_id:
+            raise RconError(f'Unexpected RCON response id: {response_id}')
+        return body
+
+    def _send(self, packet_type, body):
+        self.request_id += 1
+        payload = struct.pack('<ii', self.request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+        self.sock.sendall(struct.pack('<i', len(payload)) + payload)
+        return self.request_id
+
+    def _receive(self):
+        length = struct.unpack('<i', self._recv_exact(4))[0]
+        payload = self._recv_exact(length)
+        response_id, packet_type = struct.unpack('<ii', payload[:8])
+        return response_id, packet_type, payload[8:-2].decode('utf-8')
+
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Connection closed by RCON server.')
+            data += chunk
+        return data
@@ -0,0 +1,152 @@
+"""遊ぶ人数に合わせたインスタンスタイプの選択(停止中に変更する)
+
+INSTANCE_LADDER に小さい順のインスタンスタイプと、それぞれで快適に遊べる人数を並べておく。
+起動の度に、ログイン人数の時系列から今から SESSION_HOURS 時間の同じ曜日・時間帯のピーク人数を
+直近 SIZING_WEEKS 週分見て、その人数を収容できる最も小さいタイプを選ぶ。
+監視で TPS が STARVED_TPS を下回る、またはメモリ使用率が STARVED_MEMORY 以上のサーバーを見つけたら、
+そのタイプの収容人数をその時の人数未満に下げて記録する(STARVED_DAYS 日で忘れる)。
+記録は STATS_BUCKET の sizing/<インスタンスID>.json。次の起動では、同じ人数なら1つ大きいタイプになる。
+INSTANCE_LADDER が未設定ならインスタンスタイプは変えない。
+"""
+import json
+import os
+import time
+from dataclasses import dataclass
+
+from clients import get_client
+from player_stats import WEEK, load_series
+
+STATS_BUCKET = os.getenv('STATS_BUCKET')
+# "タイプ:人数:1時間あたりの料金(USD)" のカンマ区切り。例: t3.medium:4:0.0544,t3.large:8:0.1088
+INSTANCE_LADDER = os.getenv('INSTANCE_LADDER', '')
+
+SIZING_WEEKS = int(os.getenv('SIZING_WEEKS', '4'))  # ピーク人数を見る週数
+SESSION_HOURS = 3  # 起動してから遊ぶと見込む時間
+STARVED_TPS = float(os.getenv('STARVED_TPS', '18'))  # これを下回ったら処理が追いついていない
+STARVED_MEMORY = float(os.getenv('STARVED_MEMORY', '0.9'))  # マイクラのメモリ使用率がこれ以上なら足りていない
+STARVED_DAYS = 30  # 収容人数を下げた記録を使う日数
+
+
+@dataclass
+class Rung:
+    instance_type: str
+    players: int  # 快適に遊べる人数
+    hourly_cost: float = 0.0
+
+
+def parse_ladder(text=None):
+    if text is None:
+        text = INSTANCE_LADDER
+    ladder = []
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        fields = entry.strip().split(':')
+        ladder.append(Rung(fields[0], int(fields[1]), float(fields[2]) if len(fields) > 2 else 0.0))
+    return ladder
+
+
+class MemorySizingStore:
+    def __init__(self):
+        self.objects = {}
+
+    def load(self, instance_id):
+        return self.objects.get(instance_id, {})
+
+    def save(self, instance_id, starved):
+        self.objects[instance_id] = starved
+
+
+class S3SizingStore:
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self.client = client or get_client('s3')
+
+    def load(self, instance_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f'sizing/{instance_id}.json')
+        except self.client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(response['Body'].read())
+
+    def save(self, instance_id, starved):
+        self.client.put_object(Bucket=self.bucket, Key=f'sizing/{instance_id}.json',
+                               Body=json.dumps(starved, separators=(',', ':')).encode())
+
+
+_store = None
+
+
+def get_sizing_store():
+    global _store
+    if _store is None:
+        _store = S3SizingStore(STATS_BUCKET) if STATS_BUCKET else MemorySizingStore()
+    return _store
+
+
+def starved_reason(probe):
+    """監視の ProbeResult から、処理やメモリが足りていない理由(足りていれば None)"""
+    if probe.tps is not None and probe.tps < STARVED_TPS:
+        return f'TPS {probe.tps:.1f}'
+    if probe.memory is not None and probe.memory >= STARVED_MEMORY:
+        return f'memory {probe.memory:.0%}'
+    return None
+
+
+def record_starved(instance_id, instance_type, players, store=None, now=None):
+    """instance_type では players 人を収容できなかったことを記録する"""
+    if store is None:
+        store = get_sizing_store()
+    if now is None:
+        now = time.time()
+
+    starved = store.load(instance_id)
+    previous = starved.get(instance_type)
+    if previous and now - previous['at'] < STARVED_DAYS * 86400 and previous['players'] <= players:
+        return
+    starved[instance_type] = {'players': int(players), 'at': int(now)}
+    store.save(instance_id, starved)
+
+
+def capacity(rung, starved, now):
+    """足りなかった記録を反映した収容人数"""
+    record = starved.get(rung.instance_type)
+    if record and now - record['at'] < STARVED_DAYS * 86400:
+        return min(rung.players, record['players'] - 1)
+    return rung.players
+
+
+def expected_peak(series, now, weeks=SIZING_WEEKS, hours=SESSION_HOURS):
+    """直近 weeks 週の同じ曜日・時間帯(今から hours 時間)のピーク人数。履歴が無ければ None"""
+    peaks = []
+    for week in range(1, weeks + 1):
+        summary = series.summarize(now - week * WEEK, now - week * WEEK + hours * 3600)
+        if summary['samples']:
+            peaks.append(summary['peak'])
+    if not peaks:
+        # いつもは遊ばない時間帯なので、直近1週のピークに備える
+        summary = series.summarize(now - WEEK, now)
+        return summary['peak'] if summary['samples'] else None
+    return max(peaks)
+
+
+def choose_rung(ladder, players, starved, now):
+    """players 人を収容できる最も小さいタイプ(どれも足りなければ最大のタイプ)"""
+    for rung in ladder:
+        if capacity(rung, starved, now) >= players:
+            return rung
+    return ladder[-1]
+
+
+def plan_instance_type(instance_id, ladder=None, store=None, now=None):
+    """(次に使うタイプ, 見込みのピーク人数)。履歴が無ければタイプは None"""
+    if ladder is None:
+        ladder = parse_ladder()
+    if now is None:
+        now = time.time()
+
+    players = expected_peak(load_series(instance_id), now)
+    if not ladder or players is None:
+        return None, players
+    starved = (store or get_sizing_store()).load(instance_id)
+    return choose_rung(ladder, players, starved, now), players
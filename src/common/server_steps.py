@@ -0,0 +1,268 @@
+"""start/stop/restart のワークフローで共有するステップ
+
+どのステップも1回だけ確認を行い、まだなら Wait を返す。
+対象インスタンスは context.data['instance_id'] で指定する。
+"""
+import os
+
+import metrics
+from clients import get_client
+from hibernation import resume_world
+from minecraft_ping import PING_INTERVAL, READINESS_TIMEOUT, ReadinessTimeoutError, ping
+from minecraft_stop import (SSM_TIMEOUT_MARGIN, STOP_MODE, STOP_TIMEOUT, StopTimeoutError, check_stop_script,
+                            is_rcon_port_open, send_rcon_stop, send_stop_script)
+from orchestration import Wait
+from ssm_command import (SEND_RETRY_INTERVAL, SSM_COMMAND_TIMEOUT, CommandError, check_command, find_command,
+                         send_shell_script)
+from state_cache import record_instance
+from world_backup import BACKUP_BUCKET, BACKUP_TIMEOUT, backup_commands, describe_summary, parse_summary
+
+READINESS_MODE = os.getenv('READINESS_MODE', 'ping')  # ping: マイクラに直接問い合わせる / status_checks: EC2ステータスチェック
+
+INSTANCE_STATE_TIMEOUT = 300  # インスタンスが running になるまでの上限(秒)
+STATUS_CHECK_TIMEOUT = 600  # ステータスチェックが ok になるまでの上限(秒)
+STATUS_CHECK_SETTLE = 15  # status_checks モードでマイクラの開始を待つ秒数
+RESUME_TIMEOUT = 60  # 休止から復帰したマイクラが応答するまでの上限(秒)。超えたら起動スクリプトで起動する
+
+# ポーリング間隔(初回, 上限)秒。再実行の度に伸ばす
+POLL_INSTANCE_STATE = (5, 15)
+POLL_STATUS_CHECK = (10, 30)
+POLL_COMMAND = (1, 10)
+POLL_STOP = (1, 10)
+POLL_READY = (PING_INTERVAL, 5)
+POLL_BACKUP = (2, 15)
+
+MINECRAFT_DIR = '/home/ec2-user/minecraft/'
+
+
+def describe_instance(instance_id):
+    with metrics.timed('describe_instances'):
+        response = get_client('ec2').describe_instances(InstanceIds=[instance_id])
+    instance = response['Reservations'][0]['Instances'][0]
+    record_instance(instance)
+    return instance
+
+
+def send_once(context, key, send):
+    """send(Comment=...) で SSM コマンドを送り、コマンドIDを返す。ワークフローの実行毎に key 毎1回だけ送る
+
+    SQS のメッセージは再配信されることがあり、その場合は送信前の state からステップを再実行する。
+    送信済みなら(同じ state なら context.data、再配信ならコマンドのコメントで見つけて)そのコマンドを使う。
+    """
+    sent = context.data.setdefault('sent_commands', {})
+    if key in sent:
+        return sent[key]
+
+    ssm_client = get_client('ssm')
+    comment = f'{context.run_id} {key}'
+    command_id = find_command(ssm_client, context.data['instance_id'], comment, context.state['started_at'])
+    if command_id is None:
+        command_id = send(Comment=comment)
+    else:
+        print(f'[INFO] {key} was already sent: {command_id}')
+    sent[key] = command_id
+    return command_id
+
+
+def await_instance_state(expected, progress_name):
+    def step(context):
+        instance = describe_instance(context.data['instance_id'])
+        state = instance['State']['Name']
+        if state != expected:
+            context.check_step_timeout(INSTANCE_STATE_TIMEOUT, f'Instance did not become {expected}')
+            return Wait(context.backoff(*POLL_INSTANCE_STATE), state)
+
+        context.data['public_ip'] = instance.get('PublicIpAddress')
+        context.progress.step(progress_name)
+
+    return step
+
+
+def await_status_checks(context):
+    # ping モードと休止からの復帰ではステータスチェックを待たない
+    if READINESS_MODE != 'status_checks' or context.data.get('hibernated'):
+        return
+
+    response = get_client('ec2').describe_instance_status(InstanceIds=[context.data['instance_id']])
+    statuses = response['InstanceStatuses']
+    if not (statuses and statuses[0]['InstanceStatus']['Status'] == "ok" and
+            statuses[0]['SystemStatus']['Status'] == "ok"):
+        context.check_step_timeout(STATUS_CHECK_TIMEOUT, 'Instance status checks did not pass')
+        return Wait(context.backoff(*POLL_STATUS_CHECK), 'status checks')
+
+    print(f'[INFO] Successfully Started Instance: {context.data["instance_id"]} '
+          f'wait time was roughly: {int(context.step_elapsed())} seconds.')
+    context.progress.step("ステータスチェックOK")
+
+
+def await_resume(progress_name):
+    """休止から復帰した場合は、マイクラがそのまま応答するのを待つ
+
+    応答しなければ通常の起動(起動スクリプト)にフォールバックする。
+    """
+    def step(context):
+        if not context.data.get('hibernated'):
+            return
+
+        try:
+            ping(context.data['public_ip'])
+        except (OSError, ValueError) as error:
+            if context.step_elapsed() > RESUME_TIMEOUT:
+                print(f'[WARN] Minecraft did not resume from hibernation, falling back to the start script: {error}')
+                context.data['hibernated'] = False
+                return
+            return Wait(context.backoff(*POLL_READY), 'Minecraft resume')
+
+        resume_world(context.data['public_ip'])
+        context.data['resumed'] = True
+        print(f'[INFO] Minecraft resumed from hibernation in {context.step_elapsed():.1f} seconds.')
+        context.progress.step(progress_name)
+
+    return step
+
+
+def send_script(script):
+    def step(context):
+        if context.data.get('resumed'):
+            return
+
+        ssm_client = get_client('ssm')
+        try:
+            context.data['command_id'] = send_once(context, script, lambda **kwargs: send_shell_script(
+                ssm_client, context.data['instance_id'], [f"cd {MINECRAFT_DIR}", f"sh {script}"], **kwargs))
+        except ssm_client.exceptions.InvalidInstanceId:
+            # 起動直後で SSM エージェントがまだ登録されていない
+            context.check_step_timeout(SSM_COMMAND_TIMEOUT, 'SSM agent did not come online')
+            return Wait(SEND_RETRY_INTERVAL, 'SSM agent')
+
+    return step
+
+
+def await_script(message):
+    def step(context):
+        if context.data.get('resumed'):
+            return
+
+        result = check_command(get_client('ssm'), context.data['command_id'], context.data['instance_id'])
+        if result is None:
+            context.check_step_timeout(SSM_COMMAND_TIMEOUT, 'Command did not finish')
+            return Wait(context.backoff(*POLL_COMMAND), context.data['command_id'])
+        print(f'[INFO] {message}')
+
+    return step
+
+
+def await_ready(progress_name):
+    def step(context):
+        if context.data.get('resumed'):
+            return
+
+        # プロセスだけの再起動など、ワークフローが確認方法を指定する場合もある
+        if context.data.get('readiness', READINESS_MODE) == 'status_checks':
+            # マイクラが開始するまで待機
+            if context.step_elapsed() < STATUS_CHECK_SETTLE:
+                return Wait(STATUS_CHECK_SETTLE - context.step_elapsed(), 'Minecraft start')
+        else:
+            if not context.data.get('public_ip'):
+                context.data['public_ip'] = describe_instance(context.data['instance_id']).get('PublicIpAddress')
+            try:
+                status = ping(context.data['public_ip'])
+            except (OSError, ValueError) as error:
+                if context.step_elapsed() > READINESS_TIMEOUT:
+                    raise ReadinessTimeoutError(
+                        f'Minecraft server {context.data["public_ip"]} did not respond within '
+                        f'{READINESS_TIMEOUT} seconds (last error: {error}).')
+                return Wait(context.backoff(*POLL_READY), 'Minecraft ping')
+            print(f'[INFO] Minecraft server is ready, players: {status["players"]["online"]}/{status["players"]["max"]}')
+
+        context.progress.step(progress_name)
+
+    return step
+
+
+def send_stop(script):
+    def step(context):
+        if context.data.get('hibernated'):
+            return
+
+        if STOP_MODE == 'rcon':
+            if context.data.get('rcon_stop_sent'):
+                return
+            instance = describe_instance(context.data['instance_id'])
+            context.data['public_ip'] = instance.get('PublicIpAddress')
+            if context.redelivered and not is_rcon_port_open(context.data['public_ip']):
+                # 再配信: 前の呼び出しが停止を指示して、もう終了している
+                print('[INFO] RCON port is already closed, not sending stop again.')
+            else:
+                saved = send_rcon_stop(context.data['public_ip'])
+                print(f'[INFO] Stop phase save: {saved:.1f} seconds.')
+            context.data['rcon_stop_sent'] = True
+        else:
+            context.data['command_id'] = send_once(context, script, lambda **kwargs: send_stop_script(
+                get_client('ssm'), context.data['instance_id'], script, **kwargs))
+
+    return step
+
+
+def await_stop(progress_name):
+    def step(context):
+        if context.data.get('hibernated'):
+            return
+
+        # マイクラの終了を検知するまで待機
+        if STOP_MODE == 'rcon':
+            if is_rcon_port_open(context.data['public_ip']):
+                if context.step_elapsed() > STOP_TIMEOUT:
+                    raise StopTimeoutError(f'Minecraft did not exit within {STOP_TIMEOUT} seconds.')
+                return Wait(context.backoff(*POLL_STOP), 'RCON port')
+            print(f'[INFO] Stop phase exited: {context.step_elapsed():.1f} seconds.')
+        else:
+            phases = check_stop_script(get_client('ssm'), context.data['command_id'], context.data['instance_id'])
+            if phases is None:
+                context.check_step_timeout(STOP_TIMEOUT + SSM_TIMEOUT_MARGIN, 'Stop script did not finish')
+                return Wait(context.backoff(*POLL_COMMAND), context.data['command_id'])
+
+        print('[INFO] Successfully Stopped Minecraft.')
+        context.progress.step(progress_name)
+
+    return step
+
+
+def send_backup(enabled=True):
+    """ワールドの増分バックアップを SSM で開始する(バケットが無い・休止した場合は何もしない)"""
+    def step(context):
+        if not (enabled and BACKUP_BUCKET) or context.data.get('hibernated'):
+            return
+        context.data['backup_command_id'] = send_once(context, 'backup', lambda **kwargs: send_shell_script(
+            get_client('ssm'), context.data['instance_id'],
+            backup_commands(BACKUP_BUCKET, context.data['instance_id']),
+            execution_timeout=BACKUP_TIMEOUT, **kwargs))
+
+    return step
+
+
+def await_backup(progress_name, required=False):
+    """バックアップの完了を待つ。required でなければ、失敗しても警告を残して次へ進む"""
+    def step(context):
+        command_id = context.data.get('backup_command_id')
+        if command_id is None:
+            return
+
+        try:
+            result = check_command(get_client('ssm'), command_id, context.data['instance_id'])
+            if result is None:
+                context.check_step_timeout(BACKUP_TIMEOUT + SSM_TIMEOUT_MARGIN, 'Backup did not finish')
+                return Wait(context.backoff(*POLL_BACKUP), command_id)
+        except (CommandError, TimeoutError) as error:
+            if required:
+                raise
+            print(f'[WARN] Backup failed, continuing: {error}')
+            context.progress.step(f"{progress_name}失敗")
+            return
+
+        summary = parse_summary(result.stdout)
+        print(f'[INFO] Backup finished: {summary}')
+        context.data['backup'] = summary
+        context.progress.step(f"{progress_name} ({describe_summary(summary)})" if summary else progress_name)
+
+    return step
@@ -0,0 +1,234 @@
+import os
+import time
+from dataclasses import dataclass, field
+
+from deadline import current
+
+SSM_COMMAND_TIMEOUT = float(os.getenv('SSM_COMMAND_TIMEOUT', '120'))  # コマンド完了待ちの上限(秒)
+
+# get_command_invocation の Status のうち、これ以上変化しないもの
+TERMINAL_STATUSES = ('Success', 'Cancelled', 'TimedOut', 'Failed')
+
+POLL_INITIAL_INTERVAL = 0.25  # 初回ポーリング間隔(秒)
+POLL_MAX_INTERVAL = 5.0  # ポーリング間隔の上限(秒)
+POLL_BACKOFF = 1.6  # ポーリング間隔の増加率
+SEND_RETRY_INTERVAL = 2.0  # SSM エージェント未登録時の再送間隔(秒)
+
+
+@dataclass
+class CommandResult:
+    command_id: str
+    instance_id: str
+    status: str
+    status_details: str = ''
+    stdout: str = ''
+    stderr: str = ''
+    exit_code: int = -1
+    elapsed: float = 0.0  # send_command から終了確認までの秒数
+    polls: int = 0  # get_command_invocation の呼び出し回数
+    history: list = field(default_factory=list)  # 観測したステータスの推移
+
+    @property
+    def ok(self):
+        return self.status == 'Success'
+
+
+class CommandError(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+class CommandTimeoutError(CommandError, TimeoutError):
+    pass
+
+
+def send_shell_script(ssm_client, instance_id, commands, execution_timeout=None, **send_kwargs):
+    """AWS-RunShellScript を送信してコマンドIDを返す(完了は待たない)
+
+    instance_id にリストを渡すと、1回の send_command で複数インスタンスに送信する。
+    execution_timeout はスクリプトの実行時間の上限(秒、省略時はドキュメントの既定値 3600 秒)。
+    TimeoutSeconds はエージェントへの配信の期限で、実行時間は制限しない。
+    """
+    parameters = {"commands": commands}
+    if execution_timeout is not None:
+        parameters["executionTimeout"] = [str(int(execution_timeout))]
+    response = ssm_client.send_command(
+        InstanceIds=instance_id if isinstance(instance_id, list) else [instance_id],
+        DocumentName="AWS-RunShellScript",
+        Parameters=parameters,
+        **send_kwargs
+    )
+    return response['Command']['CommandId']
+
+
+def find_command(ssm_client, instance_id, comment, since):
+    """since(UNIX 時刻)以降に comment を付けて instance_id に送ったコマンドのID(無ければ None)"""
+    invoked_after = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since))
+    kwargs = {'InstanceId': instance_id, 'Filters': [{'key': 'InvokedAfter', 'value': invoked_after}]}
+    while True:
+        response = ssm_client.list_commands(**kwargs)
+        for command in response['Commands']:
+            if command.get('Comment') == comment:
+                return command['CommandId']
+        if not response.get('NextToken'):
+            return None
+        kwargs['NextToken'] = response['NextToken']
+
+
+def run_shell_script(ssm_client, instance_id, commands, timeout=None, sleep=time.sleep, clock=time.monotonic,
+                     **send_kwargs):
+    """AWS-RunShellScript を実行し、コマンドが終了状態になるまで待機する"""
+    if timeout is None:
+        timeout = SSM_COMMAND_TIMEOUT
+    started = clock()
+
+    while True:
+        try:
+            command_id = send_shell_script(ssm_client, instance_id, commands, **send_kwargs)
+            break
+        except ssm_client.exceptions.InvalidInstanceId:
+            # 起動直後で SSM エージェントがまだ登録されていない
+            remaining = started + timeout - clock()
+            if remaining <= 0:
+                raise
+            sleep(current().timeout(min(SEND_RETRY_INTERVAL, remaining), f'SSM send to {instance_id}'))
+
+    return wait_for_command(ssm_client, command_id, instance_id, timeout=timeout, sleep=sleep, clock=clock,
+                            started=started)
+
+
+def poll_command(ssm_client, result):
+    """get_command_invocation を1回だけ呼び、result を更新する。終了状態なら True を返す"""
+    result.polls += 1
+    try:
+        invocation = ssm_client.get_command_invocation(CommandId=result.command_id, InstanceId=result.instance_id)
+    except ssm_client.exceptions.InvocationDoesNotExist:
+        # send_command 直後はまだ呼び出しが登録されていないことがある
+        return False
+
+    return _update_result(result, invocation)
+
+
+def _update_result(result, invocation):
+    status = invocation['Status']
+    if not result.history or result.history[-1] != status:
+        result.history.append(status)
+    result.status = status
+    if status not in TERMINAL_STATUSES:
+        return False
+
+    result.status_details = invocation.get('StatusDetails', '')
+    result.stdout = invocation.get('StandardOutputContent', '')
+    result.stderr = invocation.get('StandardErrorContent', '')
+    result.exit_code = invocation.get('ResponseCode', -1)
+    return True
+
+
+def raise_for_status(result):
+    print(f'[INFO] Command {result.command_id} finished: {result.status} (exit code {result.exit_code}) '
+          f'in {result.elapsed:.2f} seconds, {result.polls} polls.')
+
+    if result.status == 'TimedOut':
+        raise CommandTimeoutError(f'Command {result.command_id} timed out: {result.status_details}', result)
+    if not result.ok:
+        raise CommandError(f'Command {result.command_id} {result.status}: {result.stderr.strip()}', result)
+
+
+def check_command(ssm_client, command_id, instance_id):
+    """コマンドの状態を1回だけ確認する(待機しない)
+
+    終了していなければ None、成功していれば CommandResult を返し、失敗していれば例外を送出する。
+    """
+    result = CommandResult(command_id=command_id, instance_id=instance_id, status='Pending')
+    if not poll_command(ssm_client, result):
+        return None
+    raise_for_status(result)
+    return result
+
+
+def wait_for_command(ssm_client, command_id, instance_id, timeout=None, sleep=time.sleep, clock=time.monotonic,
+                     started=None):
+    """コマンドが終了状態になるまでバックオフしながらポーリングする
+
+    成功時は CommandResult を返し、失敗・期限切れ時は CommandError / CommandTimeoutError を送出する。
+    """
+    if timeout is None:
+        timeout = SSM_COMMAND_TIMEOUT
+    if started is None:
+        started = clock()
+    deadline = started + timeout
+
+    result = CommandResult(command_id=command_id, instance_id=instance_id, status='Pending')
+    interval = POLL_INITIAL_INTERVAL
+
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            result.elapsed = clock() - started
+            raise CommandTimeoutError(
+                f'Command {command_id} did not finish within {timeout} seconds (last status: {result.status}).',
+                result)
+
+        sleep(current().timeout(min(interval, remaining), f'SSM command {command_id}'))
+        interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+        if poll_command(ssm_client, result):
+            break
+
+    result.elapsed = clock() - started
+    raise_for_status(result)
+    return result
+
+
+def run_fleet_script(ssm_client, instance_ids, commands, timeout=None, sleep=time.sleep, clock=time.monotonic,
+                     **send_kwargs):
+    """複数インスタンスに1回の send_command で送信し、list_command_invocations でまとめて待機する
+
+    ポーリングは1ページ(最大50インスタンス)毎に1回の API 呼び出しで済む。
+    戻り値はインスタンスID → CommandResult。失敗・期限切れでも例外は送出しないので ok を確認すること。
+    """
+    if timeout is None:
+        timeout = SSM_COMMAND_TIMEOUT
+    started = clock()
+    deadline = started + timeout
+
+    command_id = send_shell_script(ssm_client, list(instance_ids), commands, **send_kwargs)
+    results = {instance_id: CommandResult(command_id=command_id, instance_id=instance_id, status='Pending')
+               for instance_id in instance_ids}
+    pending = set(results)
+    interval = POLL_INITIAL_INTERVAL
+    polls = 0
+
+    while pending:
+        # Lambda の予算が尽きた場合も、終わっていないインスタンスは Pending のまま返す
+        remaining = min(deadline - clock(), current().budget())
+        if remaining <= 0:
+            break
+
+        sleep(min(interval, remaining))
+        interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+        polls += 1
+        # 1ページに載るのは最大50件なので、大きなフリートでは NextToken を辿る
+        pages = ssm_client.get_paginator('list_command_invocations').paginate(CommandId=command_id, Details=True)
+        for page in pages:
+            for invocation in page['CommandInvocations']:
+                instance_id = invocation['InstanceId']
+                if instance_id not in pending:
+                    continue
+                # Details=True の出力はプラグインごとに返る(AWS-RunShellScript は1つだけ)
+                plugins = invocation.get('CommandPlugins') or [{}]
+                invocation = dict(invocation,
+                                  StandardOutputContent=plugins[0].get('Output', ''),
+                                  ResponseCode=plugins[0].get('ResponseCode', -1))
+                if _update_result(results[instance_id], invocation):
+                    pending.discard(instance_id)
+
+    elapsed = clock() - started
+    for result in results.values():
+        result.elapsed = elapsed
+        result.polls = polls
+    print(f'[INFO] Command {command_id} finished on {len(results) - len(pending)}/{len(results)} instances '
+          f'in {elapsed:.2f} seconds, {polls} polls.')
+    return results
@@ -0,0 +1,92 @@
+"""マイクラのログ(logs/latest.log)から起動の内訳を取り出す(インスタンス上で実行する)
+
+ログを1行ずつ読み、節目の行の時刻から、次の節目までを1フェーズとする。
+- jvm: 最初の行(JVM 起動)から "Starting minecraft server version" まで
+- server: サーバーの初期化("Preparing level" またはプラグインの有効化まで)
+- level / spawn: ワールドの読み込みとスポーン周辺の準備("Preparing spawn area: N%" は進捗として記録)
+- plugin:<名前>: "[名前] Enabling 名前 vX" から次の節目まで
+- "Done (Xs)!" で終わり、X を total とする
+ログの時刻は秒単位なので、フェーズの長さも秒単位。ファイル全体をメモリに載せずに読む。
+
+    python3 startup_log.py /home/ec2-user/minecraft/logs/latest.log
+"""
+import json
+import re
+import sys
+
+SUMMARY_MARKER = 'PROFILE '
+MAX_PROGRESS = 20  # 記録するスポーン準備の進捗の数
+
+# vanilla: "[12:34:56] [Server thread/INFO]: ..." / Paper: "[12:34:56 INFO]: ..."
+LINE = re.compile(r'^\[(\d{2}):(\d{2}):(\d{2})[^\]]*\](?: \[[^\]]*\])?: (.*)$')
+MILESTONES = [
+    ('server', re.compile(r'Starting minecraft server version')),
+    ('level', re.compile(r'Preparing level "')),
+    ('spawn', re.compile(r'Preparing (?:start region|spawn area)')),
+    ('plugin', re.compile(r'^(?:\[[^\]]+\] )?Enabling (\S+) v')),
+]
+PROGRESS = re.compile(r'Preparing spawn area: (\d+)%')
+DONE = re.compile(r'Done \((\d+(?:\.\d+)?)s\)!')
+
+
+def parse(lines):
+    """行のイテラブルから起動の内訳(dict)を作る。Done が無ければ done=False"""
+    marks = []  # (フェーズ名, 秒)
+    progress = []
+    total = None
+    previous = None
+    offset = 0
+    seen = set()
+    for line in lines:
+        match = LINE.match(line.rstrip('\n'))
+        if not match:
+            continue
+        seconds = int(match[1]) * 3600 + int(match[2]) * 60 + int(match[3]) + offset
+        if previous is not None and seconds < previous - 43200:
+            # 日付をまたいだ(スレッドの違いによる数秒の前後は無視する)
+            offset += 86400
+            seconds += 86400
+        previous = seconds
+        message = match[4]
+
+        if not marks:
+            marks.append(('jvm', seconds))
+        done = DONE.search(message)
+        if done:
+            total = float(done[1])
+            marks.append(('done', seconds))
+            break
+        percent = PROGRESS.search(message)
+        if percent:
+            if len(progress) < MAX_PROGRESS:
+                progress.append([seconds - marks[0][1], int(percent[1])])
+            continue
+        for name, pattern in MILESTONES:
+            found = pattern.search(message)
+            if not found:
+                continue
+            if name == 'plugin':
+                name = f'plugin:{found[1]}'
+            if name not in seen:
+                seen.add(name)
+                marks.append((name, seconds))
+            break
+
+    phases = [[name, end - start] for (name, start), (_, end) in zip(marks, marks[1:])]
+    return {
+        'done': total is not None,
+        'total': total,
+        'wall': marks[-1][1] - marks[0][1] if marks else 0,
+        'phases': phases,
+        'spawn_progress': progress,
+    }
+
+
+def main():
+    with open(sys.argv[1], encoding='utf-8', errors='replace') as f:
+        print(SUMMARY_MARKER + json.dumps(parse(f), ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
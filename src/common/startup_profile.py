@@ -0,0 +1,145 @@
+"""起動の内訳(startup_log)の履歴と、遅くなったフェーズの検出
+
+起動の度に startup_log.py を SSM でインスタンスに送って latest.log を解析し、
+結果を1サーバー1オブジェクト(STATS_BUCKET の startup/<インスタンスID>.json)に直近 PROFILE_HISTORY 回分保存する。
+各フェーズを直近 BASELINE_STARTS 回の中央値と比べ、REGRESSION_RATIO 倍かつ REGRESSION_MIN_SECONDS 秒以上
+遅くなっていれば回帰とみなす。STATS_BUCKET が未設定の場合はプロセス内のメモリで代用する(ローカル実行用)。
+"""
+import base64
+import gzip
+import json
+import os
+import statistics
+import time
+
+import startup_log
+from clients import get_client
+
+STATS_BUCKET = os.getenv('STATS_BUCKET')
+STARTUP_LOG = os.getenv('STARTUP_LOG', '/home/ec2-user/minecraft/logs/latest.log')
+
+PROFILE_HISTORY = 30
+BASELINE_STARTS = 10
+BASELINE_MIN_STARTS = 3  # これより履歴が少ないフェーズは比べない
+REGRESSION_RATIO = 1.5
+REGRESSION_MIN_SECONDS = 5
+
+PHASE_NAMES = {
+    'jvm': "JVM",
+    'server': "サーバー",
+    'level': "ワールド",
+    'spawn': "スポーン準備",
+}
+
+
+class MemoryProfileStore:
+    def __init__(self):
+        self.objects = {}
+
+    def load(self, instance_id):
+        return self.objects.get(instance_id, [])
+
+    def save(self, instance_id, history):
+        self.objects[instance_id] = history
+
+
+class S3ProfileStore:
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self.client = client or get_client('s3')
+
+    def load(self, instance_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f'startup/{instance_id}.json')
+        except self.client.exceptions.NoSuchKey:
+            return []
+        return json.loads(response['Body'].read())
+
+    def save(self, instance_id, history):
+        self.client.put_object(Bucket=self.bucket, Key=f'startup/{instance_id}.json',
+                               Body=json.dumps(history, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+_store = None
+
+
+def get_profile_store():
+    global _store
+    if _store is None:
+        _store = S3ProfileStore(STATS_BUCKET) if STATS_BUCKET else MemoryProfileStore()
+    return _store
+
+
+def profile_commands(log_path=STARTUP_LOG):
+    """startup_log.py をインスタンスに送って log_path を解析するシェルスクリプト"""
+    with open(os.path.abspath(startup_log.__file__), 'rb') as f:
+        source = base64.b64encode(gzip.compress(f.read())).decode()
+    return [
+        f"echo {source} | base64 -d | gunzip > /tmp/startup_log.py",
+        f"python3 /tmp/startup_log.py {log_path}",
+    ]
+
+
+def parse_profile(stdout):
+    for line in stdout.splitlines():
+        if line.startswith(startup_log.SUMMARY_MARKER):
+            return json.loads(line[len(startup_log.SUMMARY_MARKER):])
+    return None
+
+
+def find_regressions(profile, history):
+    """(フェーズ, 今回の秒数, 基準の秒数) のリスト"""
+    regressions = []
+    for name, seconds in profile['phases']:
+        samples = [dict(entry['phases']).get(name) for entry in history[-BASELINE_STARTS:]]
+        samples = [value for value in samples if value is not None]
+        if len(samples) < BASELINE_MIN_STARTS:
+            continue
+        baseline = statistics.median(samples)
+        if seconds > baseline * REGRESSION_RATIO and seconds - baseline >= REGRESSION_MIN_SECONDS:
+            regressions.append((name, seconds, baseline))
+    return regressions
+
+
+def record_profile(instance_id, profile, store=None, now=None):
+    """今回の内訳を履歴に追加して保存し、履歴と比べて遅くなったフェーズを返す"""
+    if store is None:
+        store = get_profile_store()
+    if now is None:
+        now = time.time()
+
+    history = store.load(instance_id)
+    regressions = find_regressions(profile, history)
+    history.append({'at': int(now), 'total': profile['total'], 'phases': profile['phases']})
+    store.save(instance_id, history[-PROFILE_HISTORY:])
+    return regressions
+
+
+def phase_label(name):
+    if name.startswith('plugin:'):
+        return name[len('plugin:'):]
+    return PHASE_NAMES.get(name, name)
+
+
+def describe_profile(profile):
+    """通知用の内訳(プラグインはまとめて、最も遅いものだけ名前を出す)"""
+    parts = []
+    plugins = []
+    for name, seconds in profile['phases']:
+        if name.startswith('plugin:'):
+            plugins.append((seconds, phase_label(name)))
+        else:
+            parts.append(f"{phase_label(name)} {seconds}秒")
+    if plugins:
+        slowest = max(plugins)
+        parts.append(f"プラグイン{len(plugins)}個 {sum(seconds for seconds, _ in plugins)}秒 "
+                     f"(最長: {slowest[1]} {slowest[0]}秒)")
+    line = " / ".join(parts)
+    if profile['total'] is not None:
+        line += f"\nマイクラの起動: {profile['total']:.1f}秒"
+    return line
+
+
+def describe_regressions(regressions):
+    return "\n".join(f"{phase_label(name)}: {seconds}秒 (いつもは {baseline:.0f}秒)"
+                     for name, seconds, baseline in regressions)
@@ -0,0 +1,199 @@
+"""インスタンス状態のキャッシュ
+
+EC2 の状態変更イベントとワーカーの describe_instances の結果で更新し、
+/status などは describe_instances を呼ばずにここから答える。
+古いエントリ(遷移中の状態は TRANSITION_MAX_AGE、それ以外は STATE_MAX_AGE 秒)だけ実際に問い合わせる。
+STATE_TABLE が未設定の場合はプロセス内のメモリで代用する(ローカル実行用)。
+"""
+import datetime
+import os
+import threading
+import time
+
+from clients import get_client
+
+STATE_TABLE = os.getenv('STATE_TABLE')
+STATE_MAX_AGE = int(os.getenv('STATE_MAX_AGE', '3600'))  # running/stopped を信用する秒数
+TRANSITION_MAX_AGE = 120  # pending/stopping などの遷移中の状態を信用する秒数
+
+STABLE_STATES = ('running', 'stopped')
+
+# キャッシュに保持する項目
+FIELDS = ('state', 'public_ip', 'changed_at', 'updated_at', 'players', 'players_at', 'start_mode', 'start_seconds')
+
+
+def is_fresh(record, now):
+    if record is None or record.get('state') is None:
+        return False
+    max_age = STATE_MAX_AGE if record['state'] in STABLE_STATES else TRANSITION_MAX_AGE
+    return now - record['updated_at'] <= max_age
+
+
+class MemoryStateStore:
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def get_many(self, instance_ids):
+        with self.lock:
+            return {instance_id: dict(self.records[instance_id])
+                    for instance_id in instance_ids if instance_id in self.records}
+
+    def update(self, instance_id, fields, changed_at=None):
+        with self.lock:
+            record = self.records.setdefault(instance_id, {'instance_id': instance_id})
+            # 到着順が前後した古いイベントでは上書きしない
+            if changed_at is not None and record.get('changed_at', 0) > changed_at:
+                return False
+            record.update(fields)
+            return True
+
+
+class DynamoStateStore:
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or get_client('dynamodb')
+
+    def get_many(self, instance_ids):
+        if not instance_ids:
+            return {}
+        response = self.client.batch_get_item(
+            RequestItems={
+                self.table_name: {
+                    'Keys': [{'instance_id': {'S': instance_id}} for instance_id in instance_ids]
+                }
+            }
+        )
+        items = response['Responses'].get(self.table_name, [])
+        return {item['instance_id']['S']: self._from_item(item) for item in items}
+
+    def update(self, instance_id, fields, changed_at=None):
+        names = {f'#{key}': key for key in fields}
+        values = {f':{key}': self._to_value(value) for key, value in fields.items()}
+        kwargs = {}
+        if changed_at is not None:
+            # 到着順が前後した古いイベントでは上書きしない
+            kwargs['ConditionExpression'] = 'attribute_not_exists(changed_at) OR changed_at <= :event_at'
+            values[':event_at'] = {'N': str(changed_at)}
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'instance_id': {'S': instance_id}},
+                UpdateExpression='SET ' + ', '.join(f'#{key} = :{key}' for key in fields),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                **kwargs
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    @staticmethod
+    def _to_value(value):
+        if value is None:
+            return {'NULL': True}
+        if isinstance(value, (int, float)):
+            return {'N': str(value)}
+        return {'S': value}
+
+    @staticmethod
+    def _from_item(item):
+        record = {'instance_id': item['instance_id']['S']}
+        for key in FIELDS:
+            value = item.get(key)
+            if value is None or 'NULL' in value:
+                record[key] = None
+            elif 'N' in value:
+                record[key] = float(value['N'])
+            else:
+                record[key] = value['S']
+        return record
+
+
+_store = None
+_recorded = {}  # インスタンスID → 最後に書き込んだ (state, public_ip, 時刻)。変化が無ければしばらく書き込まない
+
+
+def get_state_store():
+    global _store
+    if _store is None:
+        _store = DynamoStateStore(STATE_TABLE) if STATE_TABLE else MemoryStateStore()
+    return _store
+
+
+def record_instance(instance, store=None, now=None):
+    """describe_instances の Instances 要素でキャッシュを更新する(失敗しても呼び出し元は止めない)"""
+    if now is None:
+        now = time.time()
+    instance_id = instance['InstanceId']
+    state = instance['State']['Name']
+    public_ip = instance.get('PublicIpAddress')
+    recorded = _recorded.get(instance_id)
+    if recorded and recorded[:2] == (state, public_ip) and now - recorded[2] < TRANSITION_MAX_AGE:
+        return
+
+    fields = {'state': state, 'public_ip': public_ip, 'updated_at': now}
+    try:
+        (store or get_state_store()).update(instance_id, fields)
+        _recorded[instance_id] = (state, public_ip, now)
+    except Exception as error:
+        print(f'[WARN] Could not update state cache for {instance_id}: {error}')
+
+
+def record_transition(instance_id, state, changed_at, public_ip=None, store=None, now=None):
+    """状態変更イベントでキャッシュを更新する。古いイベントなら False を返す"""
+    if now is None:
+        now = time.time()
+    fields = {'state': state, 'changed_at': changed_at, 'updated_at': now}
+    if public_ip is not None or state not in ('pending', 'running'):
+        fields['public_ip'] = public_ip  # 停止するとパブリックIPは解放される
+    _recorded.pop(instance_id, None)
+    return (store or get_state_store()).update(instance_id, fields, changed_at=changed_at)
+
+
+def record_players(instance_id, players, store=None, now=None):
+    if now is None:
+        now = time.time()
+    try:
+        (store or get_state_store()).update(instance_id, {'players': players, 'players_at': now})
+    except Exception as error:
+        print(f'[WARN] Could not update player count for {instance_id}: {error}')
+
+
+def record_start(instance_id, mode, seconds, store=None):
+    """起動要求から遊べるようになるまでの秒数を、起動方法(boot/hibernate)と一緒に記録する"""
+    print(f'[INFO] Start to ready: {seconds:.1f} seconds ({mode}).')
+    try:
+        (store or get_state_store()).update(instance_id, {'start_mode': mode, 'start_seconds': seconds})
+    except Exception as error:
+        print(f'[WARN] Could not record start time for {instance_id}: {error}')
+
+
+def get_states(instance_ids, store=None, now=None, refresh=True):
+    """キャッシュからインスタンス状態を取得する
+
+    古いエントリは refresh=True なら1回の describe_instances でまとめて取得し直す。
+    戻り値はインスタンスID → レコード(FIELDS の各項目)。
+    """
+    if store is None:
+        store = get_state_store()
+    if now is None:
+        now = time.time()
+
+    records = store.get_many(list(instance_ids))
+    stale = [instance_id for instance_id in instance_ids if not is_fresh(records.get(instance_id), now)]
+    if stale and refresh:
+        print(f'[INFO] State cache miss: {", ".join(stale)}')
+        response = get_client('ec2').describe_instances(InstanceIds=stale)
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                record_instance(instance, store, now)
+        records.update(store.get_many(stale))
+    return records
+
+
+def parse_state_change_event(event):
+    """EC2 Instance State-change Notification を (インスタンスID, 状態, 発生時刻) に変換する"""
+    detail = event['detail']
+    changed_at = datetime.datetime.fromisoformat(event['time'].replace('Z', '+00:00')).timestamp()
+    return detail['instance-id'], detail['state'], changed_at
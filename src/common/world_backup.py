@@ -0,0 +1,209 @@
+"""ワールドの増分バックアップ(インスタンス上で実行する)
+
+ワールドのファイル(大半はリージョンファイル .mca)を CHUNK_SIZE 毎に読んで SHA-256 を取り、
+まだ S3 に無いチャンクだけを chunks/<ハッシュ> に並列でアップロードする。
+スナップショット毎に、ファイル → チャンクのハッシュ列を書いたマニフェストを manifests/<時刻>.json.gz に置き、
+任意のマニフェストからその時点のワールドを復元できる。
+前回のマニフェストとサイズ・更新時刻が同じファイルは読まずにハッシュを使い回すので、
+保存されたリージョンだけを読み、変わったチャンクだけを送る。
+
+Lambda からは backup_commands() で、このファイル自体を SSM のシェルスクリプトに埋め込んで送る。
+インスタンスには python3 と boto3、BACKUP_BUCKET への読み書き権限(インスタンスプロファイル)が必要。
+
+    python3 world_backup.py backup --bucket B --prefix P --world DIR
+    python3 world_backup.py restore --bucket B --prefix P --world DIR [--at 20250101T000000Z]
+    python3 world_backup.py list --bucket B --prefix P
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKUP_BUCKET = os.getenv('BACKUP_BUCKET')
+BACKUP_ON_STOP = os.getenv('BACKUP_ON_STOP', 'false').lower() == 'true'  # 停止の前(マイクラ終了後)にバックアップする
+WORLD_DIR = os.getenv('WORLD_DIR', '/home/ec2-user/minecraft/world')
+BACKUP_TIMEOUT = float(os.getenv('BACKUP_TIMEOUT', '300'))  # バックアップの上限(秒)
+
+CHUNK_SIZE = 1024 * 1024  # リージョンファイルのセクタ(4KiB)の倍数
+UPLOAD_WORKERS = 8
+SUMMARY_MARKER = 'BACKUP '
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%SZ'
+
+
+def chunk_key(prefix, digest):
+    return f'{prefix}/chunks/{digest[:2]}/{digest}'
+
+
+def list_snapshots(s3, bucket, prefix):
+    """マニフェストのキーを古い順に返す"""
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f'{prefix}/manifests/'):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return sorted(keys)
+
+
+def load_manifest(s3, bucket, key):
+    return json.loads(gzip.decompress(s3.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+
+def scan(world_dir, previous, chunk_size=CHUNK_SIZE):
+    """ファイル毎のチャンクのハッシュと、読んだチャンクの (ハッシュ → (パス, 位置, 長さ))"""
+    files = {}
+    read = {}
+    for root, _, names in os.walk(world_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, world_dir)
+            stat = os.stat(path)
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            old = previous.get(relative)
+            if old and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns'] and \
+                    old.get('chunk_size', chunk_size) == chunk_size:
+                entry['chunks'] = old['chunks']
+            else:
+                entry['chunks'] = []
+                with open(path, 'rb') as f:
+                    offset = 0
+                    # インスタンスの python3 は 3.7(Amazon Linux 2)なので代入式は使わない
+                    for data in iter(lambda: f.read(chunk_size), b''):
+                        digest = hashlib.sha256(data).hexdigest()
+                        entry['chunks'].append(digest)
+                        read.setdefault(digest, (path, offset, len(data)))
+                        offset += len(data)
+            entry['chunk_size'] = chunk_size
+            files[relative] = entry
+    return files, read
+
+
+def backup(s3, bucket, prefix, world_dir, chunk_size=CHUNK_SIZE, workers=UPLOAD_WORKERS, now=None):
+    """now: スナップショットの時刻(省略時は現在時刻)"""
+    started = time.monotonic()
+    snapshots = list_snapshots(s3, bucket, prefix)
+    previous = load_manifest(s3, bucket, snapshots[-1])['files'] if snapshots else {}
+    known = {digest for entry in previous.values() for digest in entry['chunks']}
+
+    files, read = scan(world_dir, previous, chunk_size)
+    missing = {digest: location for digest, location in read.items() if digest not in known}
+
+    def upload(item):
+        digest, (path, offset, length) = item
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError(f'{path} changed during the backup')
+        s3.put_object(Bucket=bucket, Key=chunk_key(prefix, digest), Body=data)
+        return length
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploaded = sum(executor.map(upload, missing.items()))
+
+    snapshot = time.strftime(SNAPSHOT_FORMAT, time.gmtime(time.time() if now is None else now))
+    key = f'{prefix}/manifests/{snapshot}.json.gz'
+    manifest = {'snapshot': snapshot, 'files': files}
+    s3.put_object(Bucket=bucket, Key=key, Body=gzip.compress(json.dumps(manifest, separators=(',', ':')).encode()))
+    return {
+        'manifest': key,
+        'files': len(files),
+        'bytes': sum(entry['size'] for entry in files.values()),
+        'read_bytes': sum(length for _, _, length in read.values()),
+        'uploaded_chunks': len(missing),
+        'uploaded_bytes': uploaded,
+        'seconds': round(time.monotonic() - started, 1),
+    }
+
+
+def restore(s3, bucket, prefix, world_dir, at=None, workers=UPLOAD_WORKERS):
+    """at(SNAPSHOT_FORMAT)以前で最新のスナップショットで world_dir を置き換える
+
+    隣のディレクトリに書き出してから入れ替えるので、スナップショットに無いファイルは残らず、
+    途中で失敗しても world_dir はそのまま。
+    """
+    snapshots = [key for key in list_snapshots(s3, bucket, prefix)
+                 if at is None or os.path.basename(key).split('.')[0] <= at]
+    if not snapshots:
+        raise RuntimeError(f'No snapshot in s3://{bucket}/{prefix} at {at}')
+    manifest = load_manifest(s3, bucket, snapshots[-1])
+
+    def fetch(digest):
+        data = s3.get_object(Bucket=bucket, Key=chunk_key(prefix, digest))['Body'].read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError(f'Chunk {digest} is corrupted')
+        return data
+
+    world_dir = os.path.abspath(world_dir)
+    staging = f'{world_dir}.restoring'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for relative, entry in manifest['files'].items():
+            path = os.path.join(staging, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                for data in executor.map(fetch, entry['chunks']):
+                    f.write(data)
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+    if os.path.exists(world_dir):
+        shutil.rmtree(world_dir)
+    os.rename(staging, world_dir)
+    return {'manifest': snapshots[-1], 'files': len(manifest['files'])}
+
+
+def describe_summary(summary):
+    mb = 1024 * 1024
+    return (f"{summary['uploaded_bytes'] / mb:.1f} MB / {summary['bytes'] / mb:.0f} MB 転送, "
+            f"{summary['seconds']:.0f}秒")
+
+
+def backup_commands(bucket, prefix, world_dir=WORLD_DIR):
+    """このファイルをインスタンスに送って backup を実行するシェルスクリプト"""
+    with open(os.path.abspath(__file__), 'rb') as f:
+        source = base64.b64encode(gzip.compress(f.read())).decode()
+    return [
+        f"echo {source} | base64 -d | gunzip > /tmp/world_backup.py",
+        # バケット名・プレフィックス・パスは設定値なので、シェルに解釈させない
+        f"python3 /tmp/world_backup.py backup --bucket {shlex.quote(bucket)} --prefix {shlex.quote(prefix)} "
+        f"--world {shlex.quote(world_dir)}",
+    ]
+
+
+def parse_summary(stdout):
+    """backup の出力から結果の dict を取り出す"""
+    for line in stdout.splitlines():
+        if line.startswith(SUMMARY_MARKER):
+            return json.loads(line[len(SUMMARY_MARKER):])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['backup', 'restore', 'list'])
+    parser.add_argument('--bucket', default=BACKUP_BUCKET)
+    parser.add_argument('--prefix', required=True)
+    parser.add_argument('--world', default=WORLD_DIR)
+    parser.add_argument('--at', help=f'restore: この時刻({SNAPSHOT_FORMAT})以前で最新のスナップショット')
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS)
+    parser.add_argument('--endpoint-url', help='S3 互換のローカル環境(MinIO など)')
+    args = parser.parse_args()
+
+    import boto3
+    s3 = boto3.client('s3', endpoint_url=args.endpoint_url)
+    if args.command == 'backup':
+        print(SUMMARY_MARKER + json.dumps(backup(s3, args.bucket, args.prefix, args.world, workers=args.workers)))
+    elif args.command == 'restore':
+        print(json.dumps(restore(s3, args.bucket, args.prefix, args.world, args.at, args.workers)))
+    else:
+        print('\n'.join(list_snapshots(s3, args.bucket, args.prefix)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,210 +1,258 @@
-import json
-import os
-import time
-import requests
 import datetime
-import pytz
-
-import boto3
-
-EC2_INSTANCE_ID = os.getenv('EC2_INSTANCE_ID')
-
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-COMMAND_CHANNEL_ID = os.getenv('COMMAND_CHANNEL_ID')
-STACK_NAME = os.getenv('STACK_NAME')
-
-DISCORD_ENDPOINT = f"https://discordapp.com/api/channels/{COMMAND_CHANNEL_ID}/messages"
+import time
+from zoneinfo import ZoneInfo
+
+import metrics
+from clients import get_client
+from deadline import Deadline, activate
+from discord_message import COLOR_ERROR, COLOR_SUCCESS, edit_original_response, flush_messages, queue_message
+from fleet import SERVERS, describe_servers, run_concurrently, server_label
+from hibernation import can_hibernate, hibernate_instance
+from minecraft_stop import stop_minecraft
+from monitor_schedule import MONITOR_CADENCE, MONITOR_INTERVAL, next_check_seconds, next_delay, schedule_monitoring
+from operation_lock import ACQUIRED, acquire_operation, release_operation
+from play_schedule import IDLE_MAX_MINUTES, build_profile, idle_limit_minutes
+from player_probe import confirm_idle, probe_fleet
+from player_stats import record_sample
+from right_sizing import INSTANCE_LADDER, record_starved, starved_reason
+from ssm_command import run_shell_script
+from state_cache import record_players
+from world_backup import BACKUP_BUCKET, BACKUP_ON_STOP, BACKUP_TIMEOUT, backup_commands, parse_summary
+
+TOKYO_TIMEZONE = ZoneInfo('Asia/Tokyo')
 
 MAINTENANCE_START_TIME = datetime.time(5, 0, 0)  # メンテナンス開始時間
 MAINTENANCE_END_TIME = datetime.time(5, 59, 59)  # メンテナンス終了時間
 
+ACTIVE_STATES = ('pending', 'running')  # 監視を続ける必要があるインスタンスの状態
+
 
 def lambda_handler(event, context):
+    # 停止待ち・問い合わせは Lambda の残り時間内で打ち切る(停止の通知は予備の時間で送る)
+    activate(Deadline.from_lambda_context(context))
+    metrics.use('monitor')
+    started = time.perf_counter()
+    checks = {}  # サーバー名 → 次に確認するまでの秒数
+    # 途中で Lambda が強制終了しても監視が途切れないように、先に従来の間隔で次の監視を設定しておく
     try:
-        dt_now = datetime.datetime.now()  # 現時刻
-
-        # インスタンスのステータスを取得
-        region = os.environ['AWS_REGION']
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(EC2_INSTANCE_ID)
-        status_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-
-        ec2_status = status_response['Reservations'][0]['Instances'][0]['State']['Name']
-        print('[INFO] Instance Status:' + str(ec2_status))
+        reschedule_monitoring(event, [MONITOR_INTERVAL])
+    except Exception as error:
+        print('[ERROR] ' + str(error))
 
-        if ec2_status != "running":
-            # 起動していなければチェックしない
-            return 0
+    try:
+        # 全サーバーのステータスを1回で取得
+        with metrics.timed('describe'):
+            instances = describe_servers()
+        for name, instance in instances.items():
+            print(f"[INFO] Instance Status: {name} {instance['State']['Name']}")
+
+        running = {name: instance for name, instance in instances.items() if instance['State']['Name'] == 'running'}
+
+        # 東京タイムゾーンの日時を取得
+        tokyo_now = datetime.datetime.now(TOKYO_TIMEZONE)
+        tokyo_time = tokyo_now.time()
+
+        # メンテナンス時間内なら全サーバーをシャットダウン
+        if (MAINTENANCE_START_TIME < tokyo_time) & (MAINTENANCE_END_TIME > tokyo_time):
+            send_title = '\N{WARNING SIGN} メンテナンス開始したので、サーバー停止しました'
+            send_msg = f'{MAINTENANCE_START_TIME}～{MAINTENANCE_END_TIME}はメンテナンス中です \N{PERSON BOWING DEEPLY} '
+            targets = list(running)
         else:
-            # 東京タイムゾーンの日時を取得
-            tokyo_now = datetime.datetime.now(pytz.timezone('Asia/Tokyo'))
-            tokyo_time = tokyo_now.time()
-
-            # メンテナンス時間内ならec2をシャットダウン
-            if (MAINTENANCE_START_TIME < tokyo_time) & (MAINTENANCE_END_TIME > tokyo_time):
-                send_title = '\N{WARNING SIGN} メンテナンス開始したので、サーバー停止しました'
-                send_msg = f'{MAINTENANCE_START_TIME}～{MAINTENANCE_END_TIME}はメンテナンス中です \N{PERSON BOWING DEEPLY} '
-
-                # マイクラ終了
-                shutdown_ec2(ec2_client, send_title, send_msg)
-
-                return 0
-
-            # マイクラサーバー監視ログを取得する為のコマンドを実行
-            ssm_client = boto3.client('ssm')
-            ssm_response = ssm_client.send_command(
-                InstanceIds=[EC2_INSTANCE_ID],
-                DocumentName="AWS-RunShellScript",
-                Parameters={
-                    "commands":
-                        [
-                            "uptime -s",  # 起動時間
-                            "who -q",  # ec2にログイン中のユーザー情報
-                            "cat /home/ec2-user/minecraft/plugins/Zabbigot/status.json"  # マイクラサーバーを監視ログ
-                        ]
-                },
-                CloudWatchOutputConfig={
-                    "CloudWatchLogGroupName": "minecraft_server_logs",
-                    "CloudWatchOutputEnabled": True
-                },
-                TimeoutSeconds=60
-            )
-            command_id = ssm_response['Command']['CommandId']
-
-            # 開始スクリプトの実行状況を確認
-            time.sleep(2)
-            command_invocation_result = \
-                ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-            status = command_invocation_result['Status']
-
-            if status == "Failed":
-                raise Exception('Failed Started Command.')
-            elif status == "TimedOut":
-                raise TimeoutError('Timeout Started Command.')
-
-            # 監視ログを取得
-            logs_client = boto3.client('logs')
-            logs_response = logs_client.describe_log_streams(
-                logGroupName='minecraft_server_logs',
-                orderBy='LastEventTime',
-                descending=True,
-            )
-
-            stream_list = []
-            for stream in logs_response['logStreams']:
-                stream_list.append(stream['logStreamName'])
-
-            print(stream_list)
-
-            logs = logs_client.get_log_events(
-                logGroupName="minecraft_server_logs",
-                logStreamName=stream_list[0],
-                startFromHead=True
-            )
-
-            logs_message = logs['events'][0]['message']
-            log_list = logs_message.splitlines()
-
-            # ec2起動日時
-            dt_uptime = datetime.datetime.strptime(log_list[0], '%Y-%m-%d %H:%M:%S')
-
-            # 起動時間(分)を取得
-            delta = dt_now - dt_uptime
-            m_delta = int(delta.seconds / 60)
-
-            # ec2にログイン中のユーザー数
-            login_user_cnt = int(log_list[2].replace('# users=', ''))
-
-            # マイクラログ
-            minecraft_log = json.loads(log_list[3])
-            minecraft_login_user_cnt = int(minecraft_log['user'])
-
-            '''
-            以下の条件を満たす場合、ec2をシャットダウンする
-            
-            1.ec2の起動時間が30分以上
-            2.ec2のログイン人数が0人
-            3.マイクラのログイン人数が0人
-            '''
-            if (m_delta > 30) & (login_user_cnt == 0) & (minecraft_login_user_cnt == 0):
-                send_title = '\N{WHITE HEAVY CHECK MARK} サーバー自動停止しました'
-                send_msg = 'お疲れ様！'
-
-                # マイクラ終了
-                shutdown_ec2(ec2_client, send_title, send_msg)
+            send_title = '\N{WHITE HEAVY CHECK MARK} サーバー自動停止しました'
+            send_msg = 'お疲れ様！'
+            targets = idle_servers(running, checks)
+
+        # マイクラ終了(並列に停止する)
+        results = run_concurrently(
+            lambda name: shutdown_ec2(name, running[name], send_title, send_msg), targets)
+        stopped = [name for name, result in results.items() if result is True]
+
+        # 停止の通知は1つのメッセージにまとめて投稿する
+        flush_messages()
+
+        # 動いているサーバーが無くなったら監視イベントを無効化
+        active = [name for name, instance in instances.items()
+                  if instance['State']['Name'] in ACTIVE_STATES and name not in stopped]
+        if not active:
+            disable_monitoring(event)
+        else:
+            # 問い合わせていない(起動中・停止に失敗した)サーバーは従来の間隔で確認する
+            reschedule_monitoring(event, [checks.get(name, MONITOR_INTERVAL) for name in active])
 
         return 0
 
     except Exception as error:
+        # 次の監視は最初に設定した従来の間隔のまま
         print('[ERROR] ' + str(error))
         return 0
 
+    finally:
+        metrics.record('tick', time.perf_counter() - started)
+        metrics.flush()
+
+
+def idle_servers(running, checks):
+    """停止するサーバー名のリスト。停止しないサーバーは checks に次に確認するまでの秒数を入れる"""
+    if not running:
+        return []
+
+    # 起動時間とログイン人数を取得(利用可能な最も安いバックエンドでまとめて問い合わせる)
+    with metrics.timed('probe'):
+        probes = probe_fleet(running)
+    for name, probe in probes.items():
+        record_players(running[name]['InstanceId'], probe.minecraft_login_user_cnt)
+    if INSTANCE_LADDER:
+        record_starved_servers(running, probes)
+
+    # ログイン人数の時系列に追記する(サーバー毎に別オブジェクトなので並列に書き込む)
+    now = time.time()
+    with metrics.timed('record_stats'):
+        series = run_concurrently(lambda name: record_sample(running[name]['InstanceId'],
+                                                             probes[name].minecraft_login_user_cnt,
+                                                             probes[name].login_user_cnt, now=now), list(probes))
+
+    '''
+    以下の条件を満たすサーバーをシャットダウンする
+
+    1.ec2の起動時間が、今の時間帯の上限以上
+      (よく遊ぶ時間帯は IDLE_MAX_MINUTES、誰も遊ばない時間帯は IDLE_MIN_MINUTES)
+    2.ec2のログイン人数が0人
+    3.マイクラのログイン人数が0人
+    '''
+    limits = {}
+    for name in probes:
+        if isinstance(series[name], Exception):
+            # 履歴が読めなければ従来通りの上限にする
+            limits[name] = IDLE_MAX_MINUTES
+        else:
+            limits[name] = idle_limit_minutes(build_profile(series[name], now), now)
+
+    # rcon/ping で無人に見えたサーバーは、ec2 のログインユーザー数と OS の起動時間を SSM で確かめてから停止する
+    candidates = [name for name, probe in probes.items() if is_idle(probe, limits[name])]
+    if candidates:
+        with metrics.timed('confirm'):
+            confirmed = confirm_idle({name: running[name] for name in candidates}, probes)
+        for name, result in confirmed.items():
+            if isinstance(result, Exception):
+                print(f'[WARN] Could not confirm that {name} is idle, not stopping it: {result}')
+                checks[name] = MONITOR_INTERVAL
+                del probes[name]
+            else:
+                probes[name] = result
+
+    targets = []
+    for name, probe in probes.items():
+        players = probe.login_user_cnt + probe.minecraft_login_user_cnt
+        if players == 0:
+            print(f'[INFO] Idle {name}: up {probe.uptime_minutes}/{limits[name]:.0f} minutes')
+        if is_idle(probe, limits[name]):
+            targets.append(name)
+            continue
+        checks[name] = next_check_seconds(players, probe.uptime_minutes, limits[name])
+    return targets
+
+
+def is_idle(probe, limit):
+    return probe.login_user_cnt + probe.minecraft_login_user_cnt == 0 and probe.uptime_minutes > limit
+
+
+def record_starved_servers(running, probes):
+    # TPS やメモリが足りていなければ、次の起動で1つ大きいタイプになるように記録する
+    for name, probe in probes.items():
+        reason = starved_reason(probe)
+        if reason is None or not probe.minecraft_login_user_cnt:
+            continue
+        instance = running[name]
+        print(f"[WARN] Starved {name}: {reason} with {probe.minecraft_login_user_cnt} players "
+              f"on {instance.get('InstanceType')}")
+        try:
+            record_starved(instance['InstanceId'], instance.get('InstanceType'), probe.minecraft_login_user_cnt)
+        except Exception as error:
+            print(f'[WARN] Could not record the starved session: {name} {error}')
+
+
+def shutdown_ec2(name, instance, send_title, send_msg):
+    with metrics.timed('shutdown', server=name):
+        return _shutdown_ec2(name, instance, send_title, send_msg)
+
+
+def _shutdown_ec2(name, instance, send_title, send_msg):
+    """停止したら True。起動・再起動・バックアップなどの操作中なら停止せず False(次の監視で確認し直す)"""
+    instance_id = instance['InstanceId']
+    state, operation = acquire_operation(instance_id, 'stop')
+    if state != ACQUIRED:
+        print(f"[INFO] Skipped shutdown of {name}: {operation['operation']} is in progress.")
+        return False
+
+    result = {'title': '\N{cross mark} サーバー停止失敗！', 'msg': '管理者に問い合わせてね', 'color': COLOR_ERROR}
+    try:
+        _stop_server(name, instance, send_title, send_msg)
+        result = {'title': send_title + server_label(name), 'msg': send_msg, 'color': COLOR_SUCCESS}
+        return True
+    finally:
+        # 停止中に /stop で合流したユーザーにも結果を返す
+        for waiter in release_operation(operation, result):
+            edit_original_response(waiter, result['title'], result['msg'], result['color'])
+
+
+def _stop_server(name, instance, send_title, send_msg):
+    instance_id = instance['InstanceId']
+
+    # 休止できれば、マイクラを止めずにメモリごと休止する(できなければ通常の停止)
+    if can_hibernate(instance):
+        try:
+            hibernate_instance(get_client('ec2'), instance_id, instance['PublicIpAddress'])
+            queue_message(send_title + server_label(name), send_msg)
+            return
+        except Exception as error:
+            print(f'[WARN] Hibernation failed, falling back to stop: {error}')
+
+    # マイクラ終了(終了を検知するまで待機)
+    stop_minecraft(get_client('ssm'), instance_id, host=instance.get('PublicIpAddress'))
+    print(f'[INFO] Successfully Stopped Minecraft: {name}')
+
+    # ワールドのバックアップ(失敗しても停止は続ける)
+    if BACKUP_ON_STOP and BACKUP_BUCKET:
+        try:
+            with metrics.timed('backup', server=name):
+                result = run_shell_script(get_client('ssm'), instance_id, backup_commands(BACKUP_BUCKET, instance_id),
+                                          timeout=BACKUP_TIMEOUT, execution_timeout=BACKUP_TIMEOUT)
+            print(f'[INFO] Backup finished: {name} {parse_summary(result.stdout)}')
+        except Exception as error:
+            print(f'[WARN] Backup failed, continuing: {name} {error}')
 
-def shutdown_ec2(ec2_client, send_title, send_msg):
-    # マイクラ終了
-    ssm_client = boto3.client('ssm')
-    ssm_response = ssm_client.send_command(
-        InstanceIds=[EC2_INSTANCE_ID],
-        DocumentName="AWS-RunShellScript",
-        Parameters={
-            "commands": ["cd /home/ec2-user/minecraft/", "sh Minecraft_stop.sh"]
-        }
-    )
+    # EC2停止
+    get_client('ec2').stop_instances(InstanceIds=[instance_id])
+    print('[INFO] Successfully Stopped Instance: ' + str(instance_id))
 
-    # コマンドIDを取得
-    command_id = ssm_response['Command']['CommandId']
+    queue_message(send_title + server_label(name), send_msg)
 
-    # 終了スクリプトの実行状況を確認
-    time.sleep(2)
-    command_invocation_result = \
-        ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-    status = command_invocation_result['Status']
 
-    if status == "Failed":
-        raise Exception('Failed Stopped Minecraft.')
-    elif status == "TimedOut":
-        raise TimeoutError('Timeout Stopped Minecraft.')
-    else:
-        print('[INFO] Successfully Stopped Minecraft.')
+def monitoring_rule(event):
+    # 呼び出し元のルールから監視イベント名を取得(templateから参照するとリソース間の循環依存関係が発生)
+    resources = event.get('resources') or []
+    if not resources:
+        print('[INFO] Not invoked by a schedule rule, monitoring schedule is unchanged.')
+        return None
+    return resources[0].split('/')[-1]
 
-    # マイクラが完了するまで待機
-    time.sleep(55)
 
-    # EC2停止
-    response = ec2_client.stop_instances(InstanceIds=[EC2_INSTANCE_ID])
-    print('[INFO] Successfully Stopped Instance: ' + str(EC2_INSTANCE_ID))
+def reschedule_monitoring(event, checks):
+    # 次の監視の時刻を、サーバー毎の確認したい時刻のうち最も早いものにする
+    if MONITOR_CADENCE != 'adaptive':
+        return
+    event_name = monitoring_rule(event)
+    if event_name:
+        schedule_monitoring(event_name, next_delay(checks))
 
-    events_client = boto3.client('events')
 
-    # 監視イベント名を取得(templateからテンプレートを取得するとリソース間の循環依存関係が発生)
-    response = events_client.list_rules(
-        NamePrefix=STACK_NAME,
-        Limit=1
-    )
-    event_name = response['Rules'][0]['Name']
+def disable_monitoring(event):
+    event_name = monitoring_rule(event)
+    if not event_name:
+        return
 
     # EC2監視イベントの無効化
-    response = events_client.disable_rule(
+    get_client('events').disable_rule(
         Name=event_name
     )
-
-    send_message(send_title, send_msg)
-
-
-def send_message(title, msg, color=5763719):
-    body = {
-        "embeds": [
-            {
-                "title": title,
-                "description": msg,
-                "color": color
-            }
-        ]
-    }
-
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-    }
-
-    response = requests.post(DISCORD_ENDPOINT, json=body, headers=headers)
-    print('[INFO] Send Message:' + str(response))
+    print(f'[INFO] No server is running ({len(SERVERS)} registered), disabled {event_name}.')
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+from clients import get_client
+from fleet import SERVERS
+from operation_lock import ACQUIRED, acquire_operation, release_operation
+from play_schedule import build_profile, should_prewarm
+from player_stats import load_series
+from state_cache import get_states
+
+PROFILE_REFRESH = 3600  # 学習結果を使い回す秒数
+
+_profiles = {}  # インスタンスID → (学習した時刻, 曜日×時間帯毎の割合)
+
+
+def lambda_handler(event, context):
+    try:
+        now = time.time()
+        states = get_states(list(SERVERS.values()))
+
+        for name, instance_id in SERVERS.items():
+            if (states.get(instance_id) or {}).get('state') != 'stopped':
+                continue
+            if not should_prewarm(get_profile(instance_id, now), now):
+                continue
+
+            print(f'[INFO] Prewarm {name}: play window starts soon.')
+            start_server(name, instance_id)
+
+        return 0
+
+    except Exception as error:
+        print('[ERROR] ' + str(error))
+        return 0
+
+
+def get_profile(instance_id, now):
+    # 学習前の None もキャッシュし、PROFILE_REFRESH 毎に作り直す
+    built_at, profile = _profiles.get(instance_id, (0, None))
+    if now - built_at > PROFILE_REFRESH:
+        profile = build_profile(load_series(instance_id), now)
+        _profiles[instance_id] = (now, profile)
+    return profile
+
+
+def start_server(name, instance_id):
+    # 手動の操作と同じく操作ロックを取ってから起動ワーカーに任せる(結果はチャンネルに投稿される)
+    state, operation = acquire_operation(instance_id, 'start')
+    if state != ACQUIRED:
+        return
+
+    worker_operation = {
+        "instance_id": operation['instance_id'],
+        "operation_id": operation['operation_id']
+    }
+    try:
+        get_client('lambda').invoke(
+            FunctionName=os.getenv('START_EC2_LAMBDA_FUNCTION'),
+            InvocationType='Event',
+            Payload=json.dumps({
+                "action": "start",
+                "server": name,
+                "interaction": None,
+                "operation": worker_operation
+            })
+        )
+    except Exception:
+        release_operation(worker_operation, {})
+        raise
@@ -1,148 +1,160 @@
-import json
 import os
-import time
-import requests
 
-import boto3
+from clients import get_client
+from discord_message import COLOR_ERROR, COLOR_WARNING
+from fleet import DEFAULT_SERVER, resolve_server, server_label
+from operation_lock import OperationProgress
+from orchestration import FINISHED, Wait, Workflow, describe_failure, handle_event
+from server_steps import (POLL_COMMAND, STATUS_CHECK_TIMEOUT, await_instance_state, await_ready, await_script,
+                          await_status_checks, await_stop, describe_instance, send_script, send_stop)
+from ssm_command import CommandError, check_command, send_shell_script
 
-EC2_INSTANCE_ID = os.getenv('EC2_INSTANCE_ID')
+# process: マイクラ(JVM)だけ再起動する / os: インスタンスを再起動する / auto: インスタンスが不調な時だけ os
+RESTART_MODE = os.getenv('RESTART_MODE', 'auto')
+RESTART_MODES = ('process', 'os', 'auto')
+UNHEALTHY_STATUSES = ('impaired',)  # auto で OS の再起動を選ぶステータスチェックの結果
 
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-COMMAND_CHANNEL_ID = os.getenv('COMMAND_CHANNEL_ID')
-
-DISCORD_ENDPOINT = f"https://discordapp.com/api/channels/{COMMAND_CHANNEL_ID}/messages"
+REBOOT_SETTLE = 2  # reboot_instances 直後に待つ秒数
+UPTIME_RESEND = 30  # OS の起動時間を問い合わせるコマンドが終わらなければ送り直す秒数
 
 
 def lambda_handler(event, context):
-    title = ""
-
-    try:
-        # インスタンスのステータスを取得
-        region = os.environ['AWS_REGION']
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(EC2_INSTANCE_ID)
-        status_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-
-        ec2_status = status_response['Reservations'][0]['Instances'][0]['State']['Name']
-        print('[INFO] Instance Status:' + str(ec2_status))
-
-        if ec2_status != "running":
-            # 起動中でない
-            send_message("サーバーは起動してないよ！", '時間をおいてから、もう一度試してね', 16705372)
-            return 0
-        else:
-            # マイクラ終了
-            ssm_client = boto3.client('ssm')
-            ssm_response = ssm_client.send_command(
-                InstanceIds=[EC2_INSTANCE_ID],
-                DocumentName="AWS-RunShellScript",
-                Parameters={
-                    "commands": ["cd /home/ec2-user/minecraft/", "sh Minecraft_restart.sh"]
-                }
-            )
-
-            # コマンドIDを取得
-            command_id = ssm_response['Command']['CommandId']
-
-            # 終了スクリプトの実行状況を確認
-            time.sleep(2)
-            command_invocation_result = \
-                ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-            status = command_invocation_result['Status']
-
-            if status == "Failed":
-                raise Exception('Failed Stopped Minecraft.')
-            elif status == "TimedOut":
-                raise TimeoutError('Timeout Stopped Minecraft.')
-            else:
-                print('[INFO] Successfully Stopped Minecraft.')
-
-            # マイクラが完了するまで待機
-            time.sleep(55)
-
-            # EC2再起動
-            response = ec2_client.reboot_instances(InstanceIds=[EC2_INSTANCE_ID])
-            time.sleep(2)
-            print('[INFO] Instance' + str(response))
-            ec2_resource.wait_until_running()
-
-            # EC2起動が完了するまで待機
-            cont = 1
-            total = 0
-
-            while cont:
-                status_response = ec2_client.describe_instance_status(InstanceIds=[EC2_INSTANCE_ID])
-                if (status_response['InstanceStatuses'][0]['InstanceStatus']['Status'] == "ok" and
-                        status_response['InstanceStatuses'][0]['SystemStatus']['Status'] == "ok"):
-                    cont = 0
-                else:
-                    time.sleep(5)
-                    total += 5
-            print('[INFO] Successfully Started Instance: ' + str(EC2_INSTANCE_ID) + ' wait time was roughly: ' +
-                  str(total) + 'seconds.')
-
-            # マイクラ起動
-            ssm_client = boto3.client('ssm')
-            ssm_response = ssm_client.send_command(
-                InstanceIds=[EC2_INSTANCE_ID],
-                DocumentName="AWS-RunShellScript",
-                Parameters={
-                    "commands": ["cd /home/ec2-user/minecraft/", "sh Minecraft_start.sh"]
-                }
-            )
-
-            # コマンドIDを取得
-            command_id = ssm_response['Command']['CommandId']
-
-            # 開始スクリプトの実行状況を確認
-            time.sleep(2)
-            command_invocation_result = \
-                ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-            status = command_invocation_result['Status']
-
-            if status == "Failed":
-                raise Exception('Failed Rebooted Minecraft.')
-            elif status == "TimedOut":
-                raise TimeoutError('Timeout Rebooted Minecraft.')
-            else:
-                print('[INFO] Successfully Rebooted Minecraft.')
-
-            # マイクラが開始するまで待機
-            time.sleep(15)
-
-            print('[INFO] Successfully Rebooted Minecraft.')
-            title = "\N{WHITE HEAVY CHECK MARK} サーバー再起動完了！"
-
-        # public ip取得
-        instance_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-        public_ip = instance_response['Reservations'][0]['Instances'][0]['PublicIpAddress']
-        print('[LOG] public_ip: ' + public_ip)
-
-        mag = f"IPアドレス: 【{public_ip}】"
-
-        send_message(title, mag)
-        return 0
-
-    except Exception as error:
-        print('[ERROR] ' + str(error))
-        send_message('\N{cross mark} サーバー再起動失敗！', '管理者に問い合わせてね\N{Person with Folded Hands}', 15548997)
-        return 0
-
-
-def send_message(title, msg, color=5763719):
-    body = {
-        "embeds": [
-            {
-                "title": title,
-                "description": msg,
-                "color": color
-            }
-        ]
-    }
-
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-    }
-
-    response = requests.post(DISCORD_ENDPOINT, json=body, headers=headers)
-    print('[INFO] Send Message:' + str(response))
+    return handle_event(WORKFLOW, event, lambda_context=context)
+
+
+def prepare(context):
+    # サーバー名が解決できなくても on_error で応答できるように、先に進捗メッセージを用意する
+    server = context.data.get('server') or context.event.get('server') or DEFAULT_SERVER
+    context.progress = OperationProgress.restore(context.event, "サーバーを再起動します!" + server_label(server),
+                                                 context.state.get('progress'))
+    if 'instance_id' not in context.data:
+        context.data['server'], context.data['instance_id'] = resolve_server(context.event.get('server'))
+
+
+def check_instance(context):
+    # インスタンスのステータスを取得
+    instance = describe_instance(context.data['instance_id'])
+    ec2_status = instance['State']['Name']
+    print('[INFO] Instance Status:' + str(ec2_status))
+
+    if ec2_status != "running":
+        # 起動中でない
+        context.progress.finish("サーバーは起動してないよ！", '時間をおいてから、もう一度試してね', COLOR_WARNING)
+        return FINISHED
+
+    context.data['public_ip'] = instance.get('PublicIpAddress')
+    context.data['restart_mode'] = choose_mode(context.event.get('mode'), context.data['instance_id'])
+    if context.data['restart_mode'] == 'process':
+        # OS は再起動しないので、起動スクリプトの完了ではなくマイクラの応答で確認する
+        context.data['readiness'] = 'ping'
+    print(f"[INFO] Restart mode: {context.data['restart_mode']}")
+
+
+def choose_mode(requested, instance_id):
+    mode = requested or RESTART_MODE
+    if mode not in RESTART_MODES:
+        print(f'[WARN] Unknown restart mode {mode}, using {RESTART_MODE}.')
+        mode = RESTART_MODE
+    if mode != 'auto':
+        return mode
+
+    response = get_client('ec2').describe_instance_status(InstanceIds=[instance_id])
+    for status in response['InstanceStatuses']:
+        checks = (status['InstanceStatus']['Status'], status['SystemStatus']['Status'])
+        if any(check in UNHEALTHY_STATUSES for check in checks):
+            print(f'[INFO] Instance is unhealthy (instance: {checks[0]}, system: {checks[1]}), rebooting the OS.')
+            return 'os'
+    return 'process'
+
+
+def os_only(step):
+    """インスタンスを再起動する場合だけ実行するステップ(restart_mode の無い再開は従来どおり os)"""
+    def wrapper(context):
+        if context.data.get('restart_mode', 'os') == 'os':
+            return step(context)
+
+    return wrapper
+
+
+def reboot_instance(context):
+    # EC2再起動(再開時に二重に再起動しない)
+    if not context.data.get('rebooted'):
+        response = get_client('ec2').reboot_instances(InstanceIds=[context.data['instance_id']])
+        print('[INFO] Instance' + str(response))
+        context.data['rebooted'] = True
+        context.data['rebooted_at'] = context.clock()
+        return Wait(REBOOT_SETTLE, 'reboot')
+
+
+def await_reboot(context):
+    """OS が再起動したこと(起動時間が reboot_instances より後)を SSM で確かめる
+
+    再起動してもインスタンスの状態は running のままで、ping モードではステータスチェックも待たないので、
+    確かめずに進むと終了処理中の OS に起動スクリプトを送ってしまう。
+    """
+    ssm_client = get_client('ssm')
+    instance_id = context.data['instance_id']
+    since_reboot = context.clock() - context.data.get('rebooted_at', context.state['step_started_at'])
+    command_id = context.data.get('uptime_command_id')
+    if command_id is not None:
+        try:
+            result = check_command(ssm_client, command_id, instance_id)
+        except CommandError as error:
+            # 再起動で中断された
+            print(f'[INFO] Uptime command did not finish, sending it again: {error}')
+            result = None
+            context.data['uptime_command_id'] = None
+        if result is not None:
+            uptime = float(result.stdout.split()[0])
+            if uptime < since_reboot:
+                print(f'[INFO] Instance rebooted: OS uptime {uptime:.0f} seconds.')
+                return
+            # まだ再起動前の OS が応答した
+            context.data['uptime_command_id'] = None
+        elif context.clock() - context.data.get('uptime_sent_at', 0) > UPTIME_RESEND:
+            context.data['uptime_command_id'] = None
+
+    context.check_step_timeout(STATUS_CHECK_TIMEOUT, 'Instance did not come back after the reboot')
+    if context.data.get('uptime_command_id') is None:
+        try:
+            context.data['uptime_command_id'] = send_shell_script(ssm_client, instance_id, ['cat /proc/uptime'])
+            context.data['uptime_sent_at'] = context.clock()
+        except ssm_client.exceptions.InvalidInstanceId:
+            # 再起動中で SSM エージェントが応答しない
+            pass
+    return Wait(context.backoff(*POLL_COMMAND), 'reboot')
+
+
+def notify_restarted(context):
+    print(f"[INFO] Successfully Rebooted Minecraft ({context.data.get('restart_mode', 'os')}) "
+          f"in {context.elapsed():.0f} seconds.")
+    public_ip = context.data['public_ip']
+    print('[LOG] public_ip: ' + public_ip)
+
+    mag = f"IPアドレス: 【{public_ip}】"
+
+    context.progress.finish("\N{WHITE HEAVY CHECK MARK} サーバー再起動完了！", mag)
+
+
+def on_error(context, error):
+    context.progress.finish('\N{cross mark} サーバー再起動失敗！', describe_failure(error), COLOR_ERROR)
+
+
+WORKFLOW = Workflow(
+    'restart',
+    [
+        ('check_instance', check_instance),
+        ('send_stop', send_stop('Minecraft_restart.sh')),
+        ('await_stop', await_stop("マイクラ停止")),
+        ('reboot_instance', os_only(reboot_instance)),
+        ('await_reboot', os_only(await_reboot)),
+        ('await_running', os_only(await_instance_state('running', "インスタンス再起動"))),
+        ('await_status_checks', os_only(await_status_checks)),
+        ('send_start_script', send_script('Minecraft_start.sh')),
+        ('await_start_script', await_script('Successfully Rebooted Minecraft.')),
+        ('await_ready', await_ready("マイクラ起動")),
+        ('notify_restarted', notify_restarted),
+    ],
+    start=prepare,
+    on_error=on_error
+)
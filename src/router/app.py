@@ -0,0 +1,54 @@
+"""全ての関数を1つの Lambda にまとめる場合の入口(DeploymentMode=consolidated)
+
+イベントの形で振り分け先の関数を決め、その関数の app を初回だけ import して lambda_handler を呼ぶ。
+1つのコンテナが全てのイベントを処理するので、呼び出し頻度の低い関数もウォームなまま使える。
+ワーカー(起動・停止・再起動・バックアップ)は自分自身を action 付きで非同期に呼び出し、
+待機中の再開は1つのキューに積んだ state の workflow で振り分ける。
+"""
+import importlib
+import json
+import os
+
+MONITERING_EVENT_NAME = os.getenv('MONITERING_EVENT_NAME')
+
+# action(ワーカーのペイロード)/ workflow(SQS の state)→ 関数
+WORKERS = {
+    'start': 'start_ec2',
+    'stop': 'stop_ec2',
+    'restart': 'restart_ec2',
+    'backup': 'backup_ec2',
+}
+
+_handlers = {}  # 関数 → lambda_handler(import 済みのもの)
+
+
+def lambda_handler(event, context):
+    if 'Records' in event:
+        # SQS の再開メッセージ(BatchSize: 1 だが、複数でも1件ずつ振り分ける)
+        for record in event['Records']:
+            function = WORKERS[json.loads(record['body'])['workflow']]
+            get_handler(function)({'Records': [record]}, context)
+        return 0
+
+    return get_handler(route(event))(event, context)
+
+
+def route(event):
+    """イベントを処理する関数のディレクトリ名"""
+    if 'requestContext' in event:
+        return 'slash_commands_callback'
+    if event.get('source') == 'aws.ec2':
+        return 'state_change_ec2'
+    if event.get('detail-type') == 'Scheduled Event':
+        rule = event['resources'][0].rsplit('/', 1)[-1]
+        return 'monitoring_ec2' if rule == MONITERING_EVENT_NAME else 'prewarm_ec2'
+    if event.get('action') in WORKERS:
+        return WORKERS[event['action']]
+    raise ValueError(f'Unknown event: {json.dumps(event)[:200]}')
+
+
+def get_handler(function):
+    if function not in _handlers:
+        _handlers[function] = importlib.import_module(f'{function}.app').lambda_handler
+        print(f'[INFO] Loaded {function}')
+    return _handlers[function]
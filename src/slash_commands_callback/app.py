@@ -1,14 +1,48 @@
 import json
 import os
-import boto3
+import time
 
 from nacl.signing import VerifyKey
 
+import metrics
+from clients import get_client
+from fleet import ALL_SERVERS, SERVERS, UnknownServerError, resolve_server, run_concurrently, server_label, server_names
+from operation_lock import ACQUIRED, CONFLICT, acquire_operation, release_operation
+from player_stats import HOURLY_COST, load_series
+from state_cache import get_states
+
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 APPLICATION_ID = os.getenv('APPLICATION_ID')
 APPLICATION_PUBLIC_KEY = os.getenv('APPLICATION_PUBLIC_KEY')
 COMMAND_GUILD_ID = os.getenv('COMMAND_GUILD_ID')
 
+# action: 起動するLambda関数の環境変数名
+WORKER_ACTIONS = {
+    'start': 'START_EC2_LAMBDA_FUNCTION',
+    'stop': 'STOP_EC2_LAMBDA_FUNCTION',
+    'restart': 'RESTART_EC2_LAMBDA_FUNCTION',
+    'backup': 'BACKUP_EC2_LAMBDA_FUNCTION',
+}
+# action: 操作の対象になるインスタンスの状態(全サーバーへの操作で使う)
+ACTION_TARGET_STATES = {
+    'start': ('stopped',),
+    'stop': ('pending', 'running'),
+    'restart': ('running',),
+    'backup': ('running',),
+}
+OPERATION_NAMES = {
+    'start': "起動",
+    'stop': "停止",
+    'restart': "再起動",
+    'backup': "バックアップ",
+}
+STATE_NAMES = {
+    'pending': "\N{HOURGLASS WITH FLOWING SAND} 起動中",
+    'running': "\N{LARGE GREEN CIRCLE} 稼働中",
+    'stopping': "\N{HOURGLASS WITH FLOWING SAND} 停止中",
+    'stopped': "\N{MEDIUM BLACK CIRCLE} 停止",
+}
+
 verify_key = VerifyKey(bytes.fromhex(APPLICATION_PUBLIC_KEY))
 
 
@@ -23,6 +57,17 @@ def verify(signature: str, timestamp: str, body: str) -> bool:
 
 
 def lambda_handler(event: dict, context: dict):
+    # Discord には3秒以内に応答する必要があるので、応答までの時間を計測する
+    metrics.use('interaction')
+    started = time.perf_counter()
+    try:
+        return respond(event)
+    finally:
+        metrics.record('respond', time.perf_counter() - started)
+        metrics.flush()
+
+
+def respond(event: dict):
     # API Gateway has weird case conversion, so we need to make them lowercase.
     # See https://github.com/aws/aws-sam-cli/issues/1860
     headers: dict = {k.lower(): v for k, v in event['headers'].items()}
@@ -50,36 +95,51 @@ def lambda_handler(event: dict, context: dict):
         opts = {v['name']: v['value'] for v in req['data']['options']} if 'options' in req['data'] else {}
         action = req['data']['options'][0]['value']
         username = req['member']['user']['username']
+        metrics.use(action, opts.get('server'))
 
         title = ""
         msg = ""
 
-        if action == 'start':
-            client = boto3.client('lambda')
-            client.invoke(
-                FunctionName=os.getenv('START_EC2_LAMBDA_FUNCTION'),
-                InvocationType='Event'
-            )
-            title = "サーバーを起動します!"
-            msg = "\N{timer clock}３分ぐらい待ってね"
-
-        if action == 'stop':
-            client = boto3.client('lambda')
-            client.invoke(
-                FunctionName=os.getenv('STOP_EC2_LAMBDA_FUNCTION'),
-                InvocationType='Event'
-            )
-            title = "サーバーを停止します!"
-            msg = "\N{timer clock}2分ぐらい待ってね"
-
-        if action == 'restart':
-            client = boto3.client('lambda')
-            client.invoke(
-                FunctionName=os.getenv('RESTART_EC2_LAMBDA_FUNCTION'),
-                InvocationType='Event'
-            )
-            title = "サーバーを再起動します!"
-            msg = "\N{timer clock}３分ぐらい待ってね"
+        if action in WORKER_ACTIONS:
+            server = opts.get('server')
+            try:
+                names = server_names(server)
+            except UnknownServerError:
+                title = f"{server} というサーバーは無いよ！"
+                msg = "登録済みのサーバー: " + ", ".join(SERVERS)
+            else:
+                if server == ALL_SERVERS:
+                    # 全サーバーへの操作はチャンネルに結果を投稿する
+                    title, msg = dispatch_fleet(action, names)
+                else:
+                    interaction = {
+                        "application_id": req['application_id'],
+                        "token": req['token']
+                    }
+
+                    # 同じ操作が実行中なら合流し、別の操作が実行中なら拒否する
+                    state, operation = dispatch_worker(action, names[0], interaction, opts.get('mode'))
+                    if state == CONFLICT:
+                        title = f"{OPERATION_NAMES[operation['operation']]}中だよ！{server_label(names[0])}"
+                        msg = "終わってから、もう一度試してね"
+                    else:
+                        return {
+                            "type": 5  # InteractionResponseType.DeferredChannelMessageWithSource
+                        }
+
+        elif action in ('status', 'stats'):
+            server = opts.get('server') or ALL_SERVERS
+            try:
+                names = server_names(server)
+            except UnknownServerError:
+                title = f"{server} というサーバーは無いよ！"
+                msg = "登録済みのサーバー: " + ", ".join(SERVERS)
+            else:
+                if action == 'status':
+                    # 状態キャッシュから答える(古い場合だけ describe_instances する)
+                    title, msg = "サーバーの状態", describe_status(names)
+                else:
+                    title, msg = "サーバーの利用状況", describe_stats(names)
 
         return {
             "type": 4,  # InteractionResponseType.ChannelMessageWithSource
@@ -93,3 +153,118 @@ def lambda_handler(event: dict, context: dict):
                 ]
             }
         }
+
+
+def dispatch_worker(action, server, interaction=None, mode=None):
+    """操作ロックを取得できた場合だけワーカーを起動する(mode は再起動の方法。省略時はワーカーの既定)"""
+    _, instance_id = resolve_server(server)
+    state, operation = acquire_operation(instance_id, action, interaction)
+    if state != ACQUIRED:
+        return state, operation
+
+    # 応答は遅延させ、ワーカーがインタラクションのトークンで元メッセージを更新する
+    worker_operation = {
+        "instance_id": operation['instance_id'],
+        "operation_id": operation['operation_id']
+    }
+    try:
+        get_client('lambda').invoke(
+            FunctionName=os.getenv(WORKER_ACTIONS[action]),
+            InvocationType='Event',
+            Payload=json.dumps({
+                "action": action,
+                "server": server,
+                "interaction": interaction,
+                "operation": worker_operation,
+                "mode": mode
+            })
+        )
+    except Exception:
+        release_operation(worker_operation, {})
+        raise
+    return state, operation
+
+
+def dispatch_fleet(action, names):
+    """対象の状態のサーバーだけに、並列でワーカーを起動する"""
+    states = get_states([SERVERS[name] for name in names])
+    states = {name: (states.get(SERVERS[name]) or {}).get('state') for name in names}
+    targets = [name for name in names if states[name] in ACTION_TARGET_STATES[action]]
+
+    get_client('lambda')  # スレッド内で生成しないよう先に用意する
+    results = run_concurrently(lambda name: dispatch_worker(action, name), targets)
+
+    lines = []
+    for name in names:
+        result = results.get(name)
+        if result is None:
+            lines.append(f"{name}: そのまま ({states[name]})")
+        elif isinstance(result, Exception):
+            lines.append(f"{name}: \N{cross mark} 失敗")
+        elif result[0] == CONFLICT:
+            lines.append(f"{name}: {OPERATION_NAMES[result[1]['operation']]}中")
+        else:
+            lines.append(f"{name}: {OPERATION_NAMES[action]}します")
+
+    return f"全サーバーを{OPERATION_NAMES[action]}します!", "\n".join(lines)
+
+
+def describe_status(names):
+    records = get_states([SERVERS[name] for name in names])
+    now = time.time()
+
+    lines = []
+    for name in names:
+        record = records.get(SERVERS[name])
+        if record is None:
+            lines.append(f"{name}: 不明")
+            continue
+
+        line = f"{name}: {STATE_NAMES.get(record['state'], record['state'])}"
+        if record.get('changed_at'):
+            line += f" ({format_ago(now - record['changed_at'])}から)"
+        if record['state'] == 'running':
+            if record.get('public_ip'):
+                line += f"\n　IPアドレス: 【{record['public_ip']}】"
+            if record.get('players') is not None:
+                line += f"\n　ログイン: {int(record['players'])}人 ({format_ago(now - record['players_at'])}時点)"
+        if record.get('start_seconds') is not None:
+            mode = "休止から復帰" if record.get('start_mode') == 'hibernate' else "通常起動"
+            line += f"\n　前回の起動: {record['start_seconds']:.0f}秒 ({mode})"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def format_ago(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "たった今"
+    if minutes < 60:
+        return f"{minutes}分前"
+    return f"{minutes // 60}時間{minutes % 60}分前"
+
+
+def describe_stats(names):
+    now = time.time()
+    series = run_concurrently(lambda name: load_series(SERVERS[name]), names)
+
+    blocks = []
+    for name in names:
+        lines = [f"**{name}**"]
+        total = None if isinstance(series[name], Exception) else series[name].total()
+        if not total or not total['samples']:
+            lines.append("記録がまだ無いよ")
+            blocks.append("\n".join(lines))
+            continue
+
+        for week, summary in enumerate(series[name].weekly(now)):
+            label = "直近7日" if week == 0 else f"{week}週前"
+            lines.append(f"{label}: 最大 {summary['peak']}人 / 中央値 {summary['median']}人 / "
+                         f"稼働 {summary['hours']:.1f}時間{format_cost(summary['cost'])}")
+        lines.append(f"累計: 最大 {total['peak']}人 / 稼働 {total['hours']:.1f}時間{format_cost(total['cost'])}")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def format_cost(cost):
+    return f" / 約${cost:.2f}" if HOURLY_COST else ""
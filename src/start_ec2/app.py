@@ -1,141 +1,186 @@
-import json
 import os
-import time
-import requests
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
+
+import metrics
+from clients import get_client
+from discord_message import COLOR_ERROR, COLOR_WARNING, send_message
+from fleet import DEFAULT_SERVER, resolve_server, server_label
+from hibernation import is_hibernated
+from minecraft_ping import READINESS_TIMEOUT
+from monitor_schedule import schedule_monitoring
+from operation_lock import OperationProgress
+from orchestration import FINISHED, Wait, Workflow, describe_failure, handle_event
+from right_sizing import INSTANCE_LADDER, plan_instance_type
+from server_steps import (await_instance_state, await_ready, await_resume, await_script, await_status_checks,
+                          describe_instance, send_script)
+from ssm_command import check_command, send_shell_script
+from startup_profile import describe_profile, describe_regressions, parse_profile, profile_commands, record_profile
+from state_cache import record_start
 
-import boto3
-
-EC2_INSTANCE_ID = os.getenv('EC2_INSTANCE_ID')
-
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-COMMAND_CHANNEL_ID = os.getenv('COMMAND_CHANNEL_ID')
 MONITERING_EVENT_NAME = os.getenv('MONITERING_EVENT_NAME')
 
-DISCORD_ENDPOINT = f"https://discordapp.com/api/channels/{COMMAND_CHANNEL_ID}/messages"
+TOKYO_TIMEZONE = ZoneInfo('Asia/Tokyo')
 
 MAINTENANCE_START_TIME = datetime.time(5, 0, 0)  # メンテナンス開始時間
 MAINTENANCE_END_TIME = datetime.time(5, 59, 59)  # メンテナンス終了時間
 
+POLL_PROFILE = (2, 10)  # ログに Done が出るまでの解析の間隔(初回, 上限)秒
+
 
 def lambda_handler(event, context):
-    title = ""
+    return handle_event(WORKFLOW, event, lambda_context=context)
+
+
+def prepare(context):
+    # サーバー名が解決できなくても on_error で応答できるように、先に進捗メッセージを用意する
+    server = context.data.get('server') or context.event.get('server') or DEFAULT_SERVER
+    context.progress = OperationProgress.restore(context.event, "サーバーを起動します!" + server_label(server),
+                                                 context.state.get('progress'))
+    if 'instance_id' not in context.data:
+        context.data['server'], context.data['instance_id'] = resolve_server(context.event.get('server'))
+
+
+def check_instance(context):
+    # インスタンスのステータスを取得
+    instance = describe_instance(context.data['instance_id'])
+    ec2_status = instance['State']['Name']
+    print('[INFO] Instance Status:' + str(ec2_status))
+
+    if ec2_status == "running":
+        # 起動済み
+        notify_started(context, "サーバーは起動済みだよ！", instance['PublicIpAddress'])
+        return FINISHED
+
+    # 東京タイムゾーンの日時を取得
+    tokyo_now = datetime.datetime.now(TOKYO_TIMEZONE)
+    tokyo_time = tokyo_now.time()
+
+    # メンテナンス時間内ならec2を起動しない
+    if (MAINTENANCE_START_TIME < tokyo_time) & (MAINTENANCE_END_TIME > tokyo_time):
+        context.progress.finish('\N{WARNING SIGN} ただいまメンテナンス中！',
+                                f'{MAINTENANCE_START_TIME}～{MAINTENANCE_END_TIME}はメンテナンス中です \N{PERSON BOWING DEEPLY} ',
+                                COLOR_WARNING)
+        return FINISHED
+
+    # 休止していれば、起動スクリプトを使わずにマイクラの応答を待つ
+    context.data['hibernated'] = is_hibernated(instance)
+    context.data['instance_type'] = instance.get('InstanceType')
+
+
+def resize_instance(context):
+    # 見込みの人数に合わせてインスタンスタイプを変える(停止中のみ変更できる)。失敗したら今のタイプで起動する
+    if not INSTANCE_LADDER or context.data['hibernated']:
+        # 休止したインスタンスはタイプを変えられない
+        return
+
+    current = context.data['instance_type']
+    try:
+        rung, players = plan_instance_type(context.data['instance_id'])
+        if rung is None or rung.instance_type == current:
+            print(f'[INFO] Keeping {current} for {players} expected players.')
+            return
+        get_client('ec2').modify_instance_attribute(InstanceId=context.data['instance_id'],
+                                                    InstanceType={'Value': rung.instance_type})
+    except Exception as error:
+        print(f'[WARN] Could not resize the instance, starting {current}: {error}')
+        return
+
+    print(f'[INFO] Resized {current} -> {rung.instance_type} for {players} expected players.')
+    context.data['resized'] = [current, rung.instance_type, players]
+
+
+def start_instance(context):
+    # EC2起動
+    response = get_client('ec2').start_instances(InstanceIds=[context.data['instance_id']])
+    print('[INFO] Instance' + str(response))
+
+
+def profile_startup(context):
+    # latest.log から起動の内訳を取り出す(Done が出るまで解析し直す)。失敗しても起動は完了扱い
+    if context.data.get('resumed'):
+        return
 
     try:
-        # インスタンスのステータスを取得
-        region = os.environ['AWS_REGION']
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(EC2_INSTANCE_ID)
-        status_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-
-        ec2_status = status_response['Reservations'][0]['Instances'][0]['State']['Name']
-        print('[INFO] Instance Status:' + str(ec2_status))
-
-        if ec2_status == "running":
-            # 起動済み
-            title = "サーバーは起動済みだよ！"
-        else:
-            # 東京タイムゾーンの日時を取得
-            tokyo_now = datetime.datetime.now(pytz.timezone('Asia/Tokyo'))
-            tokyo_time = tokyo_now.time()
-
-            # メンテナンス時間内ならec2を起動しない
-            if (MAINTENANCE_START_TIME < tokyo_time) & (MAINTENANCE_END_TIME > tokyo_time):
-                send_message('\N{WARNING SIGN} ただいまメンテナンス中！',
-                             f'{MAINTENANCE_START_TIME}～{MAINTENANCE_END_TIME}はメンテナンス中です \N{PERSON BOWING DEEPLY} ',
-                             16705372)
-
-                return 0
-
-            # EC2起動
-            response = ec2_client.start_instances(InstanceIds=[EC2_INSTANCE_ID])
-            print('[INFO] Instance' + str(response))
-            ec2_resource.wait_until_running()
-
-            # EC2起動が完了するまで待機
-            cont = 1
-            total = 0
-
-            while cont:
-                status_response = ec2_client.describe_instance_status(InstanceIds=[EC2_INSTANCE_ID])
-                if (status_response['InstanceStatuses'][0]['InstanceStatus']['Status'] == "ok" and
-                        status_response['InstanceStatuses'][0]['SystemStatus']['Status'] == "ok"):
-                    cont = 0
-                else:
-                    time.sleep(5)
-                    total += 5
-            print('[INFO] Successfully Started Instance: ' + str(EC2_INSTANCE_ID) + ' wait time was roughly: ' +
-                  str(total) + 'seconds.')
-
-            # マイクラ起動
-            ssm_client = boto3.client('ssm')
-            ssm_response = ssm_client.send_command(
-                InstanceIds=[EC2_INSTANCE_ID],
-                DocumentName="AWS-RunShellScript",
-                Parameters={
-                    "commands": ["cd /home/ec2-user/minecraft/", "sh Minecraft_start.sh"]
-                }
-            )
-
-            # コマンドIDを取得
-            command_id = ssm_response['Command']['CommandId']
-
-            # 開始スクリプトの実行状況を確認
-            time.sleep(2)
-            command_invocation_result = \
-                ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-            status = command_invocation_result['Status']
-
-            if status == "Failed":
-                raise Exception('Failed Started Minecraft.')
-            elif status == "TimedOut":
-                raise TimeoutError('Timeout Started Minecraft.')
-            else:
-                print('[INFO] Successfully Started Minecraft.')
-
-            # マイクラが開始するまで待機
-            time.sleep(15)
-
-            # EC2監視イベントの有効化
-            events_client = boto3.client('events')
-            response = events_client.enable_rule(
-                Name=MONITERING_EVENT_NAME
-            )
-
-            print('[INFO] Successfully Started Minecraft.')
-            title = "\N{WHITE HEAVY CHECK MARK} サーバー起動完了！"
-
-        # public ip取得
-        instance_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-        public_ip = instance_response['Reservations'][0]['Instances'][0]['PublicIpAddress']
-        print('[LOG] public_ip: ' + public_ip)
-
-        mag = f"IPアドレス: 【{public_ip}】"
-
-        send_message(title, mag)
-        return 0
+        ssm_client = get_client('ssm')
+        command_id = context.data.get('profile_command_id')
+        if command_id is None:
+            context.data['profile_command_id'] = send_shell_script(ssm_client, context.data['instance_id'],
+                                                                   profile_commands())
+            return Wait(POLL_PROFILE[0], 'startup log')
+
+        result = check_command(ssm_client, command_id, context.data['instance_id'])
+        if result is None:
+            return Wait(context.backoff(*POLL_PROFILE), command_id)
+        profile = parse_profile(result.stdout)
+        if profile is None or not profile['done']:
+            if context.step_elapsed() > READINESS_TIMEOUT:
+                print('[WARN] Minecraft did not log Done, skipping the startup profile.')
+                return
+            del context.data['profile_command_id']
+            return Wait(context.backoff(*POLL_PROFILE), 'Minecraft Done')
+    except Exception as error:
+        print(f'[WARN] Could not profile the startup: {error}')
+        return
+
+    print(f"[INFO] Startup phases: {profile['phases']} (Done {profile['total']}s)")
+    for name, seconds in profile['phases']:
+        if not name.startswith('plugin:'):
+            metrics.record(f'startup_{name}', seconds)
+    context.data['startup_profile'] = profile
 
+    try:
+        regressions = record_profile(context.data['instance_id'], profile)
+        if regressions:
+            print(f'[WARN] Startup regressions: {regressions}')
+            send_message("\N{WARNING SIGN} 起動が遅くなっています" + server_label(context.data['server']),
+                         describe_regressions(regressions), COLOR_WARNING)
     except Exception as error:
-        print('[ERROR] ' + str(error))
-        send_message('\N{cross mark} サーバー起動失敗！', '管理者に問い合わせてね\N{Person with Folded Hands}', 15548997)
-        return 0
-
-
-def send_message(title, msg, color=5763719):
-    body = {
-        "embeds": [
-            {
-                "title": title,
-                "description": msg,
-                "color": color
-            }
-        ]
-    }
-
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-    }
-
-    response = requests.post(DISCORD_ENDPOINT, json=body, headers=headers)
-    print('[INFO] Send Message:' + str(response))
+        print(f'[WARN] Could not record the startup profile: {error}')
+
+
+def enable_monitoring(context):
+    # EC2監視イベントの有効化(前回の監視が書き換えた発火時刻もここで設定し直す)
+    schedule_monitoring(MONITERING_EVENT_NAME)
+
+    print('[INFO] Successfully Started Minecraft.')
+    record_start(context.data['instance_id'], 'hibernate' if context.data.get('resumed') else 'boot',
+                 context.elapsed())
+    notify_started(context, "\N{WHITE HEAVY CHECK MARK} サーバー起動完了！", context.data['public_ip'])
+
+
+def notify_started(context, title, public_ip):
+    print('[LOG] public_ip: ' + public_ip)
+
+    mag = f"IPアドレス: 【{public_ip}】"
+    if context.data.get('resized'):
+        previous, instance_type, players = context.data['resized']
+        mag += f"\nインスタンス: {previous} → {instance_type} (見込み {players}人)"
+    if context.data.get('startup_profile'):
+        mag += "\n" + describe_profile(context.data['startup_profile'])
+
+    context.progress.finish(title, mag)
+
+
+def on_error(context, error):
+    context.progress.finish('\N{cross mark} サーバー起動失敗！', describe_failure(error), COLOR_ERROR)
+
+
+WORKFLOW = Workflow(
+    'start',
+    [
+        ('check_instance', check_instance),
+        ('resize_instance', resize_instance),
+        ('start_instance', start_instance),
+        ('await_running', await_instance_state('running', "インスタンス起動")),
+        ('await_status_checks', await_status_checks),
+        ('await_resume', await_resume("休止から復帰")),
+        ('send_start_script', send_script('Minecraft_start.sh')),
+        ('await_start_script', await_script('Successfully Started Minecraft.')),
+        ('await_ready', await_ready("マイクラ起動")),
+        ('profile_startup', profile_startup),
+        ('enable_monitoring', enable_monitoring),
+    ],
+    start=prepare,
+    on_error=on_error
+)
@@ -0,0 +1,23 @@
+from clients import get_client
+from fleet import SERVERS
+from state_cache import parse_state_change_event, record_transition
+
+
+def lambda_handler(event, context):
+    # EC2 Instance State-change Notification で状態キャッシュを更新する
+    instance_id, state, changed_at = parse_state_change_event(event)
+    if instance_id not in SERVERS.values():
+        print(f'[INFO] Ignored state change of unregistered instance: {instance_id}')
+        return 0
+
+    # パブリックIPはイベントに含まれないので、running になった時だけ取得する
+    public_ip = None
+    if state == 'running':
+        response = get_client('ec2').describe_instances(InstanceIds=[instance_id])
+        public_ip = response['Reservations'][0]['Instances'][0].get('PublicIpAddress')
+
+    if record_transition(instance_id, state, changed_at, public_ip):
+        print(f'[INFO] Instance State: {instance_id} {state} (public_ip: {public_ip})')
+    else:
+        print(f'[INFO] Ignored out-of-order state change: {instance_id} {state}')
+    return 0
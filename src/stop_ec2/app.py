@@ -1,97 +1,94 @@
-import json
 import os
-import time
-import requests
 
-import boto3
+from clients import get_client
+from discord_message import COLOR_ERROR, COLOR_WARNING
+from fleet import DEFAULT_SERVER, SERVERS, describe_servers, resolve_server, server_label
+from hibernation import can_hibernate, hibernate_instance
+from operation_lock import OperationProgress
+from orchestration import FINISHED, Workflow, describe_failure, handle_event
+from server_steps import await_backup, await_stop, describe_instance, send_backup, send_stop
+from world_backup import BACKUP_ON_STOP
 
-EC2_INSTANCE_ID = os.getenv('EC2_INSTANCE_ID')
-
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-COMMAND_CHANNEL_ID = os.getenv('COMMAND_CHANNEL_ID')
 MONITERING_EVENT_NAME = os.getenv('MONITERING_EVENT_NAME')
-
-DISCORD_ENDPOINT = f"https://discordapp.com/api/channels/{COMMAND_CHANNEL_ID}/messages"
+ACTIVE_STATES = ('pending', 'running')  # 監視を続ける必要があるインスタンスの状態
 
 
 def lambda_handler(event, context):
-    try:
-        # インスタンスのステータスを取得
-        region = os.environ['AWS_REGION']
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(EC2_INSTANCE_ID)
-        status_response = ec2_client.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-
-        ec2_status = status_response['Reservations'][0]['Instances'][0]['State']['Name']
-        print('[INFO] Instance Status:' + str(ec2_status))
-
-        if ec2_status == "shutting-down" or ec2_status == "stopped":
-            # 停止済み
-            send_message("サーバーはもう停止してるよ！", '', 16705372)
-            return 0
-        else:
-            # マイクラ終了
-            ssm_client = boto3.client('ssm')
-            ssm_response = ssm_client.send_command(
-                InstanceIds=[EC2_INSTANCE_ID],
-                DocumentName="AWS-RunShellScript",
-                Parameters={
-                    "commands": ["cd /home/ec2-user/minecraft/", "sh Minecraft_stop.sh"]
-                }
-            )
-
-            # コマンドIDを取得
-            command_id = ssm_response['Command']['CommandId']
-
-            # 終了スクリプトの実行状況を確認
-            time.sleep(2)
-            command_invocation_result = \
-                ssm_client.get_command_invocation(CommandId=command_id, InstanceId=EC2_INSTANCE_ID)
-            status = command_invocation_result['Status']
-
-            if status == "Failed":
-                raise Exception('Failed Stopped Minecraft.')
-            elif status == "TimedOut":
-                raise TimeoutError('Timeout Stopped Minecraft.')
-            else:
-                print('[INFO] Successfully Stopped Minecraft.')
-
-            # マイクラが完了するまで待機
-            time.sleep(55)
-
-            # EC2停止
-            response = ec2_client.stop_instances(InstanceIds=[EC2_INSTANCE_ID])
-            print('[INFO] Successfully Instance: ' + str(EC2_INSTANCE_ID))
-
-            # EC2監視イベントの無効化
-            events_client = boto3.client('events')
-            response = events_client.disable_rule(
-                Name=MONITERING_EVENT_NAME
-            )
-
-        send_message('\N{WHITE HEAVY CHECK MARK} サーバー停止しました', 'お疲れ様！')
-        return 0
+    return handle_event(WORKFLOW, event, lambda_context=context)
+
+
+def prepare(context):
+    # サーバー名が解決できなくても on_error で応答できるように、先に進捗メッセージを用意する
+    server = context.data.get('server') or context.event.get('server') or DEFAULT_SERVER
+    context.progress = OperationProgress.restore(context.event, "サーバーを停止します!" + server_label(server),
+                                                 context.state.get('progress'))
+    if 'instance_id' not in context.data:
+        context.data['server'], context.data['instance_id'] = resolve_server(context.event.get('server'))
+
 
+def check_instance(context):
+    # インスタンスのステータスを取得
+    instance = describe_instance(context.data['instance_id'])
+    ec2_status = instance['State']['Name']
+    print('[INFO] Instance Status:' + str(ec2_status))
+
+    if ec2_status == "shutting-down" or ec2_status == "stopped":
+        # 停止済み
+        context.progress.finish("サーバーはもう停止してるよ！", '', COLOR_WARNING)
+        return FINISHED
+
+    context.data['can_hibernate'] = can_hibernate(instance)
+    context.data['public_ip'] = instance.get('PublicIpAddress')
+
+
+def hibernate(context):
+    # 休止できれば、マイクラを止めずにメモリごと休止する(できなければ通常の停止)
+    if not context.data.get('can_hibernate'):
+        return
+    try:
+        hibernate_instance(get_client('ec2'), context.data['instance_id'], context.data['public_ip'])
     except Exception as error:
-        print('[ERROR] ' + str(error))
-        send_message('\N{cross mark} サーバー停止失敗！', '管理者に問い合わせてね\N{Person with Folded Hands}', 15548997)
-        return 0
-
-
-def send_message(title, msg, color=5763719):
-    body = {
-        "embeds": [
-            {
-                "title": title,
-                "description": msg,
-                "color": color
-            }
-        ]
-    }
-
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-    }
-
-    response = requests.post(DISCORD_ENDPOINT, json=body, headers=headers)
-    print('[INFO] Send Message:' + str(response))
+        print(f'[WARN] Hibernation failed, falling back to stop: {error}')
+        return
+    context.data['hibernated'] = True
+
+
+def stop_instance(context):
+    # EC2停止(休止済みなら不要)
+    if not context.data.get('hibernated'):
+        get_client('ec2').stop_instances(InstanceIds=[context.data['instance_id']])
+        print('[INFO] Successfully Instance: ' + str(context.data['instance_id']))
+
+    # EC2監視イベントの無効化(他に動いているサーバーがあれば、その自動停止のために監視を続ける)
+    others = [name for name in SERVERS if name != context.data['server']]
+    active = [name for name, instance in describe_servers(others).items()
+              if instance['State']['Name'] in ACTIVE_STATES]
+    if active:
+        print(f"[INFO] Keeping {MONITERING_EVENT_NAME} enabled for {', '.join(active)}.")
+    else:
+        get_client('events').disable_rule(
+            Name=MONITERING_EVENT_NAME
+        )
+
+    msg = 'お疲れ様！次はすぐに起動できるよ' if context.data.get('hibernated') else 'お疲れ様！'
+    context.progress.finish('\N{WHITE HEAVY CHECK MARK} サーバー停止しました', msg)
+
+
+def on_error(context, error):
+    context.progress.finish('\N{cross mark} サーバー停止失敗！', describe_failure(error), COLOR_ERROR)
+
+
+WORKFLOW = Workflow(
+    'stop',
+    [
+        ('check_instance', check_instance),
+        ('hibernate', hibernate),
+        ('send_stop', send_stop('Minecraft_stop.sh')),
+        ('await_stop', await_stop("マイクラ停止")),
+        ('send_backup', send_backup(BACKUP_ON_STOP)),
+        ('await_backup', await_backup("バックアップ")),
+        ('stop_instance', stop_instance),
+    ],
+    start=prepare,
+    on_error=on_error
+)
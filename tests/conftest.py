@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambda と同じく src/common のモジュールをトップレベルで import する
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common'))
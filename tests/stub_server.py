@@ -0,0 +1,52 @@
+"""テスト用の TCP サーバー: 接続毎に handler(sock) をスレッドで実行する"""
+import socket
+import threading
+
+
+class StubServer:
+    def __init__(self, handler):
+        self.handler = handler
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.errors = []
+        self.closing = False
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        # close() だけでは accept() が戻らないため、自分に接続して起こす
+        self.closing = True
+        socket.create_connection(('127.0.0.1', self.port)).close()
+        self.thread.join(timeout=5)
+        self.listener.close()
+        if self.errors:
+            raise self.errors[0]
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.closing:
+                sock.close()
+                return
+            with sock:
+                sock.settimeout(5)
+                try:
+                    self.handler(sock)
+                except Exception as error:
+                    self.errors.append(error)
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('client closed the connection')
+        data += chunk
+    return data
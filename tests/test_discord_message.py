@@ -0,0 +1,214 @@
+import pytest
+
+import clients
+import deadline
+import discord_message
+import metrics
+from discord_message import MAX_EMBEDS, RateLimiter, request, send_embeds
+
+URL = 'https://discord.test/api/v10/channels/1/messages'
+ROUTE = 'POST /api/v10/channels/1/messages'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, data=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.data = data
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('No JSON body')
+        return self.data
+
+
+class FakeSession:
+    """request() が responses の順に応答を返す"""
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.calls = []
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        self.calls.append({'method': method, 'url': url, 'json': json, 'timeout': timeout})
+        return self.responses.pop(0) if self.responses else FakeResponse()
+
+
+def limit_headers(remaining, reset_after, bucket='bucket-1', limit=5):
+    return {'X-RateLimit-Bucket': bucket, 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset-After': str(reset_after), 'X-RateLimit-Limit': str(limit)}
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    deadline.activate(deadline.UNLIMITED)
+    monkeypatch.setattr(metrics, '_samples', [])
+    yield
+    deadline.activate(deadline.UNLIMITED)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(clients, '_http_session', session)
+    return session
+
+
+def test_unknown_route_is_not_limited():
+    assert RateLimiter(clock=FakeClock()).reserve(ROUTE) == 0.0
+
+
+def test_bucket_waits_for_reset_once_used_up():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    limiter.update(ROUTE, limit_headers(remaining=2, reset_after=3))
+
+    assert limiter.reserve(ROUTE) == 0.0
+    assert limiter.reserve(ROUTE) == 0.0
+    assert limiter.reserve(ROUTE) == pytest.approx(3)
+
+    limiter.wait(ROUTE)
+    assert clock.sleeps == [pytest.approx(3)]
+    # 新しいウィンドウでは上限まで送れる(wait で1回分を確保済み)
+    assert [limiter.reserve(ROUTE) for _ in range(4)] == [0.0] * 4
+    assert limiter.reserve(ROUTE) > 0
+
+
+def test_routes_sharing_a_bucket():
+    limiter = RateLimiter(clock=FakeClock())
+    other = 'PATCH /api/v10/webhooks/1/token/messages/@original'
+    limiter.update(ROUTE, limit_headers(remaining=0, reset_after=2))
+    limiter.update(other, limit_headers(remaining=0, reset_after=2))
+
+    assert limiter.routes == {ROUTE: 'bucket-1', other: 'bucket-1'}
+    assert limiter.reserve(other) == pytest.approx(2)
+
+
+def test_update_keeps_slots_reserved_in_parallel():
+    limiter = RateLimiter(clock=FakeClock())
+    limiter.update(ROUTE, limit_headers(remaining=3, reset_after=5))
+    limiter.reserve(ROUTE)
+    limiter.reserve(ROUTE)
+    # 先に送ったリクエストの応答が遅れて届いても、残り回数は増やさない
+    limiter.update(ROUTE, limit_headers(remaining=2, reset_after=4))
+
+    assert limiter.buckets['bucket-1'][0] == 1
+
+
+def test_global_limit_blocks_every_route():
+    limiter = RateLimiter(clock=FakeClock())
+    limiter.limited(ROUTE, 1.5, is_global=True)
+
+    assert limiter.reserve('GET /api/v10/users/@me') == pytest.approx(1.5)
+
+
+def test_wait_gives_up_after_max_wait():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    limiter.limited(ROUTE, discord_message.DISCORD_MAX_WAIT + 1, is_global=False)
+
+    with pytest.raises(TimeoutError):
+        limiter.wait(ROUTE)
+    assert clock.sleeps == []
+
+
+def test_wait_stops_before_the_lambda_deadline():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    limiter.limited(ROUTE, 5, is_global=False)
+    deadline.activate(deadline.Deadline(3000, reserve=1, clock=clock))
+
+    with pytest.raises(deadline.DeadlineExceededError):
+        limiter.wait(ROUTE)
+    assert clock.sleeps == []
+
+
+def test_request_retries_after_429(session):
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    session.responses = [
+        FakeResponse(429, {'Retry-After': '9'}, {'retry_after': 0.75, 'global': False}),
+        FakeResponse(200, limit_headers(remaining=4, reset_after=1)),
+    ]
+
+    response = request('POST', URL, {'content': 'hi'}, limiter=limiter)
+
+    assert response.status_code == 200
+    assert len(session.calls) == 2
+    # 本文の retry_after を Retry-After ヘッダーより優先する
+    assert clock.sleeps == [pytest.approx(0.75)]
+
+
+def test_request_uses_retry_after_header_without_body(session):
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    session.responses = [FakeResponse(429, {'Retry-After': '2'}), FakeResponse(204)]
+
+    assert request('POST', URL, {}, limiter=limiter).status_code == 204
+    assert clock.sleeps == [pytest.approx(2)]
+
+
+def test_request_gives_up_after_max_retries(session):
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    session.responses = [FakeResponse(429, data={'retry_after': 0.1})
+                         for _ in range(discord_message.DISCORD_MAX_RETRIES + 1)]
+
+    assert request('POST', URL, {}, limiter=limiter) is None
+    assert len(session.calls) == discord_message.DISCORD_MAX_RETRIES + 1
+
+
+def test_request_clamps_timeout_to_the_deadline(session):
+    clock = FakeClock()
+    deadline.activate(deadline.Deadline(5000, reserve=10, clock=clock))
+
+    request('POST', URL, {}, limiter=RateLimiter(clock=clock))
+
+    # 予備の時間も使ってよいので、読み取りのタイムアウトは残り5秒に切り詰められる
+    assert session.calls[0]['timeout'] == (3.05, 5)
+
+
+def test_request_returns_none_on_error(monkeypatch):
+    class BrokenSession:
+        def request(self, *args, **kwargs):
+            raise ConnectionError('connection reset')
+
+    monkeypatch.setattr(clients, '_http_session', BrokenSession())
+
+    assert request('POST', URL, {}, limiter=RateLimiter(clock=FakeClock())) is None
+    assert metrics._samples[-1][2] == 'discord'
+
+
+def test_send_embeds_batches_by_max_embeds(session, monkeypatch):
+    monkeypatch.setattr(discord_message, '_limiter', RateLimiter(clock=FakeClock()))
+    embeds = [discord_message.build_embed(f'title {i}', 'msg') for i in range(MAX_EMBEDS * 2 + 3)]
+
+    send_embeds(embeds)
+
+    assert [len(call['json']['embeds']) for call in session.calls] == [MAX_EMBEDS, MAX_EMBEDS, 3]
+    assert [embed for call in session.calls for embed in call['json']['embeds']] == embeds
+
+
+def test_flush_messages_sends_queued_embeds_once(session, monkeypatch):
+    monkeypatch.setattr(discord_message, '_limiter', RateLimiter(clock=FakeClock()))
+    discord_message.queue_message('one', 'a')
+    discord_message.queue_message('two', 'b')
+
+    discord_message.flush_messages()
+    discord_message.flush_messages()
+
+    assert len(session.calls) == 1
+    assert [embed['title'] for embed in session.calls[0]['json']['embeds']] == ['one', 'two']
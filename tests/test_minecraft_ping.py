@@ -0,0 +1,125 @@
+import json
+import struct
+
+import pytest
+
+from minecraft_ping import _pack_varint, ping
+from stub_server import StubServer, recv_exact
+
+STATUS = {'version': {'name': '1.21', 'protocol': 767}, 'players': {'online': 3, 'max': 20},
+          'description': {'text': 'テストサーバー'}}
+
+
+def read_varint(sock):
+    value = 0
+    for i in range(5):
+        byte = recv_exact(sock, 1)[0]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise ValueError('VarInt is too big.')
+
+
+def varint(value):
+    data = b''
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data += bytes([byte | 0x80])
+        else:
+            return data + bytes([byte])
+
+
+def read_packet(sock):
+    length = read_varint(sock)
+    return recv_exact(sock, length)
+
+
+def parse_varint(data, offset):
+    value = 0
+    for i in range(5):
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, offset
+    raise ValueError('VarInt is too big.')
+
+
+class StatusHandler:
+    """ハンドシェイクとステータス要求を受け取り、ステータスを数バイトずつ返す"""
+
+    def __init__(self, status=STATUS, packet_id=0x00):
+        self.status = status
+        self.packet_id = packet_id
+        self.handshake = None
+        self.request = None
+
+    def __call__(self, sock):
+        handshake = read_packet(sock)
+        packet_id, offset = parse_varint(handshake, 0)
+        protocol, offset = parse_varint(handshake, offset)
+        host_length, offset = parse_varint(handshake, offset)
+        host = handshake[offset:offset + host_length].decode('utf-8')
+        offset += host_length
+        port = struct.unpack('>H', handshake[offset:offset + 2])[0]
+        next_state, offset = parse_varint(handshake, offset + 2)
+        self.handshake = {'packet_id': packet_id, 'protocol': protocol, 'host': host, 'port': port,
+                          'next_state': next_state, 'rest': handshake[offset:]}
+        self.request = read_packet(sock)
+
+        body = json.dumps(self.status).encode('utf-8')
+        payload = varint(self.packet_id) + varint(len(body)) + body
+        response = varint(len(payload)) + payload
+        for start in range(0, len(response), 7):
+            sock.sendall(response[start:start + 7])
+
+
+@pytest.mark.parametrize('value, encoded', [
+    (0, b'\x00'),
+    (1, b'\x01'),
+    (127, b'\x7f'),
+    (128, b'\x80\x01'),
+    (300, b'\xac\x02'),
+    (25565, b'\xdd\xc7\x01'),
+    (-1, b'\xff\xff\xff\xff\x0f'),
+])
+def test_pack_varint(value, encoded):
+    assert _pack_varint(value) == encoded
+
+
+def test_ping_handshake_and_status():
+    handler = StatusHandler()
+    with StubServer(handler) as server:
+        status = ping('127.0.0.1', server.port, timeout=2)
+
+    assert handler.handshake == {'packet_id': 0x00, 'protocol': 0xFFFFFFFF, 'host': '127.0.0.1',
+                                 'port': server.port, 'next_state': 1, 'rest': b''}
+    assert handler.request == b'\x00'
+    assert status['players'] == {'online': 3, 'max': 20}
+    assert status['description']['text'] == 'テストサーバー'
+    assert status['latency'] >= 0
+
+
+def test_ping_reads_a_status_longer_than_one_varint_byte():
+    status = dict(STATUS, description={'text': 'x' * 1000})
+    with StubServer(StatusHandler(status)) as server:
+        assert ping('127.0.0.1', server.port, timeout=2)['description']['text'] == 'x' * 1000
+
+
+def test_ping_rejects_an_unexpected_packet_id():
+    with StubServer(StatusHandler(packet_id=0x01)) as server:
+        with pytest.raises(ValueError, match='Unexpected packet id'):
+            ping('127.0.0.1', server.port, timeout=2)
+
+
+def test_ping_raises_when_the_server_closes_early():
+    def handler(sock):
+        read_packet(sock)
+        read_packet(sock)
+        sock.sendall(varint(100) + b'\x00')
+
+    with StubServer(handler) as server:
+        with pytest.raises(ConnectionError):
+            ping('127.0.0.1', server.port, timeout=2)
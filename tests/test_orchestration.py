@@ -0,0 +1,63 @@
+from deadline import Deadline, DeadlineExceededError
+from orchestration import FINISHED, WAITING, LocalScheduler, Wait, Workflow, new_state, run_workflow
+
+
+def make_workflow(steps, start=None):
+    errors = []
+    workflow = Workflow('test', steps, start or (lambda context: None), lambda context, error: errors.append(error))
+    return workflow, errors
+
+
+def test_start_failure_is_reported_to_on_error():
+    def start(context):
+        raise KeyError('unknown')
+
+    ran = []
+    workflow, errors = make_workflow([('step', lambda context: ran.append(True))], start)
+
+    assert run_workflow(workflow, new_state(workflow, {}), LocalScheduler()) == FINISHED
+    assert [type(error) for error in errors] == [KeyError]
+    assert ran == []
+
+
+def test_wait_is_scheduled_and_resumed():
+    polls = []
+
+    def step(context):
+        polls.append(context.clock())
+        if len(polls) < 3:
+            return Wait(10, 'not yet')
+
+    workflow, errors = make_workflow([('step', step)])
+    runner = LocalScheduler()
+    runner.run(workflow, {})
+
+    assert polls == [0.0, 10.0, 20.0]
+    assert runner.invocations == 3
+    assert errors == []
+
+
+def test_handoff_without_progress_fails_instead_of_looping():
+    # 予備(5秒)がタイムアウト(1秒)以上なので、呼び出しの最初から予算が無い
+    deadline = Deadline(1000, reserve=5, clock=lambda: 0.0)
+    workflow, errors = make_workflow([('step', lambda context: None)])
+    runner = LocalScheduler()
+
+    assert run_workflow(workflow, new_state(workflow, {}), runner, deadline=deadline) == FINISHED
+    assert [type(error) for error in errors] == [DeadlineExceededError]
+    assert runner.queue == []
+
+
+def test_handoff_after_progress_continues_in_a_new_invocation():
+    now = [0.0]
+    deadline = Deadline(10000, reserve=5, clock=lambda: now[0])
+
+    def step(context):
+        now[0] += 6
+
+    workflow, errors = make_workflow([('first', step), ('second', step)])
+    runner = LocalScheduler()
+
+    assert run_workflow(workflow, new_state(workflow, {}), runner, deadline=deadline) == WAITING
+    assert len(runner.queue) == 1
+    assert errors == []
@@ -0,0 +1,41 @@
+import play_schedule
+from play_schedule import IDLE_MAX_MINUTES, IDLE_MIN_MINUTES, build_profile, idle_limit_minutes, should_prewarm
+from player_stats import DAY, SAMPLE_INTERVAL, WEEK, PlayerSeries
+
+# 2025-10-06(月) 0:00 JST
+MONDAY = 1_759_676_400
+
+
+def history(days, playing_hour=None, end=MONDAY + 2 * WEEK):
+    """end までの days 日分の履歴(playing_hour 時台だけ毎日1人が遊ぶ)"""
+    series = PlayerSeries()
+    for t in range(int(end - days * DAY), end, SAMPLE_INTERVAL):
+        hour = (t + play_schedule.TOKYO_OFFSET) // 3600 % 24
+        series.append(t, 1 if hour == playing_hour else 0)
+    return series
+
+
+def test_no_history_keeps_the_longest_limit():
+    now = MONDAY + 2 * WEEK
+    profile = build_profile(PlayerSeries(), now)
+
+    assert profile is None
+    assert idle_limit_minutes(profile, now) == IDLE_MAX_MINUTES
+    assert not should_prewarm(profile, now + 20 * 3600 - 300)
+
+
+def test_short_history_is_not_learned():
+    now = MONDAY + 2 * WEEK
+    # 3日間誰も来なくても、まだ見ていない曜日・時間帯は短くしない
+    assert build_profile(history(3), now) is None
+    assert idle_limit_minutes(build_profile(history(3), now), now) == IDLE_MAX_MINUTES
+
+
+def test_learned_profile_scales_the_limit():
+    now = MONDAY + 2 * WEEK
+    profile = build_profile(history(14, playing_hour=20), now)
+
+    assert idle_limit_minutes(profile, now + 20 * 3600) == IDLE_MAX_MINUTES
+    assert idle_limit_minutes(profile, now + 3 * 3600) == IDLE_MIN_MINUTES
+    assert should_prewarm(profile, now + 20 * 3600 - 300)
+    assert not should_prewarm(profile, now + 3 * 3600 - 300)
@@ -0,0 +1,100 @@
+import datetime
+import json
+
+import player_probe
+from player_probe import ProbeResult, confirm_idle
+
+
+class FakeSSM:
+    """AWS-RunShellScript をすぐに完了させ、決まった標準出力を返す"""
+
+    class exceptions:
+        class InvalidInstanceId(Exception):
+            pass
+
+        class InvocationDoesNotExist(Exception):
+            pass
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.instance_ids = []
+
+    def send_command(self, InstanceIds, **kwargs):
+        self.instance_ids = list(InstanceIds)
+        return {'Command': {'CommandId': 'command-1'}}
+
+    def list_command_invocations(self, CommandId, Details=False, **kwargs):
+        return {'CommandInvocations': [
+            {'InstanceId': instance_id, 'Status': 'Success',
+             'CommandPlugins': [{'Output': self.stdout, 'ResponseCode': 0}]}
+            for instance_id in self.instance_ids
+        ]}
+
+    def get_paginator(self, name):
+        ssm = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(ssm, name)(**kwargs)
+
+        return Paginator()
+
+
+def ssm_output(booted, users=0, players=0):
+    return (f"{booted:%Y-%m-%d %H:%M:%S}\n{' '.join(['ec2-user'] * users)}\n# users={users}\n"
+            f"{json.dumps({'user': players})}\n# memory=0 0\n")
+
+
+def instance(launched_minutes_ago):
+    launched = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=launched_minutes_ago)
+    return {'InstanceId': 'i-1', 'PublicIpAddress': '192.0.2.10', 'LaunchTime': launched}
+
+
+def ping_result(uptime_minutes):
+    return ProbeResult(backend='ping', uptime_minutes=uptime_minutes, login_user_cnt=0,
+                       minecraft_login_user_cnt=0, latency=0.0)
+
+
+def run_confirm(stdout, server):
+    return confirm_idle({'survival': server}, {'survival': ping_result(0)}, FakeSSM(stdout))['survival']
+
+
+def test_confirm_idle_uses_time_since_resume_from_hibernation():
+    # 10時間前に起動した OS を、5分前に休止から復帰した
+    booted = datetime.datetime.now() - datetime.timedelta(hours=10)
+    result = run_confirm(ssm_output(booted), instance(launched_minutes_ago=5))
+
+    assert result.backend == 'ssm'
+    assert result.uptime_minutes == 5
+
+
+def test_confirm_idle_uses_os_uptime_after_reboot():
+    # 10時間前に起動したインスタンスの OS を、20分前に再起動した
+    booted = datetime.datetime.now() - datetime.timedelta(minutes=20)
+    result = run_confirm(ssm_output(booted), instance(launched_minutes_ago=600))
+
+    assert result.uptime_minutes == 20
+
+
+def test_confirm_idle_reports_ec2_users():
+    booted = datetime.datetime.now() - datetime.timedelta(hours=1)
+    result = run_confirm(ssm_output(booted, users=2), instance(launched_minutes_ago=60))
+
+    assert result.login_user_cnt == 2
+    assert result.minecraft_login_user_cnt == 0
+
+
+def test_confirm_idle_keeps_ssm_results():
+    probe = ProbeResult(backend='ssm', uptime_minutes=45, login_user_cnt=0, minecraft_login_user_cnt=0, latency=0.0)
+    ssm = FakeSSM('')
+    results = confirm_idle({'survival': instance(45)}, {'survival': probe}, ssm)
+
+    assert results == {'survival': probe}
+    assert ssm.instance_ids == []
+
+
+def test_launch_uptime_minutes():
+    now = datetime.datetime(2025, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    server = {'LaunchTime': now - datetime.timedelta(minutes=31, seconds=30)}
+
+    assert player_probe.launch_uptime_minutes(server, now) == 31
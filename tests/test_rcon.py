@@ -0,0 +1,95 @@
+import struct
+
+import pytest
+
+from rcon import PACKET_COMMAND, PACKET_LOGIN, RconClient, RconError
+from stub_server import StubServer, recv_exact
+
+PASSWORD = 'secret'
+PACKET_RESPONSE = 0
+PACKET_AUTH_RESPONSE = 2
+
+
+def read_packet(sock):
+    length = struct.unpack('<i', recv_exact(sock, 4))[0]
+    payload = recv_exact(sock, length)
+    request_id, packet_type = struct.unpack('<ii', payload[:8])
+    assert payload[-2:] == b'\x00\x00'
+    return request_id, packet_type, payload[8:-2].decode('utf-8')
+
+
+def send_packet(sock, request_id, packet_type, body):
+    payload = struct.pack('<ii', request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+    sock.sendall(struct.pack('<i', len(payload)) + payload)
+
+
+class RconHandler:
+    """ログインを確かめ、コマンドに決まった応答を返す"""
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.packets = []
+
+    def __call__(self, sock):
+        request_id, packet_type, body = read_packet(sock)
+        self.packets.append((packet_type, body))
+        if packet_type != PACKET_LOGIN or body != PASSWORD:
+            send_packet(sock, -1, PACKET_AUTH_RESPONSE, '')
+            return
+        send_packet(sock, request_id, PACKET_AUTH_RESPONSE, '')
+
+        while True:
+            try:
+                request_id, packet_type, body = read_packet(sock)
+            except ConnectionError:
+                return
+            self.packets.append((packet_type, body))
+            send_packet(sock, request_id, PACKET_RESPONSE, self.responses.get(body, f'Unknown command: {body}'))
+
+
+def test_login_and_command_round_trip():
+    handler = RconHandler({'list': 'There are 2 of a max of 20 players online: alex, steve'})
+    with StubServer(handler) as server:
+        with RconClient('127.0.0.1', server.port, PASSWORD, timeout=2) as rcon:
+            assert rcon.command('list') == 'There are 2 of a max of 20 players online: alex, steve'
+            assert rcon.command('tps') == 'Unknown command: tps'
+
+    assert handler.packets == [(PACKET_LOGIN, PASSWORD), (PACKET_COMMAND, 'list'), (PACKET_COMMAND, 'tps')]
+
+
+def test_command_with_multibyte_response():
+    handler = RconHandler({'say こんにちは': '[Server] こんにちは'})
+    with StubServer(handler) as server:
+        with RconClient('127.0.0.1', server.port, PASSWORD, timeout=2) as rcon:
+            assert rcon.command('say こんにちは') == '[Server] こんにちは'
+
+
+def test_authentication_failure():
+    handler = RconHandler()
+    with StubServer(handler) as server:
+        client = RconClient('127.0.0.1', server.port, 'wrong', timeout=2)
+        with pytest.raises(RconError, match='authentication failed'):
+            client.connect()
+
+    assert client.sock is None
+    assert handler.packets == [(PACKET_LOGIN, 'wrong')]
+
+
+def test_unexpected_response_id():
+    def handler(sock):
+        request_id, _, _ = read_packet(sock)
+        send_packet(sock, request_id, PACKET_AUTH_RESPONSE, '')
+        request_id, _, _ = read_packet(sock)
+        send_packet(sock, request_id + 10, PACKET_RESPONSE, '')
+        read_packet_or_close(sock)
+
+    def read_packet_or_close(sock):
+        try:
+            read_packet(sock)
+        except ConnectionError:
+            pass
+
+    with StubServer(handler) as server:
+        with RconClient('127.0.0.1', server.port, PASSWORD, timeout=2) as rcon:
+            with pytest.raises(RconError, match='Unexpected RCON response id'):
+                rcon.command('list')
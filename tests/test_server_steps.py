@@ -0,0 +1,54 @@
+import clients
+import server_steps
+from orchestration import StepContext, Workflow, new_state
+
+WORKFLOW = Workflow('stop', [], None, None)
+
+
+class FakeEC2:
+    def describe_instances(self, InstanceIds):
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': InstanceIds[0], 'State': {'Name': 'running'}, 'PublicIpAddress': '192.0.2.10'}]}]}
+
+
+def rcon_context(monkeypatch, port_open=True, redelivered=False):
+    sent = []
+    monkeypatch.setattr(server_steps, 'STOP_MODE', 'rcon')
+    monkeypatch.setattr(server_steps, 'record_instance', lambda instance: None)
+    monkeypatch.setattr(server_steps, 'send_rcon_stop', lambda host: sent.append(host) or 0.5)
+    monkeypatch.setattr(server_steps, 'is_rcon_port_open', lambda host: port_open)
+    monkeypatch.setitem(clients._clients, 'ec2', FakeEC2())
+
+    state = new_state(WORKFLOW, {})
+    state['data']['instance_id'] = 'i-1'
+    state['redelivered'] = redelivered
+    return StepContext(WORKFLOW, state), sent
+
+
+def test_rcon_stop_is_sent_once(monkeypatch):
+    context, sent = rcon_context(monkeypatch)
+    step = server_steps.send_stop('Minecraft_stop.sh')
+
+    step(context)
+    step(context)
+
+    assert sent == ['192.0.2.10']
+    assert context.data['rcon_stop_sent']
+
+
+def test_redelivered_rcon_stop_skips_a_closed_port(monkeypatch):
+    context, sent = rcon_context(monkeypatch, port_open=False, redelivered=True)
+
+    server_steps.send_stop('Minecraft_stop.sh')(context)
+
+    assert sent == []
+    assert context.data['rcon_stop_sent']
+
+
+def test_first_delivery_sends_rcon_stop_even_if_the_port_check_fails(monkeypatch):
+    # 設定ミスでポートが閉じていても、最初の配信では停止を試みる(失敗すればワークフローが失敗する)
+    context, sent = rcon_context(monkeypatch, port_open=False)
+
+    server_steps.send_stop('Minecraft_stop.sh')(context)
+
+    assert sent == ['192.0.2.10']
@@ -0,0 +1,261 @@
+import pytest
+
+import deadline
+import ssm_command
+from ssm_command import (CommandError, CommandTimeoutError, check_command, run_fleet_script, run_shell_script,
+                         wait_for_command)
+
+
+class FakeClock:
+    """sleep() で進む時計"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ScriptedSSM:
+    """get_command_invocation が script の順にステータスを返す(最後の要素は繰り返す)"""
+
+    class exceptions:
+        class InvalidInstanceId(Exception):
+            pass
+
+        class InvocationDoesNotExist(Exception):
+            pass
+
+    def __init__(self, script, send_failures=0):
+        self.script = list(script)
+        self.send_failures = send_failures
+        self.sent = []
+        self.polls = 0
+
+    def send_command(self, **kwargs):
+        if self.send_failures:
+            self.send_failures -= 1
+            raise self.exceptions.InvalidInstanceId()
+        self.sent.append(kwargs)
+        return {'Command': {'CommandId': 'command-1'}}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        assert (CommandId, InstanceId) == ('command-1', 'i-1')
+        self.polls += 1
+        step = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        if step is NOT_REGISTERED:
+            raise self.exceptions.InvocationDoesNotExist()
+        return step
+
+
+NOT_REGISTERED = object()
+IN_PROGRESS = {'Status': 'InProgress'}
+
+
+def finished(status, stdout='', stderr='', code=0, details=''):
+    return {'Status': status, 'StatusDetails': details or status, 'StandardOutputContent': stdout,
+            'StandardErrorContent': stderr, 'ResponseCode': code}
+
+
+@pytest.fixture(autouse=True)
+def unlimited_deadline():
+    deadline.activate(deadline.UNLIMITED)
+    yield
+    deadline.activate(deadline.UNLIMITED)
+
+
+def test_wait_until_success():
+    clock = FakeClock()
+    ssm = ScriptedSSM([NOT_REGISTERED, IN_PROGRESS, IN_PROGRESS, finished('Success', stdout='done\n')])
+
+    result = wait_for_command(ssm, 'command-1', 'i-1', timeout=60, sleep=clock.sleep, clock=clock)
+
+    assert result.ok
+    assert result.stdout == 'done\n'
+    assert result.exit_code == 0
+    assert result.history == ['InProgress', 'Success']
+    assert result.polls == 4
+    assert clock.sleeps == pytest.approx([0.25, 0.4, 0.64, 1.024])
+    assert result.elapsed == pytest.approx(sum(clock.sleeps))
+
+
+def test_backoff_is_capped():
+    clock = FakeClock()
+    ssm = ScriptedSSM([IN_PROGRESS] * 10 + [finished('Success')])
+
+    wait_for_command(ssm, 'command-1', 'i-1', timeout=600, sleep=clock.sleep, clock=clock)
+
+    assert max(clock.sleeps) == ssm_command.POLL_MAX_INTERVAL
+    assert clock.sleeps[-1] == ssm_command.POLL_MAX_INTERVAL
+
+
+def test_failed_command_raises_command_error():
+    clock = FakeClock()
+    ssm = ScriptedSSM([IN_PROGRESS, finished('Failed', stderr='boom\n', code=2)])
+
+    with pytest.raises(CommandError, match='Failed: boom') as raised:
+        wait_for_command(ssm, 'command-1', 'i-1', timeout=60, sleep=clock.sleep, clock=clock)
+
+    assert not isinstance(raised.value, CommandTimeoutError)
+    assert raised.value.result.exit_code == 2
+    assert raised.value.result.history == ['InProgress', 'Failed']
+
+
+def test_timed_out_status_raises_timeout_error():
+    clock = FakeClock()
+    ssm = ScriptedSSM([IN_PROGRESS, finished('TimedOut', code=-1, details='Execution timed out')])
+
+    with pytest.raises(CommandTimeoutError, match='Execution timed out') as raised:
+        wait_for_command(ssm, 'command-1', 'i-1', timeout=60, sleep=clock.sleep, clock=clock)
+
+    assert raised.value.result.status == 'TimedOut'
+
+
+def test_timeout_cuts_off_polling():
+    clock = FakeClock()
+    ssm = ScriptedSSM([IN_PROGRESS])
+
+    with pytest.raises(CommandTimeoutError, match='within 10 seconds') as raised:
+        wait_for_command(ssm, 'command-1', 'i-1', timeout=10, sleep=clock.sleep, clock=clock)
+
+    # 最後の待機は期限までの残り時間に切り詰められ、期限を越えて待たない
+    assert clock.now == pytest.approx(10)
+    assert raised.value.result.status == 'InProgress'
+    assert raised.value.result.elapsed == pytest.approx(10)
+    assert ssm.polls == len(clock.sleeps)
+
+
+def test_timeout_counts_from_started():
+    clock = FakeClock()
+    clock.now = 8.0
+    ssm = ScriptedSSM([IN_PROGRESS])
+
+    with pytest.raises(CommandTimeoutError):
+        wait_for_command(ssm, 'command-1', 'i-1', timeout=10, sleep=clock.sleep, clock=clock, started=0.0)
+
+    assert sum(clock.sleeps) == pytest.approx(2)
+
+
+def test_lambda_deadline_stops_the_wait():
+    clock = FakeClock()
+    deadline.activate(deadline.Deadline(3000, reserve=1, clock=clock))
+    ssm = ScriptedSSM([IN_PROGRESS])
+
+    with pytest.raises(deadline.DeadlineExceededError, match='SSM command command-1'):
+        wait_for_command(ssm, 'command-1', 'i-1', timeout=60, sleep=clock.sleep, clock=clock)
+
+    assert clock.now == pytest.approx(2)
+
+
+def test_run_shell_script_retries_until_the_agent_registers():
+    clock = FakeClock()
+    ssm = ScriptedSSM([finished('Success')], send_failures=2)
+
+    result = run_shell_script(ssm, 'i-1', ['echo hi'], timeout=60, sleep=clock.sleep, clock=clock,
+                              execution_timeout=30)
+
+    assert result.ok
+    assert clock.sleeps[:2] == [ssm_command.SEND_RETRY_INTERVAL] * 2
+    assert ssm.sent == [{'InstanceIds': ['i-1'], 'DocumentName': 'AWS-RunShellScript',
+                         'Parameters': {'commands': ['echo hi'], 'executionTimeout': ['30']}}]
+
+
+def test_run_shell_script_gives_up_sending_after_the_timeout():
+    clock = FakeClock()
+    ssm = ScriptedSSM([finished('Success')], send_failures=100)
+
+    with pytest.raises(ScriptedSSM.exceptions.InvalidInstanceId):
+        run_shell_script(ssm, 'i-1', ['echo hi'], timeout=5, sleep=clock.sleep, clock=clock)
+
+    assert clock.now == pytest.approx(5)
+    assert not ssm.sent
+
+
+@pytest.mark.parametrize('step', [NOT_REGISTERED, IN_PROGRESS])
+def test_check_command_pending(step):
+    assert check_command(ScriptedSSM([step]), 'command-1', 'i-1') is None
+
+
+def test_check_command_finished():
+    assert check_command(ScriptedSSM([finished('Success', stdout='ok')]), 'command-1', 'i-1').stdout == 'ok'
+    with pytest.raises(CommandError):
+        check_command(ScriptedSSM([finished('Failed')]), 'command-1', 'i-1')
+
+
+class FleetSSM:
+    """list_command_invocations を page_size 件ずつ返し、done_after 回目の一覧から完了にする"""
+
+    def __init__(self, instance_ids, page_size=2, done_after=2, failed=()):
+        self.instance_ids = instance_ids
+        self.page_size = page_size
+        self.done_after = done_after
+        self.failed = set(failed)
+        self.pages = []
+        self.listings = 0
+
+    def send_command(self, InstanceIds, **kwargs):
+        assert InstanceIds == self.instance_ids
+        return {'Command': {'CommandId': 'command-1'}}
+
+    def list_command_invocations(self, CommandId, Details=False, NextToken=None):
+        assert Details
+        start = int(NextToken or 0)
+        if start == 0:
+            self.listings += 1
+        self.pages.append(start)
+        invocations = []
+        for instance_id in self.instance_ids[start:start + self.page_size]:
+            if self.listings < self.done_after:
+                invocations.append({'InstanceId': instance_id, 'Status': 'InProgress'})
+                continue
+            code = 1 if instance_id in self.failed else 0
+            invocations.append({'InstanceId': instance_id, 'Status': 'Failed' if code else 'Success',
+                                'CommandPlugins': [{'Output': f'{instance_id} done', 'ResponseCode': code}]})
+        page = {'CommandInvocations': invocations}
+        if start + self.page_size < len(self.instance_ids):
+            page['NextToken'] = str(start + self.page_size)
+        return page
+
+    def get_paginator(self, name):
+        ssm = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    page = getattr(ssm, name)(NextToken=token, **kwargs)
+                    yield page
+                    token = page.get('NextToken')
+                    if not token:
+                        return
+
+        return Paginator()
+
+
+def test_run_fleet_script_reads_every_page():
+    clock = FakeClock()
+    instance_ids = [f'i-{n}' for n in range(5)]
+    ssm = FleetSSM(instance_ids, failed={'i-3'})
+
+    results = run_fleet_script(ssm, instance_ids, ['echo hi'], timeout=60, sleep=clock.sleep, clock=clock)
+
+    assert ssm.pages == [0, 2, 4, 0, 2, 4]
+    assert [results[i].status for i in instance_ids] == ['Success', 'Success', 'Success', 'Failed', 'Success']
+    assert results['i-4'].stdout == 'i-4 done'
+    assert results['i-3'].exit_code == 1
+    assert all(result.polls == 2 for result in results.values())
+
+
+def test_run_fleet_script_returns_pending_at_the_timeout():
+    clock = FakeClock()
+    ssm = FleetSSM(['i-1', 'i-2', 'i-3'], done_after=1000)
+
+    results = run_fleet_script(ssm, ['i-1', 'i-2', 'i-3'], ['echo hi'], timeout=3, sleep=clock.sleep, clock=clock)
+
+    assert {result.status for result in results.values()} == {'InProgress'}
+    assert clock.now == pytest.approx(3)
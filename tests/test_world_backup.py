@@ -0,0 +1,143 @@
+import io
+import os
+import shlex
+import time
+
+import pytest
+
+import world_backup
+from world_backup import backup, backup_commands, list_snapshots, restore
+
+CHUNK_SIZE = 4096
+BUCKET = 'backups'
+PREFIX = 'worlds/main'
+
+
+class FakeS3:
+    """list_objects_v2 / get_object / put_object だけのメモリ上のバケット"""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+        self.puts.append(Key)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for bucket, key in s3.objects if bucket == Bucket and key.startswith(Prefix))
+                # 1ページ2件ずつ返して、ページングも通す
+                for start in range(0, max(len(keys), 1), 2):
+                    yield {'Contents': [{'Key': key} for key in keys[start:start + 2]]} if keys else {}
+
+        return Paginator()
+
+
+def write(path, data, mtime_ns=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def read_tree(root):
+    tree = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+@pytest.fixture
+def world(tmp_path):
+    world_dir = tmp_path / 'world'
+    # リージョンファイルは4チャンク分、level.dat は1チャンク未満
+    write(str(world_dir / 'region' / 'r.0.0.mca'), b''.join(bytes([i]) * CHUNK_SIZE for i in range(4)))
+    write(str(world_dir / 'region' / 'r.0.1.mca'), b''.join(bytes([i + 10]) * CHUNK_SIZE for i in range(4)))
+    write(str(world_dir / 'level.dat'), b'level data')
+    return str(world_dir)
+
+
+def test_backup_uploads_only_changed_chunks_and_restores(world, tmp_path):
+    s3 = FakeS3()
+    first = backup(s3, BUCKET, PREFIX, world, chunk_size=CHUNK_SIZE, workers=2, now=1_760_000_000)
+    assert first['files'] == 3
+    assert first['uploaded_chunks'] == 9
+    original = read_tree(world)
+
+    # 1つのリージョンの2チャンク目だけを書き換える
+    region = os.path.join(world, 'region', 'r.0.0.mca')
+    with open(region, 'r+b') as f:
+        f.seek(CHUNK_SIZE)
+        f.write(b'\xff' * CHUNK_SIZE)
+    os.utime(region, ns=(1, 1))
+    s3.puts.clear()
+    second = backup(s3, BUCKET, PREFIX, world, chunk_size=CHUNK_SIZE, workers=2, now=1_760_000_600)
+
+    assert second['uploaded_chunks'] == 1
+    assert second['uploaded_bytes'] == CHUNK_SIZE
+    # 変わっていないファイルは読まない
+    assert second['read_bytes'] == 4 * CHUNK_SIZE
+    assert [key.split('/')[2] for key in s3.puts] == ['chunks', 'manifests']
+    assert len(list_snapshots(s3, BUCKET, PREFIX)) == 2
+    changed = read_tree(world)
+
+    # 最新のスナップショットを、余計なファイルがあるワールドに復元する
+    write(os.path.join(world, 'region', 'r.9.9.mca'), b'stray')
+    assert restore(s3, BUCKET, PREFIX, world, workers=2)['files'] == 3
+    assert read_tree(world) == changed
+    assert os.stat(region).st_mtime_ns == 1
+    assert not os.path.exists(world + '.restoring')
+
+    # 以前の時刻を指定すると、1回目のスナップショットに戻る
+    restore(s3, BUCKET, PREFIX, world, at=time.strftime(world_backup.SNAPSHOT_FORMAT, time.gmtime(1_760_000_300)))
+    assert read_tree(world) == original
+
+
+def test_restore_without_snapshot_leaves_the_world(world):
+    with pytest.raises(RuntimeError, match='No snapshot'):
+        restore(FakeS3(), BUCKET, PREFIX, world)
+    assert 'level.dat' in read_tree(world)
+
+
+def test_restore_rejects_a_corrupted_chunk(world):
+    s3 = FakeS3()
+    backup(s3, BUCKET, PREFIX, world, chunk_size=CHUNK_SIZE, now=1_760_000_000)
+    chunk = next(key for key in s3.objects if '/chunks/' in key[1])
+    s3.objects[chunk] = b'corrupted'
+    before = read_tree(world)
+
+    with pytest.raises(RuntimeError, match='corrupted'):
+        restore(s3, BUCKET, PREFIX, world)
+    assert read_tree(world) == before
+
+
+def test_backup_commands_quote_arguments():
+    commands = backup_commands('my bucket', "prefix; rm -rf /", "/home/ec2-user/my world")
+
+    assert shlex.split(commands[1]) == ['python3', '/tmp/world_backup.py', 'backup', '--bucket', 'my bucket',
+                                        '--prefix', 'prefix; rm -rf /', '--world', '/home/ec2-user/my world']
+    assert commands[0].endswith('> /tmp/world_backup.py')
+
+
+def test_parse_summary():
+    stdout = 'noise\n' + world_backup.SUMMARY_MARKER + '{"uploaded_chunks": 1}\n'
+    assert world_backup.parse_summary(stdout) == {'uploaded_chunks': 1}
+    assert world_backup.parse_summary('noise\n') is None